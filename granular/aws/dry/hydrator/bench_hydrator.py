@@ -0,0 +1,283 @@
+import os
+import sys
+from argparse import ArgumentParser
+import shutil
+import tempfile
+import time
+import tracemalloc
+import platform
+import json
+import re
+from pathlib import Path
+
+from hydrator import TerragruntConfigParser, Hydrator, HclParser, Block, FS_CACHE, INCLUDE_CACHE, RUN_DIR, CONFIG_FILE_NAME, environ, compile_expression, setup_logging
+
+RESULTS_FILE = Path('bench_results.json')
+REPEAT = 3
+REGRESSION_THRESHOLD = 0.25
+# Differences below this are noise, never a regression
+MIN_REGRESSION_SECONDS = 0.005
+PHASES = ['parse', 'resolve', 'copy', 'set_vars', 'run']
+
+# Every case varies one dimension of the generated configuration, everything else stays small
+DEFAULT_SIZES = {
+    'locals': 10,
+    'depth': 2,
+    'list_length': 10,
+    'interpolations': 1,
+    'stacks': 1,
+    'modules': 1,
+}
+CASES = {
+    'locals': {'locals': 2000},
+    'nesting': {'depth': 60},
+    'list': {'list_length': 20000},
+    'interpolation': {'interpolations': 20},
+    'includes': {'stacks': 100},
+    'modules': {'modules': 500},
+}
+
+
+def gen_config(locals=10, depth=2, list_length=10, interpolations=1) -> str:
+    """`terragrunt.hcl` of a stack with the given number of locals, depth of a nested object, length of a list and
+    number of interpolations in each of 100 strings"""
+
+    lines = ['include "backend" {', '  path = find_in_parent_folders("backend.hcl")', '}', '',
+             'terraform {', '  source = "../../tpl"', '}', '', 'locals {', '  l0 = "value-0"']
+
+    # Every local references another one, resolved in the dependency order
+    lines += [f'  l{i} = "${{local.l{i // 2}}}-{i}"' for i in range(1, locals)]
+
+    nested = '"leaf"'
+    for i in range(depth):
+        nested = f'{{\n    level = {i}\n    child = {nested}\n  }}'
+    lines.append(f'  nested = {nested}')
+
+    lines.append('  items = [' + ', '.join([f'"item-{i}"' for i in range(list_length)]) + ']')
+
+    parts = [f'${{local.l{i % locals}}}' if i % 2 == 0 else '${replace("a-b", "-", "_")}' for i in range(interpolations)]
+    lines.append('  interpolated = [')
+    lines += [f'    "{i}-' + '-'.join(parts) + '",' for i in range(100)]
+    lines += ['  ]', '}', '']
+
+    lines += ['inputs = {', '  all_locals = [' + ', '.join([f'local.l{i}' for i in range(locals)]) + ']',
+              '  nested = local.nested', '  items = local.items', '  interpolated = local.interpolated', '}']
+    return '\n'.join(lines) + '\n'
+
+def gen_backend() -> str:
+    return """
+remote_state {
+  backend = "s3"
+  config = {
+    bucket = "bench"
+    key    = "state/${path_relative_to_include()}/terraform.tfstate"
+    region = "eu-west-1"
+  }
+}
+"""
+
+def gen_template(modules=1) -> str:
+    """`main.tf` of the Terraform template with the given number of modules"""
+
+    lines = ['terraform {', '  backend "s3" {}', '}', '']
+    for i in range(modules):
+        lines += [f'module "m{i}" {{', '  source = "./modules/m"', f'  name   = "m{i}"', '}', '']
+    return '\n'.join(lines)
+
+def generate(root: Path, locals=10, depth=2, list_length=10, interpolations=1, stacks=1, modules=1) -> list:
+    """Write the Terraform template and the stacks under the root, return the directories of the stacks"""
+
+    (root / 'tpl' / 'modules' / 'm').mkdir(parents=True)
+    (root / 'tpl' / 'main.tf').write_text(gen_template(modules))
+    (root / 'tpl' / 'modules' / 'm' / 'main.tf').write_text('variable "name" {}\n')
+    (root / 'config').mkdir()
+    (root / 'config' / 'backend.hcl').write_text(gen_backend())
+
+    config = gen_config(locals, depth, list_length, interpolations)
+    dirs = []
+    for i in range(stacks):
+        d = root / 'config' / f'stack-{i}'
+        d.mkdir()
+        (d / CONFIG_FILE_NAME).write_text(config)
+        dirs.append(d)
+    return dirs
+
+def stub_terraform(bin_dir: Path) -> dict:
+    """Environment with a `terraform` which does nothing, so the runs are offline and measure only the hydrator"""
+
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    if os.name == 'nt':
+        tf = bin_dir / 'terraform.cmd'
+        tf.write_text('@exit /b 0\n')
+    else:
+        tf = bin_dir / 'terraform'
+        tf.write_text('#!/bin/sh\nexit 0\n')
+        tf.chmod(0o755)
+    return {'PATH': f'{bin_dir}{os.pathsep}{os.environ.get("PATH", "")}'}
+
+def reset_caches():
+    """Forget everything cached by the earlier runs in this process"""
+
+    FS_CACHE.clear()
+    INCLUDE_CACHE.clear()
+    compile_expression.cache_clear()
+
+def measure(func, setup=None, repeat=REPEAT) -> dict:
+    """Best time of the runs and the peak memory allocated by one more run, `setup` runs before every run untimed"""
+
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    # Tracing slows down everything, so the memory is measured separately
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': best, 'peak_bytes': peak}
+
+def run_case(root: Path, sizes: dict, repeat=REPEAT, phases=PHASES) -> dict:
+    dirs = generate(root, **sizes)
+    stack = dirs[0]
+    env = stub_terraform(root / 'bin')
+    results = {}
+
+    def parse_all():
+        for d in dirs:
+            TerragruntConfigParser(d / CONFIG_FILE_NAME, terragrunt_dir=d)
+
+    def clean():
+        reset_caches()
+        shutil.rmtree(stack / RUN_DIR, ignore_errors=True)
+
+    if 'parse' in phases:
+        results['parse'] = measure(parse_all, reset_caches, repeat)
+
+    reset_caches()
+    config = TerragruntConfigParser(stack / CONFIG_FILE_NAME, terragrunt_dir=stack)
+    if 'resolve' in phases:
+        # Resolve everything already parsed into the intermediate form, compiled expressions are reused
+        intermediate = HclParser(config.config_str.strip()).parse()
+        def resolve():
+            config._resolve_locals(intermediate[config._block_key(Block.LOCALS)])
+            config._resolve(intermediate[config._block_key(Block.INPUTS)], block_type=Block.INPUTS)
+        results['resolve'] = measure(resolve, None, repeat)
+
+    runner = Hydrator('plan', cache_dir=None, stack_dir=stack)
+    runner.config_parser = config
+    if 'copy' in phases:
+        results['copy'] = measure(runner._copy, lambda: shutil.rmtree(stack / RUN_DIR, ignore_errors=True), repeat)
+    if 'set_vars' in phases:
+        runner._copy()
+        results['set_vars'] = measure(runner._set_vars, None, repeat)
+    if 'run' in phases:
+        with environ(env):
+            results['run'] = measure(Hydrator('plan', cache_dir=None, stack_dir=stack).run, clean, repeat)
+    return results
+
+def run_benchmarks(cases=CASES, scale=1.0, repeat=REPEAT, phases=PHASES) -> dict:
+    """Run every case in a temporary directory, sizes are multiplied by the scale"""
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': repeat,
+            'scale': scale,
+        },
+        'cases': {},
+    }
+    for name, case in cases.items():
+        sizes = dict(DEFAULT_SIZES)
+        sizes.update({k: max(1, int(v * scale)) for k, v in case.items()})
+        with tempfile.TemporaryDirectory() as d:
+            results['cases'][name] = run_case(Path(d), sizes, repeat, phases)
+            results['cases'][name]['sizes'] = sizes
+    return results
+
+def compare(results: dict, baseline: dict, threshold=REGRESSION_THRESHOLD) -> list:
+    """Return `(case, phase, baseline seconds, seconds)` of every phase slower than the baseline by more than the threshold"""
+
+    regressions = []
+    for name, phases in results['cases'].items():
+        base = baseline.get('cases', {}).get(name, {})
+        for phase, res in phases.items():
+            if phase not in base or phase == 'sizes':
+                continue
+            old, new = base[phase]['seconds'], res['seconds']
+            if new > old * (1 + threshold) and new - old > MIN_REGRESSION_SECONDS:
+                regressions.append((name, phase, old, new))
+    return regressions
+
+def print_results(results: dict):
+    for name, phases in results['cases'].items():
+        for phase in PHASES:
+            if phase in phases:
+                res = phases[phase]
+                print(f"{name:<15} {phase:<10} {res['seconds'] * 1000:>10.1f} ms {res['peak_bytes'] / 1024 / 1024:>10.1f} MiB")
+
+def get_args():
+    parser = ArgumentParser(
+        description='Benchmark the hydrator with generated configurations'
+    )
+    parser.add_argument(
+        '-o',
+        '--out',
+        default=str(RESULTS_FILE),
+        help='File to write the results to, as JSON'
+    )
+    parser.add_argument(
+        '--compare',
+        default=None,
+        help='Results of an earlier run (e.g. saved with `--out`) to compare with, fails if any phase is slower by more than the threshold'
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=REGRESSION_THRESHOLD,
+        help='Maximum allowed slowdown against the baseline, as a fraction'
+    )
+    parser.add_argument(
+        '--case',
+        default=None,
+        help=f'Regular expression of the cases to run, out of {list(CASES)}'
+    )
+    parser.add_argument(
+        '--scale',
+        type=float,
+        default=1.0,
+        help='Multiplier of the sizes of the generated configurations'
+    )
+    parser.add_argument(
+        '-r',
+        '--repeat',
+        type=int,
+        default=REPEAT,
+        help='Number of runs of each phase, the best time is reported'
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    setup_logging('WARNING')
+    cases = {k: v for k, v in CASES.items() if args.case is None or re.search(args.case, k)}
+    results = run_benchmarks(cases, args.scale, args.repeat)
+    print_results(results)
+    Path(args.out).write_text(json.dumps(results, indent=2))
+
+    if args.compare is not None:
+        regressions = compare(results, json.loads(Path(args.compare).read_text()), args.threshold)
+        for name, phase, old, new in regressions:
+            print(f'Regression in {name}/{phase}: {old * 1000:.1f} ms -> {new * 1000:.1f} ms')
+        if regressions:
+            sys.exit(1)
@@ -1,13 +1,41 @@
 import os
+import sys
+import json
+import socket
+import array
+import struct
+import stat
+import tempfile
+from pathlib import Path
 from argparse import ArgumentParser
 import shutil
+import subprocess
+import shlex
+import signal
+import traceback
+import threading
+import copy
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager, nullcontext
+import cProfile
+import pstats
 from datetime import datetime as dt
 import logging
 # from enum import StrEnum, auto
 from enum import Enum
 import re
-from pathlib import Path
-import json
+import hashlib
+import gzip
+import mmap
+from collections import OrderedDict
+from functools import lru_cache
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
 
 # class Operation(StrEnum):
 #     INIT = auto()
@@ -48,74 +76,1497 @@ class Block(Enum):
     LOCALS = 2
     REMOTE_STATE = 3
     TERRAFORM = 4
+    DEPENDENCIES = 5
+    DEPENDENCY = 6
     def val(self):
         return self.name.lower()
 
 CONFIG_FILE_NAME = 'terragrunt.hcl'
 RUN_DIR = Path('_hydrator')
-SUB_REPLACE = '§|'
-QUOTE_REPLACE = '`'
-QUOTE_ESCAPE_REPLACE = "'"
 INC_PREFIX = 'include_'
-TF_RUN_FORMAT = 'cd _hydrator && terraform {}'
+TF_COMMAND = 'terraform'
+# Seconds Terraform gets to stop cleanly (e.g. release the state lock) after it was interrupted, before it is killed
+TF_STOP_GRACE = 30
+# Seconds to wait for the rest of the output after Terraform exited, anything it started may still hold the pipe open
+TF_OUTPUT_GRACE = 1
+META_DIR = RUN_DIR / '.hydrator'
+CONFIG_CACHE_DIR = META_DIR / 'config-cache'
+CONFIG_CACHE_ENTRIES = 8
+STAGING_MANIFEST = META_DIR / 'staging.json'
+# Files Terraform itself may write to, those are never linked to the originals
+STAGING_COPY_ONLY = ['.terraform.lock.hcl', 'terraform.tfstate']
+# Files Terraform owns once staged, never removed from the run directory even if they are no longer among the sources
+STAGING_KEEP = ['terraform.tfstate']
+RUN_ALL = 'run-all'
+RUN_ALL_WORKERS = 4
+RENDER = 'render'
+DRIFT = 'drift'
+STATES = 'states'
+REMOTE_STATE_PARAMS_SUFFIX = '_remote_state_params'
+LOCK_FILE_NAME = '.terraform.lock.hcl'
+PROFILE_FILE = META_DIR / 'profile.json'
+# `--profile` without a file, the report goes to `PROFILE_FILE` of the run directory
+PROFILE_IN_RUN_DIR = object()
+INIT_FINGERPRINT = META_DIR / 'init.json'
+PLAN_FILE = 'hydrator.tfplan'
+# Changes of the saved plan by module, resource type and action, in the run directory
+PLAN_SUMMARY = 'plan-summary.json'
+PLAN_RECORD = META_DIR / 'plan.json'
+# Held for the whole run, only one run at a time may use a run directory
+RUN_LOCK = META_DIR / 'run.lock'
+# Outputs of a stack cached for the stacks depending on it, relative to the stack directory
+DEPENDENCY_OUTPUTS = META_DIR / 'outputs.json'
+# Record of the last clean drift scan and the output of the last scan
+DRIFT_RECORD = META_DIR / 'drift.json'
+DRIFT_LOG = META_DIR / 'drift.log'
+# Lines of the output included in the summary for the stacks which failed
+DRIFT_ERROR_LINES = 20
+# History of the local state, relative to the stack directory, and the number of the latest snapshots kept in it
+STATE_STORE = META_DIR / 'states'
+STATE_SNAPSHOTS_KEEP = 50
+# Files in the run directory which do not change what is planned
+PLAN_KEY_IGNORED = [PLAN_FILE, PLAN_SUMMARY, 'terraform.tfstate', 'terraform.tfstate.backup']
+PLAN_KEY_ENV_PREFIXES = ('TF_VAR_', 'TF_WORKSPACE')
+# Files of the run directory which are not part of the rendered output
+RENDER_IGNORED = [PLAN_FILE, PLAN_SUMMARY, 'terraform.tfstate', 'terraform.tfstate.backup']
+# Only these values of the `terraform show -json` output are read, everything else (e.g. the before and after values of
+# every change) is skipped without decoding. Array items are matched by `*`
+PLAN_SUMMARY_PATHS = [
+    ('resource_changes', '*', 'address'),
+    ('resource_changes', '*', 'module_address'),
+    ('resource_changes', '*', 'type'),
+    ('resource_changes', '*', 'change', 'actions', '*'),
+]
+PLAN_SUMMARY_ACTIONS = ['create', 'update', 'replace', 'delete']
+JSON_STREAM_CHUNK = 1024 * 1024
+# Tokens of a Terraform file as far as blocks and their string attributes are concerned. Text (with strings) is matched in
+# runs up to the next brace, comment, heredoc or end of line, each alternative either matches at once or fails at its first
+# character so the scan is linear
+TF_TOKEN_RE = re.compile(r"""
+    (?P<comment>\#[^\n]*|//[^\n]*|/\*.*?\*/)
+  | (?P<heredoc><<-?(?P<tag>[A-Za-z_]\w*)\n.*?^[^\S\n]*(?P=tag)[^\S\n]*$)
+  | (?P<newline>\n\s*)
+  | (?P<brace>[{}])
+  | (?P<text>(?:[^"\#/<{}\n]+|"(?:[^"\\\n]|\\.)*"|/(?![/*])|<(?!<))+|.)
+""", re.VERBOSE | re.DOTALL | re.MULTILINE)
+TF_WORD_RE = re.compile(r'[A-Za-z_][\w-]*|"(?:[^"\\\n]|\\.)*"|\S')
+TF_MODULE_ATTR_RE = re.compile(r'\s*(source|version)\s*=\s*("(?:[^"\\\n]|\\.)*")\s*')
+# Anything up to the next brace which is not in a string, comment or heredoc, to skip the blocks which do not matter
+TF_SKIP_RE = re.compile(r"""(?:[^"\#/<{}]+|"(?:[^"\\\n]|\\.)*"|\#[^\n]*|//[^\n]*|/\*.*?\*/|<<-?([A-Za-z_]\w*)\n.*?^[^\S\n]*\1[^\S\n]*$|[/<"])*""", re.DOTALL | re.MULTILINE)
+FILE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DIR_CACHE_MAX_ENTRIES = 10000
+JSON_VIEW_MAX_ENTRIES = 64
+EXPRESSION_CACHE_SIZE = 4096
 LOG_LEVEL = logging.INFO
+LOG_FORMAT = '[%(asctime)s]: %(message)s'
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Messages are formatted only if they are going to be logged, pass the values as arguments instead of formatting them
+parser_log = logging.getLogger('hydrator.parser')
+staging_log = logging.getLogger('hydrator.staging')
+runner_log = logging.getLogger('hydrator.runner')
+
+class JsonLinesFormatter(logging.Formatter):
+    """Format the records as JSON objects, one per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        res = {
+            'time': dt.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            res['exception'] = self.formatException(record.exc_info)
+        return json.dumps(res, default=str)
+
+def setup_logging(level=LOG_LEVEL, json_file: Path=None):
+    """Log to the standard output, and also as JSON lines to the file if given"""
+
+    root = logging.getLogger('hydrator')
+    root.setLevel(level)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+    handlers = [handler]
+    if json_file is not None:
+        handler = logging.FileHandler(json_file)
+        handler.setFormatter(JsonLinesFormatter())
+        handlers.append(handler)
+    for h in root.handlers:
+        if h not in handlers:
+            h.close()
+    root.handlers = handlers
+
+def sort_dependencies(dependencies: dict, name='dependencies') -> list:
+    """Topologically sort the keys so every key comes after the ones it depends on, fail on cycles. Dependencies which
+    are not keys themselves are ignored"""
+
+    order = []
+    # 1 - being visited, 2 - done
+    state = {}
+    for start in dependencies:
+        if start in state:
+            continue
+        state[start] = 1
+        path = [start]
+        stack = [iter(sorted(dependencies[start]))]
+        while stack:
+            dep = next(stack[-1], None)
+            if dep is None:
+                stack.pop()
+                key = path.pop()
+                state[key] = 2
+                order.append(key)
+            elif dep not in dependencies or state.get(dep) == 2:
+                continue
+            elif state.get(dep) == 1:
+                cycle = path[path.index(dep):] + [dep]
+                raise LookupError(f"Cycle in {name}: {' -> '.join([str(c) for c in cycle])}")
+            else:
+                state[dep] = 1
+                path.append(dep)
+                stack.append(iter(sorted(dependencies[dep])))
+    return order
+
+def hcl_string(literal: str) -> str:
+    if '\\' not in literal:
+        return literal[1:-1]
+    try:
+        return json.loads(literal)
+    except ValueError:
+        # Not a JSON escape, e.g. `$${`, kept as it is
+        return literal[1:-1]
+
+def scan_tf(txt: str) -> tuple:
+    """Find the `module` blocks and the `backend` and `required_providers` blocks (of the `terraform` block) of a
+    Terraform file in one pass, skipping strings, comments and heredocs
+
+    Returns the modules as `(name, source, start, end, version)` with the position of the `source` string and the version
+    (None if not given), the backends as `(name, start, end, empty)` with the position of the whole block and whether it
+    has nothing but comments in it, and the required providers as `(start, end)` positions of the whole blocks"""
+
+    modules, backends, required_providers = [], [], []
+    # Kinds of the open blocks, None for the ones which do not matter
+    blocks = []
+    # Position of the statement being read, None if nothing but comments read since the last one
+    start = end = None
+    pos, n = 0, len(txt)
+    while pos < n:
+        if blocks and blocks[-1] not in ('module', 'terraform'):
+            # Nothing in it matters, only the braces are followed
+            pos = TF_SKIP_RE.match(txt, pos).end()
+            if pos >= n:
+                break
+            if txt[pos] == '{':
+                blocks.append(None)
+            else:
+                block = blocks.pop()
+                if block == 'backend':
+                    name, block_start, body_start = backend
+                    body = [m for m in TF_TOKEN_RE.finditer(txt, body_start, pos) if m.lastgroup != 'comment' and not m.group().isspace()]
+                    backends.append((name, block_start, pos + 1, not body))
+                elif block == 'required_providers':
+                    required_providers.append((block_start, pos + 1))
+            pos += 1
+            continue
+
+        m = TF_TOKEN_RE.match(txt, pos)
+        pos = m.end()
+        kind = m.lastgroup
+        if kind in ('text', 'heredoc'):
+            if start is None:
+                start = m.start()
+            end = m.end()
+            continue
+        if kind == 'comment':
+            continue
+
+        # End of the statement
+        if start is not None and blocks == ['module']:
+            attr = TF_MODULE_ATTR_RE.fullmatch(txt, start, end)
+            if attr is not None:
+                module[attr.group(1)] = (hcl_string(attr.group(2)), attr.start(2), attr.end(2))
+        if m.group() == '{':
+            block = None
+            words = TF_WORD_RE.findall(txt, start, m.start()) if start is not None else []
+            block_start = start + len(txt[start:end]) - len(txt[start:end].lstrip()) if start is not None else None
+            if not blocks and len(words) == 2 and words[0] == 'module' and words[1][0] == '"':
+                block = 'module'
+                module = {'name': hcl_string(words[1])}
+            elif not blocks and words == ['terraform']:
+                block = 'terraform'
+            elif blocks == ['terraform'] and len(words) == 2 and words[0] == 'backend' and words[1][0] == '"':
+                block = 'backend'
+                backend = (hcl_string(words[1]), block_start, pos)
+            elif blocks == ['terraform'] and words == ['required_providers']:
+                block = 'required_providers'
+            blocks.append(block)
+        elif m.group() == '}' and blocks:
+            if blocks.pop() == 'module' and 'source' in module:
+                source, source_start, source_end = module['source']
+                modules.append((module['name'], source, source_start, source_end, module.get('version', (None, ))[0]))
+        start = end = None
+    return modules, backends, required_providers
+
+def local_module_dirs(root: Path) -> list:
+    """The directory and all the directories of the local modules used from it, directly or not"""
+
+    res = []
+    dirs = [root]
+    seen = set()
+    while dirs:
+        d = dirs.pop()
+        key = str(d.resolve())
+        if key in seen or not d.is_dir():
+            continue
+        seen.add(key)
+        res.append(d)
+        for f in sorted(d.glob('*.tf')):
+            for _, source, _, _, _ in scan_tf(f.read_text())[0]:
+                if source.startswith(('./', '../')):
+                    dirs.append(d / source)
+    return res
+
+def find_stacks(root: Path, prefix='') -> list:
+    """Directories with a config file below the root"""
+
+    FS_CACHE.index(root)
+    return sorted([
+        p.parent.resolve() for p in root.rglob(prefix + CONFIG_FILE_NAME)
+        if not any([is_run_dir(part) for part in p.parts]) and '.terragrunt-cache' not in p.parts
+    ])
+
+def stack_run_dir(stack: Path, prefix='') -> Path:
+    """Run directory of the config with the prefix in the stack, every prefix has its own (with its own `.terraform` and
+    records) so configs of different prefixes can run at the same time"""
+
+    name = prefix.rstrip('-_.') or prefix
+    return stack / (f'{RUN_DIR.name}-{name}' if name else RUN_DIR.name)
+
+def is_run_dir(name: str) -> bool:
+    return name == RUN_DIR.name or name.startswith(f'{RUN_DIR.name}-')
+
+def config_prefix(config_file: Path) -> str:
+    """Prefix of the config file, empty for an include"""
+
+    return config_file.name[:-len(CONFIG_FILE_NAME)] if config_file.name.endswith(CONFIG_FILE_NAME) else ''
+
+def meta_path(run_dir: Path, path: Path) -> Path:
+    """Path of a file of the hydrator (e.g. `PLAN_RECORD`) in the run directory"""
+
+    return run_dir / path.relative_to(RUN_DIR)
+
+def local_state_file(stack: Path, prefix='') -> Path:
+    """Local state of the config with the prefix in the stack directory, `terraform.tfstate` for the config without a
+    prefix like Terragrunt has it and e.g. `dev-terraform.tfstate` for the others so they never share it. It is staged as
+    `terraform.tfstate` into the run directory"""
+
+    return stack / f'{prefix}terraform.tfstate'
+
+def state_id(run_dir: Path, runner: 'TerraformRunner'=None) -> str:
+    """Lineage and serial of the state of the run directory, empty if there is no state yet and `None` if not known (e.g.
+    not initialized). Local state is read directly, otherwise `terraform state pull` neither refreshes anything nor loads
+    any providers so it is much faster than e.g. `plan`"""
+
+    local_state = run_dir / 'terraform.tfstate'
+    if local_state.exists():
+        try:
+            state = json.loads(local_state.read_text())
+        except ValueError:
+            return None
+        return f"{state.get('lineage', '')}:{state.get('serial', '')}"
+    if not (run_dir / '.terraform').exists():
+        return None
+
+    runner = runner if runner is not None else TerraformRunner()
+    res, output = runner.read(['state', 'pull'], run_dir, lambda stream: stream.read())
+    if res['exit_code'] != 0:
+        return None
+    if not output.strip():
+        return ''
+    try:
+        state = json.loads(output)
+    except ValueError:
+        return None
+    return f"{state.get('lineage', '')}:{state.get('serial', '')}"
+
+def dependency_outputs(run_dir: Path, runner: 'TerraformRunner'=None) -> tuple:
+    """Return the state id and the outputs of the stack, `None` outputs if it has none yet. `terraform output` runs only if
+    the state changed since the outputs were cached"""
+
+    stack = run_dir.parent
+    runner = runner if runner is not None else TerraformRunner()
+    state = state_id(run_dir, runner)
+    if not state:
+        return state, None
+
+    cache_file = meta_path(run_dir, DEPENDENCY_OUTPUTS)
+    try:
+        cached = json.loads(cache_file.read_text())
+        if cached['state'] == state:
+            parser_log.debug('Using cached outputs of %s', stack)
+            return state, cached['outputs']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    parser_log.debug('Reading outputs of %s', stack)
+    res, output = runner.read(['output', '-json'], run_dir, lambda stream: stream.read())
+    if res['exit_code'] != 0:
+        raise RuntimeError(f"`terraform output` failed in {run_dir}: {res['stderr'].strip()}")
+    outputs = {k: v['value'] for k, v in json.loads(output or '{}').items()}
+
+    write_atomic(cache_file, json.dumps({'state': state, 'outputs': outputs}))
+    return state, outputs
+
+def write_atomic(path: Path, text):
+    """Write to a temporary file first so concurrent runs (processes or threads) never see a partially written file"""
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+    if isinstance(text, bytes):
+        tmp.write_bytes(text)
+    else:
+        tmp.write_text(text)
+    os.replace(tmp, path)
+
+@contextmanager
+def environ(values: dict):
+    """Temporarily set the environment variables"""
+
+    saved = {k: os.environ.get(k, None) for k in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
 
-def log(msg: str, level=logging.DEBUG):
-    if LOG_LEVEL <= level:
-        print(f'[{dt.now().strftime("%Y-%m-d %H:%M:%S")}]: {msg}')
+class FileLock:
+    """Exclusive lock on a file, shared between processes"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    # Gives up after 10 seconds, keep trying
+                    msvcrt.locking(self.fd, msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        return self
+
+    def __exit__(self, *args):
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        else:
+            msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+        os.close(self.fd)
+        self.fd = None
+
+@contextmanager
+def redirected_streams(fds: list):
+    """Temporarily replace the standard streams (stdin, stdout, stderr, in this order) of this process and of the commands
+    it runs with the file descriptors"""
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(i) for i in range(len(fds))]
+    for i, fd in enumerate(fds):
+        os.dup2(fd, i)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for i, fd in enumerate(saved):
+            os.dup2(fd, i)
+            os.close(fd)
+
+class HclParser:
+    """Single pass HCL parser producing the intermediate dict consumed by `TerragruntConfigParser`
+
+    The source is tokenized once and the tokens are consumed by a recursive-descent parser. Blocks, objects and lists become
+    dicts and lists, literals other than strings become Python values and everything else (strings, references, function
+    calls) is kept as an expression string in HCL syntax, compiled by `ExpressionCompiler`. Quoted strings are single
+    tokens with their source text, heredocs are turned into the equivalent quoted strings. Keys and block labels are
+    decoded
+    """
+
+    # Whitespace and comments are collected as a single run so each token knows whether a new line precedes it
+    TOKEN_RE = re.compile(r'''
+        (?P<ws>(?:[ \t\r\n]+|\#[^\n]*|//[^\n]*|/\*.*?\*/)+)
+      | (?P<number>\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+      | (?P<ident>[A-Za-z_][A-Za-z0-9_\-]*)
+      | (?P<op>==|!=|<=|>=|&&|\|\||=>|\.\.\.)
+    ''', re.VERBOSE | re.DOTALL)
+    HEREDOC_RE = re.compile(r'<<(-?)([A-Za-z_][A-Za-z0-9_]*)[ \t]*\r?\n')
+    STRING_SPECIAL_RE = re.compile(r'[\\"]|\$?\$\{')
+    INTERPOLATION_SPECIAL_RE = re.compile(r'["{}]')
+    HEREDOC_SPECIAL_RE = re.compile(r'\$?\$\{')
+    NUMBER_RE = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?')
+    LITERALS = {'true': True, 'false': False, 'null': None}
+
+    # Token kinds
+    EOF = 0
+    IDENT = 1
+    NUMBER = 2
+    STRING = 3
+    PUNCT = 4
+
+    def __init__(self, src: str):
+        self.src = src
+        self.tokens = []
+        self.pos = 0
+
+    def parse(self) -> dict:
+        self._tokenize()
+        res = self._parse_body(top_level=True)
+        if self._peek()[0] != self.EOF:
+            self._fail('Unexpected token')
+        return res
+
+    def _fail(self, msg: str):
+        token = self._peek()
+        line = self.src.count('\n', 0, token[4]) + 1
+        raise ValueError(f'{msg} `{token[1]}` at line {line}')
+
+    def _tokenize(self):
+        """Split the source into `(kind, text, new_line_before, whitespace_before, offset)` tuples"""
+
+        src = self.src
+        n = len(src)
+        i = 0
+        ws = ''
+        tokens = self.tokens
+        match = self.TOKEN_RE.match
+        while i < n:
+            m = match(src, i)
+            if m is not None:
+                kind = m.lastgroup
+                text = m.group()
+                if kind == 'ws':
+                    ws = text
+                else:
+                    tokens.append((self.IDENT if kind == 'ident' else self.NUMBER if kind == 'number' else self.PUNCT, text, '\n' in ws, ws, i))
+                    ws = ''
+                i = m.end()
+                continue
+
+            c = src[i]
+            if c == '"':
+                j = self._string_end(src, i)
+                text = src[i:j]
+            elif src.startswith('<<', i) and self.HEREDOC_RE.match(src, i):
+                text, j = self._scan_heredoc(i)
+            else:
+                tokens.append((self.PUNCT, c, '\n' in ws, ws, i))
+                ws = ''
+                i += 1
+                continue
+            tokens.append((self.STRING, text, '\n' in ws, ws, i))
+            ws = ''
+            i = j
+        tokens.append((self.EOF, '', True, ws, n))
+
+    def _string_end(self, text: str, i: int) -> int:
+        """Position after the quoted template starting at `i`, skipping its escapes and interpolations"""
+
+        search = self.STRING_SPECIAL_RE.search
+        i += 1
+        while True:
+            m = search(text, i)
+            if m is None:
+                raise ValueError(f'Unclosed string at line {text.count(chr(10), 0, i) + 1}')
+            j = m.start()
+            c = m.group()
+            if c == '"':
+                return j + 1
+            if c == '\\':
+                i = j + 2
+            elif c == '$${':
+                # Escaped, a literal `${`
+                i = m.end()
+            else:
+                i = self._interpolation_end(text, m.end())
+
+    def _interpolation_end(self, text: str, i: int) -> int:
+        """Position after the closing brace of the `${...}` body starting at `i`, strings in it may contain braces"""
+
+        depth = 0
+        search = self.INTERPOLATION_SPECIAL_RE.search
+        while True:
+            m = search(text, i)
+            if m is None:
+                raise ValueError(f'Unclosed interpolation at line {text.count(chr(10), 0, i) + 1}')
+            j = m.start()
+            c = text[j]
+            if c == '"':
+                i = self._string_end(text, j)
+                continue
+            i = j + 1
+            if c == '{':
+                depth += 1
+            elif depth == 0:
+                return i
+            else:
+                depth -= 1
+
+    def _scan_heredoc(self, i: int) -> tuple:
+        """Return the heredoc starting at `i` as the equivalent quoted template and the position after its end marker"""
+
+        src = self.src
+        m = self.HEREDOC_RE.match(src, i)
+        indented, marker = m.group(1), m.group(2)
+        end = re.compile(rf'^[ \t]*{marker}[ \t]*$', re.MULTILINE).search(src, m.end())
+        if end is None:
+            raise ValueError(f'Unclosed heredoc `{marker}` at line {src.count(chr(10), 0, i) + 1}')
+        lines = src[m.end():end.start()].split('\n')
+        if indented:
+            # `<<-` strips the common leading indentation
+            margin = min((len(l) - len(l.lstrip()) for l in lines if l.strip()), default=0)
+            lines = [l[margin:] for l in lines]
+        text = '\n'.join(lines)
+
+        def escaped(literal: str) -> str:
+            return literal.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        # Heredocs have no escapes, everything but the interpolations is escaped for the quotes
+        parts = ['"']
+        pos = 0
+        for m in self.HEREDOC_SPECIAL_RE.finditer(text):
+            if m.start() < pos:
+                continue
+            parts.append(escaped(text[pos:m.start()]))
+            pos = m.end() if m.group() == '$${' else self._interpolation_end(text, m.end())
+            parts.append(text[m.start():pos])
+        parts.append(escaped(text[pos:]))
+        parts.append('"')
+        return ''.join(parts), end.end()
+
+    def _peek(self) -> tuple:
+        return self.tokens[self.pos]
+
+    def _next(self) -> tuple:
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def _expect(self, text: str):
+        kind, token_text = self._peek()[:2]
+        if kind != self.PUNCT or token_text != text:
+            self._fail(f"Expected '{text}', got")
+        self.pos += 1
+
+    def _parse_body(self, top_level=False) -> dict:
+        """Parse attributes and nested blocks until the closing brace (or the end of the source at the top level)"""
+
+        res = {}
+        while True:
+            kind, text = self._peek()[:2]
+            if kind == self.EOF:
+                if not top_level:
+                    self._fail('Unclosed block, got')
+                return res
+            if kind == self.PUNCT and text == '}' and not top_level:
+                self.pos += 1
+                return res
+            if kind == self.PUNCT and text == ',' and not top_level:
+                # Object items may be comma separated
+                self.pos += 1
+                continue
+            if kind not in (self.IDENT, self.STRING, self.NUMBER):
+                self._fail('Expected an attribute or block name, got')
+            self.pos += 1
+            key = hcl_string(text) if kind == self.STRING else text
+
+            kind, text = self._peek()[:2]
+            if kind == self.PUNCT and text in ('=', ':'):
+                self.pos += 1
+                res[key] = self._parse_value(',}' if not top_level else '')
+                continue
+
+            # A block, possibly with labels, e.g. `include "backend" {`
+            labels = []
+            while self._peek()[0] in (self.STRING, self.IDENT):
+                kind, text = self._next()[:2]
+                labels.append(hcl_string(text) if kind == self.STRING else text)
+            self._expect('{')
+            body = self._parse_body()
+            if not labels:
+                res[key] = body
+            elif top_level and key == Block.INCLUDE.val():
+                res[INC_PREFIX + labels[0]] = body
+            else:
+                node = res.setdefault(key, {})
+                for label in labels[:-1]:
+                    node = node.setdefault(label, {})
+                node[labels[-1]] = body
+
+    def _parse_list(self) -> list:
+        res = []
+        while True:
+            kind, text = self._peek()[:2]
+            if kind == self.PUNCT and text == ']':
+                self.pos += 1
+                return res
+            if kind == self.PUNCT and text == ',':
+                self.pos += 1
+                continue
+            if kind == self.EOF:
+                self._fail('Unclosed list, got')
+            res.append(self._parse_value(',]'))
+
+    def _parse_value(self, stops: str):
+        kind, text = self._peek()[:2]
+        if kind == self.PUNCT and text in ('{', '['):
+            # `for` expressions are kept as expressions
+            following = self.tokens[self.pos + 1]
+            if not (following[0] == self.IDENT and following[1] == 'for'):
+                self.pos += 1
+                return self._parse_body() if text == '{' else self._parse_list()
+        return self._parse_expression(stops)
+
+    def _parse_expression(self, stops: str):
+        """Collect the tokens of a single expression, a new line ends it unless it is inside brackets"""
+
+        start = self.pos
+        parts = []
+        depth = 0
+        tokens = self.tokens
+        while True:
+            kind, text, nl, ws, _ = tokens[self.pos]
+            if kind == self.EOF:
+                break
+            if depth == 0 and self.pos > start and (nl or (kind == self.PUNCT and text in stops)):
+                break
+            if kind == self.PUNCT:
+                if text in '([{':
+                    depth += 1
+                elif text in ')]}':
+                    if depth == 0:
+                        break
+                    depth -= 1
+            if self.pos > start:
+                parts.append(' ' if nl else ws)
+            parts.append(text)
+            self.pos += 1
+
+        if self.pos == start:
+            self._fail('Expected a value, got')
+        if len(parts) == 1:
+            # A single token, convert literals
+            kind, text = tokens[start][:2]
+            if kind == self.STRING:
+                return text
+            if kind == self.IDENT and text in self.LITERALS:
+                return self.LITERALS[text]
+        expr = ''.join(parts)
+        if self.NUMBER_RE.fullmatch(expr):
+            return json.loads(expr)
+        return expr
+
+
+class UnresolvedReference(LookupError):
+    """A `local.`, `include.` or `dependency.` reference to a value which is not (yet) known"""
+
+    def __init__(self, root: str, ref: str):
+        super().__init__(ref)
+        self.root = root
+        self.ref = ref
+
+# Expression AST node kinds, nodes are tuples starting with the kind
+EXPR_LITERAL = 0
+EXPR_TEMPLATE = 1
+EXPR_REFERENCE = 2
+EXPR_CALL = 3
+EXPR_LIST = 4
+EXPR_OBJECT = 5
+# Reference steps
+STEP_ATTR = 0
+STEP_INDEX = 1
+
+class ExpressionCompiler:
+    """Compile a single expression (as stored by `HclParser`) into an AST
+
+    Supported are literals, quoted templates with `${...}` interpolations, `local.`, `include.` and `dependency.` references with
+    attribute and index steps, function calls, lists and objects. Strings are quoted templates with the escapes of HCL,
+    `$${` is a literal `${`. Text which does not start as an expression is treated as a template without the quotes (and
+    without escapes)
+
+    Nodes are:
+    - `(EXPR_LITERAL, value)`
+    - `(EXPR_TEMPLATE, (parts, ...))`, evaluates to the string concatenation of all the parts
+    - `(EXPR_REFERENCE, root, ((STEP_ATTR, name) | (STEP_INDEX, node), ...), text)`, where root is `local`, `include` or
+      `dependency`
+    - `(EXPR_CALL, name, (args, ...))`
+    - `(EXPR_LIST, (items, ...))`
+    - `(EXPR_OBJECT, ((key, node), ...))`
+    """
+
+    IDENT_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_\-]*')
+    NUMBER_RE = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?')
+    WS_RE = re.compile(r'\s*')
+    ESCAPES = {'"': '"', '\\': '\\', 'n': '\n', 't': '\t', 'r': '\r', '/': '/'}
+    LITERALS = {'true': True, 'false': False, 'null': None}
+    ROOTS = ['local', 'include', 'dependency']
+
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+
+    def compile(self) -> tuple:
+        self._skip_ws()
+        if not self._is_expression_start():
+            # Likely just a string
+            parts = self._template_parts(None)
+            return self._template(parts)
+
+        node = self._expression()
+        self._skip_ws()
+        if self.pos < len(self.text):
+            raise ValueError(f'Unsupported expression `{self.text}` at the position {self.pos}')
+        return node
+
+    def _fail(self, msg: str):
+        raise ValueError(f'{msg} in `{self.text}` at the position {self.pos}')
+
+    def _skip_ws(self):
+        self.pos = self.WS_RE.match(self.text, self.pos).end()
+
+    def _is_expression_start(self) -> bool:
+        text = self.text
+        if self.pos >= len(text):
+            return False
+        c = text[self.pos]
+        if c in '"[{(' or self.NUMBER_RE.match(text, self.pos):
+            return True
+        m = self.IDENT_RE.match(text, self.pos)
+        if m is None:
+            return False
+        name = m.group()
+        if name in self.LITERALS:
+            return True
+        rest = text[self.WS_RE.match(text, m.end()).end():m.end() + 64]
+        return rest.startswith('(') or (name in self.ROOTS and rest.startswith('.'))
+
+    def _expression(self) -> tuple:
+        self._skip_ws()
+        text = self.text
+        if self.pos >= len(text):
+            self._fail('Expected an expression')
+        c = text[self.pos]
+        if c == '"':
+            self.pos += 1
+            return self._template(self._template_parts(c))
+        if c == '[':
+            return self._list()
+        if c == '{':
+            return self._object()
+        if c == '(':
+            self.pos += 1
+            node = self._expression()
+            self._expect(')')
+            return node
+        m = self.NUMBER_RE.match(text, self.pos)
+        if m is not None:
+            self.pos = m.end()
+            return (EXPR_LITERAL, json.loads(m.group()))
+
+        start = self.pos
+        m = self.IDENT_RE.match(text, self.pos)
+        if m is None:
+            self._fail('Unexpected character')
+        name = m.group()
+        self.pos = m.end()
+        self._skip_ws()
+        if self.pos < len(text) and text[self.pos] == '(':
+            self.pos += 1
+            return (EXPR_CALL, name, self._items(')'))
+        if name in self.LITERALS:
+            return (EXPR_LITERAL, self.LITERALS[name])
+        if name not in self.ROOTS:
+            self._fail(f'Unknown reference `{name}`')
+
+        steps = []
+        while self.pos < len(text):
+            c = text[self.pos]
+            if c == '.':
+                m = self.IDENT_RE.match(text, self.pos + 1) or self.NUMBER_RE.match(text, self.pos + 1)
+                if m is None:
+                    self._fail('Expected an attribute name')
+                steps.append((STEP_ATTR, m.group()))
+                self.pos = m.end()
+            elif c == '[':
+                self.pos += 1
+                steps.append((STEP_INDEX, self._expression()))
+                self._expect(']')
+            else:
+                break
+        if not steps:
+            self._fail(f'Expected an attribute of `{name}`')
+        return (EXPR_REFERENCE, name, tuple(steps), text[start:self.pos])
+
+    def _expect(self, c: str):
+        self._skip_ws()
+        if self.pos >= len(self.text) or self.text[self.pos] != c:
+            self._fail(f"Expected '{c}'")
+        self.pos += 1
+
+    def _items(self, end: str) -> tuple:
+        """Comma separated expressions up to the closing character"""
+
+        items = []
+        while True:
+            self._skip_ws()
+            if self.pos < len(self.text) and self.text[self.pos] == end:
+                self.pos += 1
+                return tuple(items)
+            items.append(self._expression())
+            self._skip_ws()
+            if self.pos < len(self.text) and self.text[self.pos] == ',':
+                self.pos += 1
+            elif self.pos >= len(self.text) or self.text[self.pos] != end:
+                self._fail(f"Expected ',' or '{end}'")
+
+    def _list(self) -> tuple:
+        self.pos += 1
+        return (EXPR_LIST, self._items(']'))
+
+    def _object(self) -> tuple:
+        self.pos += 1
+        items = []
+        text = self.text
+        while True:
+            self._skip_ws()
+            if self.pos < len(text) and text[self.pos] == '}':
+                self.pos += 1
+                return (EXPR_OBJECT, tuple(items))
+            if self.pos < len(text) and text[self.pos] == '"':
+                self.pos += 1
+                key = self._template(self._template_parts('"'))
+            else:
+                m = self.IDENT_RE.match(text, self.pos)
+                if m is None:
+                    self._fail('Expected an object key')
+                key = (EXPR_LITERAL, m.group())
+                self.pos = m.end()
+            self._skip_ws()
+            if self.pos >= len(text) or text[self.pos] not in '=:':
+                self._fail("Expected '=' or ':'")
+            self.pos += 1
+            items.append((key, self._expression()))
+            self._skip_ws()
+            if self.pos < len(text) and text[self.pos] == ',':
+                self.pos += 1
+
+    def _template_parts(self, delimiter) -> list:
+        """Parse the template up to the closing delimiter, or up to the end of the text if there is no delimiter"""
+
+        text = self.text
+        n = len(text)
+        parts = []
+        chunk = []
+        while True:
+            if self.pos >= n:
+                if delimiter is not None:
+                    self._fail('Unclosed string')
+                break
+            c = text[self.pos]
+            if c == delimiter:
+                self.pos += 1
+                break
+            if c == '\\' and delimiter is not None and self.pos + 1 < n:
+                esc = text[self.pos + 1]
+                digits = {'u': 4, 'U': 8}.get(esc, 0)
+                if digits and self.pos + 2 + digits <= n:
+                    chunk.append(chr(int(text[self.pos + 2:self.pos + 2 + digits], 16)))
+                    self.pos += 2 + digits
+                else:
+                    chunk.append(self.ESCAPES.get(esc, '\\' + esc))
+                    self.pos += 2
+            elif c == '$' and delimiter is not None and text.startswith('$${', self.pos):
+                chunk.append('${')
+                self.pos += 3
+            elif c == '$' and text.startswith('${', self.pos):
+                if chunk:
+                    parts.append((EXPR_LITERAL, ''.join(chunk)))
+                    chunk = []
+                self.pos += 2
+                parts.append(self._expression())
+                self._expect('}')
+            else:
+                chunk.append(c)
+                self.pos += 1
+        if chunk:
+            parts.append((EXPR_LITERAL, ''.join(chunk)))
+        return parts
+
+    def _template(self, parts: list) -> tuple:
+        if not parts:
+            return (EXPR_LITERAL, '')
+        if len(parts) == 1 and parts[0][0] == EXPR_LITERAL:
+            return parts[0]
+        return (EXPR_TEMPLATE, tuple(parts))
+
+@lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def compile_expression(text: str) -> tuple:
+    """Compile the expression once, the AST is shared by all the parsers so it must never be modified"""
+
+    return ExpressionCompiler(text).compile()
+
+class Profiler:
+    """Wall and CPU time of the run phases and of the items (staged files, locals, functions) within them
+
+    Disabled unless there is somewhere to write the results to: a JSON report and/or `cProfile` statistics, written both in
+    the `pstats` format and as collapsed stacks for flame graphs"""
+
+    def __init__(self, report_file: Path=None, out_prefix: Path=None):
+        self.report_file = report_file
+        self.out_prefix = out_prefix
+        self.phases = {}
+        self.items = {}
+        self.cprofile = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.report_file is not None or self.out_prefix is not None
+
+    def start(self):
+        if self.out_prefix is not None:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        self._start = (time.perf_counter(), time.process_time())
+        return self
+
+    def stop(self):
+        if not self.enabled:
+            return
+        wall, cpu = time.perf_counter() - self._start[0], time.process_time() - self._start[1]
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.out_prefix.parent.mkdir(parents=True, exist_ok=True)
+            self.cprofile.dump_stats(f'{self.out_prefix}.pstats')
+            stats = pstats.Stats(self.cprofile)
+            Path(f'{self.out_prefix}.collapsed').write_text(''.join([f'{s} {v}\n' for s, v in self._collapsed_stacks(stats).items()]))
+            runner_log.info('Profile written to %s.pstats and %s.collapsed', self.out_prefix, self.out_prefix)
+        if self.report_file is not None:
+            report = {'total': {'wall': wall, 'cpu': cpu}, 'phases': self.phases}
+            report.update(self.items)
+            self.report_file.parent.mkdir(parents=True, exist_ok=True)
+            self.report_file.write_text(json.dumps(report, indent=2))
+            runner_log.info('Profile report written to %s', self.report_file)
+
+    @contextmanager
+    def phase(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.phases[name] = {'wall': time.perf_counter() - wall, 'cpu': time.process_time() - cpu}
+
+    @contextmanager
+    def measure(self, category: str, name: str):
+        """Accumulate the time of an item, e.g. all the calls of a function"""
+
+        if not self.enabled:
+            yield
+            return
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            item = self.items.setdefault(category, {}).setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+            item['calls'] += 1
+            item['wall'] += time.perf_counter() - wall
+            item['cpu'] += time.process_time() - cpu
+
+    def _collapsed_stacks(self, stats: pstats.Stats) -> dict:
+        """Approximate call stacks with their own time in microseconds, `cProfile` only records the direct callers so the
+        time of a function is split between its callers proportionally"""
+
+        def name(func):
+            return f'{Path(func[0]).name}:{func[1]}({func[2]})'
+
+        callees = {}
+        for func, (_, _, _, _, callers) in stats.stats.items():
+            for caller, (_, _, _, ct) in callers.items():
+                callees.setdefault(caller, []).append((func, ct))
+
+        res = {}
+        def walk(func, path, share):
+            _, _, tt, ct, _ = stats.stats[func]
+            path = path + [func]
+            own = int(tt * share * 1_000_000)
+            if own > 0:
+                key = ';'.join([name(f) for f in path])
+                res[key] = res.get(key, 0) + own
+            if ct > 0:
+                for callee, callee_ct in callees.get(func, []):
+                    if callee not in path:
+                        walk(callee, path, share * callee_ct / ct)
+
+        for func, (_, _, _, ct, callers) in stats.stats.items():
+            if not callers and ct > 0:
+                walk(func, [], 1.0)
+        return res
+
+class TerraformRunner:
+    """Run Terraform commands in the given directory, with the standard streams of the process unless there are sinks
+
+    With sinks the output is read line by line and every line is passed to each sink (a callable) as soon as it is read,
+    nothing is kept. `read` passes the standard output of the command to a callable instead, e.g. to parse it. A command running longer than the timeout is interrupted like with Ctrl-C and killed if it does not
+    stop within `TF_STOP_GRACE` seconds. Extra arguments are given per Terraform command, e.g. `{'plan': ['-parallelism=5']}`
+
+    The runners of a process are safe to use from any number of threads at the same time"""
+
+    # Commands running in all the runners (and the runs of `run-all`), signals received by the process are passed on to them
+    running = set()
+    running_lock = threading.Lock()
+
+    @classmethod
+    @contextmanager
+    def tracked(cls, proc: subprocess.Popen):
+        """Pass the signals received by the process on to `proc` while in the context"""
+
+        with cls.running_lock:
+            cls.running.add(proc)
+        try:
+            yield proc
+        finally:
+            with cls.running_lock:
+                cls.running.discard(proc)
+
+    def __init__(self, sinks: list=None, timeout: float=None, extra_args: dict=None):
+        self.sinks = sinks
+        self.timeout = timeout
+        self.extra_args = extra_args or {}
+
+    def command(self, args: list, env: dict=None) -> list:
+        """Full command line of the Terraform command, with the extra arguments right after the command itself"""
+
+        # Found the same way as by a shell, e.g. also `terraform.cmd` on Windows
+        executable = shutil.which(TF_COMMAND, path=(env if env is not None else os.environ).get('PATH', None)) or TF_COMMAND
+        return [executable, args[0]] + list(self.extra_args.get(args[0], [])) + list(args[1:])
+
+    def run(self, args: list, cwd: Path, env: dict=None) -> dict:
+        """Return the command, its exit code, the time taken and whether it timed out or was interrupted"""
+
+        piped = self.sinks is not None
+
+        def wait(proc: subprocess.Popen):
+            reader = None
+            if piped:
+                reader = threading.Thread(target=self._read, args=[proc.stdout], daemon=True)
+                reader.start()
+            proc.wait()
+            if reader is not None:
+                reader.join(TF_OUTPUT_GRACE)
+
+        return self._execute(args, cwd, env, wait, stdout=subprocess.PIPE if piped else None, stderr=subprocess.STDOUT if piped else None, text=True, errors='replace')
+
+    def read(self, args: list, cwd: Path, consume, env: dict=None) -> tuple:
+        """Run the command with its standard output passed to `consume(stream)` as it is written, return the result (like
+        `run` does, with the standard error added) and what `consume` returned. The sinks are not used"""
+
+        value = None
+        errors = []
+
+        def wait(proc: subprocess.Popen):
+            nonlocal value
+            reader = threading.Thread(target=lambda: errors.append(proc.stderr.read()), daemon=True)
+            reader.start()
+            with proc.stdout:
+                value = consume(proc.stdout)
+            proc.wait()
+            reader.join(TF_OUTPUT_GRACE)
+
+        res = self._execute(args, cwd, env, wait, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', errors='replace')
+        res['stderr'] = ''.join(errors)
+        return res, value
+
+    def _execute(self, args: list, cwd: Path, env: dict, wait, **popen_args) -> dict:
+        cmd = self.command(args, env)
+        res = {'command': [TF_COMMAND] + cmd[1:], 'cwd': str(cwd), 'exit_code': None, 'seconds': None, 'timed_out': False, 'interrupted': False}
+        runner_log.debug('Running %s in %s', res['command'], cwd)
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env, **popen_args)
+        timer = None
+        if self.timeout is not None:
+            timer = threading.Timer(self.timeout, self._expire, [proc, res])
+            timer.daemon = True
+            timer.start()
+        with self.tracked(proc):
+            try:
+                wait(proc)
+            except BaseException:
+                # E.g. Ctrl-C, Terraform got the signal as well (or it was passed on), give it time to stop cleanly
+                res['interrupted'] = True
+                self._stop(proc)
+                raise
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                res['exit_code'] = proc.returncode
+                res['seconds'] = time.perf_counter() - start
+        return res
+
+    def _read(self, stream):
+        with stream:
+            for line in stream:
+                for sink in self.sinks:
+                    sink(line)
+
+    def _expire(self, proc: subprocess.Popen, res: dict):
+        if proc.poll() is not None:
+            return
+        runner_log.error('`%s` timed out after %ss, interrupting it', ' '.join(res['command']), self.timeout)
+        res['timed_out'] = True
+        proc.send_signal(signal.SIGINT if os.name != 'nt' else signal.SIGTERM)
+        self._stop(proc)
+
+    def _stop(self, proc: subprocess.Popen):
+        try:
+            proc.wait(TF_STOP_GRACE)
+        except subprocess.TimeoutExpired:
+            runner_log.error('Terraform did not stop in %ds, killing it', TF_STOP_GRACE)
+            proc.kill()
+            proc.wait()
+
+def forward_signals():
+    """Pass SIGINT and SIGTERM received by the process on to the running Terraform commands (and the runs of `run-all`)
+    and stop, so they can stop cleanly before the process exits. Must be called from the main thread"""
+
+    def from_terminal() -> bool:
+        # Ctrl-C in the terminal interrupts the whole foreground process group, Terraform included, it must not get it
+        # twice (the second one stops it immediately)
+        try:
+            return os.tcgetpgrp(sys.stdin.fileno()) == os.getpgrp()
+        except (AttributeError, OSError, ValueError):
+            return os.name == 'nt'
+
+    def own_group(proc: subprocess.Popen) -> bool:
+        try:
+            return os.getpgid(proc.pid) == os.getpgrp()
+        except (AttributeError, OSError):
+            return os.name == 'nt'
+
+    def handler(signum, frame):
+        terminal = signum == signal.SIGINT and from_terminal()
+        with TerraformRunner.running_lock:
+            running = list(TerraformRunner.running)
+        for proc in running:
+            # The runs of `run-all` are in process groups of their own, Ctrl-C in the terminal does not reach them
+            if not terminal or not own_group(proc):
+                runner_log.info('Passing signal %d on to pid %d', signum, proc.pid)
+                proc.send_signal(signum)
+        if signum == signal.SIGINT:
+            raise KeyboardInterrupt()
+        raise SystemExit(128 + signum)
+
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signum, handler)
 
 class Hydrator:
-    def __init__(self, operation: str, allow_state=False, prefix=''):
+    """Hydrate a single stack (a directory with a config file) and run the Terraform operation for it
+
+    Every path is relative to the stack directory (the current directory unless given), nothing depends on the working
+    directory of the process, so any number of stacks can be run at the same time, e.g. from a pool of threads"""
+
+    def __init__(self, operation: str, allow_state=False, prefix='', cache_dir=CONFIG_CACHE_DIR, provider_cache=None, profiler=None, stack_dir: Path=None, runner: TerraformRunner=None):
         self.operation = Operation(operation)
         self.allow_state = allow_state
         self.prefix = prefix
         self.config_parser = None
+        self.profiler = profiler if profiler is not None else Profiler()
+        self.stack_dir = FS_CACHE.resolve_dir(stack_dir if stack_dir is not None else Path('.'))
+        self.run_dir = stack_run_dir(self.stack_dir, prefix)
+        # Wall time of each phase of the last run
+        self.timings = {}
+        self.runner = runner if runner is not None else TerraformRunner()
+        # Results of the Terraform commands of the last run
+        self.tf_results = []
+
+        # `ProviderCache` shared by all the `terraform init` runs, if any
+        self.provider_cache = provider_cache
+
+        # Resolved configs are cached unless `cache_dir` is None, a relative directory is relative to the stack and one in
+        # the run directory (the default) is in the run directory of the prefix
+        if cache_dir is not None and not cache_dir.is_absolute() and cache_dir.parts[:1] == RUN_DIR.parts:
+            cache_dir = meta_path(self.run_dir, cache_dir)
+        self.config_cache = ConfigCache(self.stack_dir / cache_dir, self.runner) if cache_dir is not None else None
+
+    def run(self) -> dict:
+        """Return the exit code of the operation (non zero if anything failed), the wall time of each phase, the paths
+        of the config file and the run directory and the results of the Terraform commands"""
 
-    def run(self):
         # If running only against a single state then it would be possible to avoid running all the steps when Destroying, but
         # that won't work if the same configuration is used to to deploy to different states (e.g. dev and test in the same target
         # environment but everything is the same, controlled by some prefix. Therefore all the operations will go throu the same steps
-        res = self.parse_config()._copy()._set_vars()._init(self.operation == Operation.INIT)._tf_run(self.operation)
-        if res > 0:
-            # Signal failure to the caller, stopping here
-            quit()
-
-        if self.operation == Operation.APPLY:
-            # Backup the lock file if not exists locally
-            lock_file = Path('.terraform.lock.hcl')
-            if not lock_file.exists() and (RUN_DIR / lock_file).exists():
-                shutil.copy(RUN_DIR / lock_file, lock_file)
-
-            # Backup the local state if existing state files are allowed
-            state_file = RUN_DIR / 'terraform.tfstate'
-            if self.allow_state and state_file.exists():
-                shutil.copy(state_file, Path('./'), )
-
-    def _init(self, no_op=False):
-        tf = RUN_DIR / '.terraform'
-        if not (no_op or tf.exists()):
-            self._tf_run(Operation.INIT)
+        start = time.perf_counter()
+        self.timings = {}
+        self.tf_results = []
+        self.profiler.start()
+        try:
+            with self._phase('parse'):
+                self.parse_config()
+            # Everything else uses the run directory, other runs of the same stack and prefix wait
+            with self.lock():
+                with self._phase('staging'):
+                    self._copy()
+                with self._phase('vars'):
+                    self._set_vars()
+                with self._phase('init'):
+                    # `init` operation always runs, otherwise only when anything it depends on changed
+                    res = self._init(force=self.operation == Operation.INIT).init_status
+                if res == 0 and self.operation != Operation.INIT:
+                    with self._phase(self.operation.name.lower()):
+                        if self.operation == Operation.PLAN:
+                            res = self._plan()
+                        elif self.operation == Operation.APPLY:
+                            res = self._apply()
+                        else:
+                            res = self._tf_run(self.operation)
+                            meta_path(self.run_dir, PLAN_RECORD).unlink(missing_ok=True)
+
+                if res == 0 and self.operation == Operation.APPLY:
+                    # Backup the lock file if not exists locally
+                    lock_file = self.stack_dir / LOCK_FILE_NAME
+                    if not lock_file.exists() and (self.run_dir / LOCK_FILE_NAME).exists():
+                        shutil.copy(self.run_dir / LOCK_FILE_NAME, lock_file)
+
+                    # Backup the local state if existing state files are allowed
+                    state_file = self.run_dir / 'terraform.tfstate'
+                    if self.allow_state and state_file.exists():
+                        self._backup_state(state_file)
+        finally:
+            self.profiler.stop()
+
+        return {
+            'stack': str(self.stack_dir),
+            'operation': self.operation.name.lower(),
+            'exit_code': res,
+            'phases': self.timings,
+            'seconds': time.perf_counter() - start,
+            'config_file': str(self.config_parser.config_file_path),
+            'run_dir': str(self.run_dir),
+            'plan_summary': str(self.run_dir / PLAN_SUMMARY) if (self.run_dir / PLAN_SUMMARY).exists() else None,
+            'terraform': self.tf_results,
+        }
+
+    def lock(self) -> FileLock:
+        """Lock of the run directory, runs of the same stack and prefix wait for each other"""
+
+        return FileLock(meta_path(self.run_dir, RUN_LOCK))
+
+    def _backup_state(self, state_file: Path):
+        """Add the state to the history of the config and update the local state file, unless it is the same already"""
+
+        store = StateStore(meta_path(self.run_dir, STATE_STORE))
+        local_state = local_state_file(self.stack_dir, self.prefix)
+        if local_state.exists() and local_state != state_file:
+            # Kept in the history even if it was never applied by the hydrator
+            store.save(local_state.read_bytes())
+        data = state_file.read_bytes()
+        snapshot = store.save(data)
+        if local_state.exists() and local_state.stat().st_size == len(data) and local_state.read_bytes() == data:
+            runner_log.debug('Local state unchanged')
+            return
+        write_atomic(local_state, data)
+        runner_log.info('Local state serial %s saved', snapshot['serial'])
+
+    @contextmanager
+    def _phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            with self.profiler.phase(name):
+                yield
+        finally:
+            self.timings[name] = time.perf_counter() - start
+
+    def _init(self, force=False):
+        """Run `terraform init` unless the backend, the providers, the modules and the lock file are the same as when it
+        last succeeded. If the backend changed it is reconfigured"""
+
+        fingerprint = self._init_fingerprint()
+        fingerprint_file = meta_path(self.run_dir, INIT_FINGERPRINT)
+        stored = None
+        if fingerprint_file.exists():
+            stored = json.loads(fingerprint_file.read_text())
+
+        self.init_status = 0
+        initialized = (self.run_dir / '.terraform').exists()
+        if not force and initialized and stored == fingerprint:
+            runner_log.debug('Nothing changed since the last init, skipping it')
+            return self
+
+        args = []
+        if initialized and stored is not None and stored['backend'] != fingerprint['backend']:
+            runner_log.info('Backend changed, reconfiguring it')
+            args = ['-reconfigure']
+        lock_file = self.run_dir / LOCK_FILE_NAME
+        if self.provider_cache is not None and self.provider_cache.mirror_dir is not None and lock_file.exists():
+            self.provider_cache.populate([lock_file])
+        self.init_status = self._tf_run(Operation.INIT, *args)
+        if self.init_status == 0:
+            # Init may create or update the lock file
+            write_atomic(fingerprint_file, json.dumps(self._init_fingerprint()))
+        else:
+            fingerprint_file.unlink(missing_ok=True)
         return self
 
-    def _tf_run(self, op: Operation):
-        return os.system(TF_RUN_FORMAT.format(op.name.lower()))
+    def _init_fingerprint(self) -> dict:
+        """Hashes of everything in the staged files `terraform init` depends on, local modules are followed"""
+
+        backend = hashlib.sha256()
+        providers = hashlib.sha256()
+        lock_file = self.run_dir / LOCK_FILE_NAME
+        if lock_file.exists():
+            providers.update(lock_file.read_bytes())
+
+        for d in local_module_dirs(self.run_dir):
+            key = str(d.resolve())
+            for f in sorted(d.glob('*.tf')):
+                txt = f.read_text()
+                modules, backends, required_providers = scan_tf(txt)
+                for _, start, end, _ in backends:
+                    backend.update(txt[start:end].encode())
+                for start, end in required_providers:
+                    providers.update(txt[start:end].encode())
+                for name, source, _, _, version in modules:
+                    providers.update(f'{key} {name} source={source} version={version}\n'.encode())
+
+        # Where the providers are installed from
+        installation = None
+        if self.provider_cache is not None:
+            installation = self.provider_cache.settings()
+        return {'backend': backend.hexdigest(), 'providers': providers.hexdigest(), 'installation': installation}
+
+    def _plan(self) -> int:
+        """Run `plan` saving the plan file, unless the last plan of the same staged files and the same state had no changes"""
+
+        key = self._plan_key()
+        state = state_id(self.run_dir, self.runner)
+        record = self._plan_record()
+        if record is not None and record['key'] == key and record['state'] == state and state is not None and not record['changes']:
+            runner_log.info('Unchanged, the last plan of the same configuration and state had no changes')
+            return 0
+
+        meta_path(self.run_dir, PLAN_RECORD).unlink(missing_ok=True)
+        (self.run_dir / PLAN_SUMMARY).unlink(missing_ok=True)
+        res = self._tf_run(Operation.PLAN, f'-out={PLAN_FILE}', '-detailed-exitcode')
+        if res not in [0, 2]:
+            return res
+
+        # 0 - no changes, 2 - changes
+        write_atomic(meta_path(self.run_dir, PLAN_RECORD), json.dumps({'key': key, 'state': state, 'changes': res == 2}))
+        self._summarize_plan(res == 2)
+        return 0
+
+    def _summarize_plan(self, changes: bool):
+        """Write the summary of the changes in the saved plan, streamed from `terraform show -json` so the memory used does
+        not depend on the size of the plan"""
+
+        def summarize(stream):
+            try:
+                return plan_summary(stream)
+            except ValueError as e:
+                runner_log.warning('Failed to read the plan: %s', e)
+                return None
+
+        summary = plan_summary(None)
+        if changes:
+            res, summary = self.runner.read(['show', '-json', PLAN_FILE], self.run_dir, summarize)
+            if res['exit_code'] != 0:
+                runner_log.warning("`terraform show` failed with exit code %d, no plan summary: %s", res['exit_code'], res['stderr'].strip())
+                return
+            if summary is None:
+                return
+
+        write_atomic(self.run_dir / PLAN_SUMMARY, json.dumps(summary, indent=2))
+        totals = summary['totals']
+        runner_log.info('Plan summary: %s, written to %s', ', '.join([f'{totals[a]} to {a}' for a in PLAN_SUMMARY_ACTIONS]), self.run_dir / PLAN_SUMMARY)
+
+    def _apply(self) -> int:
+        """Apply the saved plan if it was made from the same staged files, otherwise plan and apply"""
+
+        record = self._plan_record()
+        if record is not None and (self.run_dir / PLAN_FILE).exists() and record['key'] == self._plan_key():
+            runner_log.info('Applying the saved plan')
+            res = self._tf_run(Operation.APPLY, PLAN_FILE)
+        else:
+            res = self._tf_run(Operation.APPLY)
+
+        # The state changed, the saved plan is stale
+        meta_path(self.run_dir, PLAN_RECORD).unlink(missing_ok=True)
+        (self.run_dir / PLAN_FILE).unlink(missing_ok=True)
+        (self.run_dir / PLAN_SUMMARY).unlink(missing_ok=True)
+        return res
+
+    def _plan_record(self) -> dict:
+        try:
+            return json.loads(meta_path(self.run_dir, PLAN_RECORD).read_text())
+        except (OSError, ValueError):
+            return None
+
+    def _plan_key(self) -> str:
+        """Hash of everything the plan depends on other than the state: the staged files (including the variables), the
+        files of the local modules and the `TF_VAR_` environment variables"""
+
+        key = hashlib.sha256()
+        for d in local_module_dirs(self.run_dir):
+            for f in sorted(d.glob('*')):
+                if f.is_file() and not (d == self.run_dir and f.name in PLAN_KEY_IGNORED):
+                    key.update(f'{f.resolve()}\n'.encode())
+                    key.update(hashlib.sha256(f.read_bytes()).digest())
+        for k in sorted(os.environ):
+            if k.startswith(PLAN_KEY_ENV_PREFIXES):
+                key.update(f'{k}={os.environ[k]}\n'.encode())
+        return key.hexdigest()
+
+    def _tf_run(self, op: Operation, *args) -> int:
+        """Run Terraform in the run directory, return its exit code"""
+
+        cmd = [op.name.lower()] + list(args)
+        if op == Operation.INIT and self.provider_cache is not None:
+            # Only `init` installs the providers, it must not run concurrently with others using the same cache
+            with self.provider_cache.lock():
+                res = self.runner.run(cmd, self.run_dir, dict(os.environ, **self.provider_cache.env()))
+        else:
+            res = self.runner.run(cmd, self.run_dir)
+        self.tf_results.append(res)
+        return res['exit_code']
 
     def _set_vars(self):
         inputs = self.config_parser.get_block(Block.INPUTS)
         if inputs is not None and len(inputs) > 0:
-           dest = RUN_DIR / 'hydrator.auto.tfvars.json' 
+           dest = self.run_dir / 'hydrator.auto.tfvars.json'
            dest.write_text(json.dumps(inputs))
         return self
 
     def _copy(self):
-        if not RUN_DIR.exists():
-            log(f"New run, creating '{RUN_DIR}' directory", logging.INFO)
-            RUN_DIR.mkdir()
+        if not self.run_dir.exists():
+            staging_log.info("New run, creating '%s' directory", self.run_dir)
+            self.run_dir.mkdir()
 
         self.files = []
+        names = {}
 
         # `terraform` block must have a `source` attribute. Copy files from there
-        tf_source = Path(self.config_parser.get_block(Block.TERRAFORM)['source'])
+        tf_source = self.stack_dir / self.config_parser.get_block(Block.TERRAFORM)['source']
         for f in tf_source.glob('*'):
             if f.is_file():
                 if f.suffix.lower() in ['.tfstate']:
@@ -127,74 +1578,1069 @@ class Hydrator:
             raise RuntimeError(f'Teffaform files not found in {tf_source.absolute()}')
 
         # Files local to config
-        for f in Path('./').glob('*'):
+        for f in self.stack_dir.glob('*'):
             if f.is_file():
                 if f.suffix.lower() in ['.tfstate'] and not self.allow_state:
                     raise FileExistsError(f"State files are not allowed in the current configuration, run with `--allow-state` to enable")
                 elif any([f.name == fe.name for fe in self.files]):
                     raise FileExistsError(f"File '{f.name}' exists in both local directory and target Terraform template directory")
-                elif f.suffix.lower() in ['.tf', '.tfvars', '.json'] or f.name.lower() in ['.terraform.lock.hcl', 'terraform.tfstate']:
+                elif f.name.lower() == local_state_file(self.stack_dir, self.prefix).name.lower():
+                    # Local state of this config, staged as `terraform.tfstate` whatever its prefix
                     self.files.append(f)
-        [shutil.copy(f, RUN_DIR) for f in self.files]
-        
-        # Resolve module relative paths
-        log(f'Resolving module paths')
-        for f in self.files:
-            path_in_run = RUN_DIR / f.name
-            txt = path_in_run.read_text()
-            res = re.findall('module\s+"[^"]+"\s*\{([^}]+|\{[^}]*\})[^}]*(source\s*=\s*"([^"]+)")', txt, re.IGNORECASE | re.MULTILINE)
-            if res:
-                log(f'In file: {f}')
-                for p in res:
-                    source_path = (f.parent / p[2]).resolve().absolute()
+                    names[f] = 'terraform.tfstate'
+                elif f.suffix.lower() in ['.tfstate']:
+                    # Local state of a config with another prefix
+                    continue
+                elif f.suffix.lower() in ['.tf', '.tfvars', '.json'] or f.name.lower() == LOCK_FILE_NAME:
+                    self.files.append(f)
+
+        # Only the files which changed since the last run are staged again
+        remote_state = self.config_parser.get_block(Block.REMOTE_STATE)
+        inputs = json.dumps([str(self.run_dir), remote_state], default=str)
+        Stager(self.run_dir, meta_path(self.run_dir, STAGING_MANIFEST), self.profiler).stage(self.files, self._render, inputs, names)
+
+        return self
+
+    def _render(self, f: Path, txt: str) -> str:
+        """Return the contents of the `.tf` file as it must be in the run directory"""
+
+        modules, backends, _ = scan_tf(txt)
+        # Every change as (start, end, new text), applied at once
+        edits = []
+
+        # Resolve module relative paths, other sources (registry, git, ...) do not depend on the directory
+        rel_paths = {}
+        for name, source, start, end, _ in modules:
+            if source.startswith('./') or source.startswith('../'):
+                if source not in rel_paths:
+                    source_path = (f.parent / source).resolve().absolute()
 
                     # This should always use posix style separatator, even in Windows
-                    rel_path = os.path.relpath(source_path, RUN_DIR).replace(os.sep, '/')
-                    txt = txt.replace(p[1], f'source = "{rel_path}"')
-                    path_in_run.write_text(txt)
+                    rel_paths[source] = json.dumps(os.path.relpath(source_path, self.run_dir).replace(os.sep, '/'))
+                edits.append((start, end, rel_paths[source]))
+        if edits:
+            staging_log.debug('Resolving module paths in file: %s', f)
 
         # Set the remote state if needed
         remote_state = self.config_parser.get_block(Block.REMOTE_STATE)
-        if remote_state:
-            log('Setting remote state')
+        if remote_state and backends:
             backend = remote_state['backend']
-            for f in self.files:
-                path_in_run = RUN_DIR / f.name
-                txt = path_in_run.read_text()
-                res = re.search('(backend\s+"([^"]+)"\s+\{(([^}{]*|\{[^}]*\})[^}]*)\})', txt, re.IGNORECASE | re.MULTILINE)
-                if res:
-                    log(f'In file: {f}')
-                    if res[2] != backend:
-                        RuntimeError(f'Invalid backend, expected {res[1]}, got {backend}')
-                    if len(res[3].strip()) > 0:
-                        RuntimeError(f'Backend configuration must be empty, found {res[2]}')
-                    
-                    # TODO: improve to handle non-string data types if provided, not needed for S3 now
-                    hcl = f'\n    '.join([f'{k} = "{v}"' for k, v in remote_state['config'].items()])
-                    txt = txt.replace(res[1], f'backend "{backend}" {{\n    {hcl}\n  }}')
-                    path_in_run.write_text(txt)
-
-        return self
+            staging_log.debug('Setting remote state in file: %s', f)
+            for name, start, end, empty in backends:
+                if name != backend:
+                    raise RuntimeError(f"Invalid backend in '{f}', expected '{backend}' of the `remote_state`, got '{name}'")
+                if not empty:
+                    raise RuntimeError(f"Backend configuration in '{f}' must be empty, found {txt[start:end]}")
+
+                # TODO: improve to handle non-string data types if provided, not needed for S3 now
+                hcl = f'\n    '.join([f'{k} = "{v}"' for k, v in remote_state['config'].items()])
+                edits.append((start, end, f'backend "{backend}" {{\n    {hcl}\n  }}'))
+
+        if not edits:
+            return txt
+        parts = []
+        pos = 0
+        for start, end, new in sorted(edits):
+            parts += [txt[pos:start], new]
+            pos = end
+        parts.append(txt[pos:])
+        return ''.join(parts)
     
     def parse_config(self): 
-        config_file = Path(self.prefix + CONFIG_FILE_NAME)  
-        self.config_parser = TerragruntConfigParser(config_file)
+        config_file = self.stack_dir / (self.prefix + CONFIG_FILE_NAME)
+        if self.config_cache is not None:
+            self.config_parser = self.config_cache.load(config_file)
+            if self.config_parser is not None:
+                return self
+
+        self.config_parser = TerragruntConfigParser(config_file, profiler=self.profiler, terragrunt_dir=self.stack_dir, runner=self.runner)
+        if self.config_cache is not None:
+            self.config_cache.store(self.config_parser)
         return self
 
+class StateStore:
+    """Local history of the states of a stack
+
+    Every snapshot is stored once, compressed, under the hash of its contents and indexed by the lineage and the serial of
+    the state. Only the latest snapshots are kept, the contents not used by any of them are removed"""
+
+    def __init__(self, store_dir: Path, keep=STATE_SNAPSHOTS_KEEP):
+        self.store_dir = store_dir
+        self.keep = keep
+        self.index_file = store_dir / 'index.json'
+
+    def snapshots(self) -> list:
+        """Snapshots from the oldest to the latest"""
+
+        try:
+            return json.loads(self.index_file.read_text())
+        except FileNotFoundError:
+            return []
+
+    def save(self, data: bytes) -> dict:
+        """Add the state to the history unless the latest snapshot is the same, return the snapshot"""
+
+        state = json.loads(data)
+        digest = hashlib.sha256(data).hexdigest()
+        with FileLock(self.store_dir / '.lock'):
+            snapshots = self.snapshots()
+            if snapshots and snapshots[-1]['digest'] == digest:
+                return snapshots[-1]
+
+            object_file = self._object(digest)
+            if not object_file.exists():
+                write_atomic(object_file, gzip.compress(data, compresslevel=6))
+            snapshot = {
+                'lineage': state.get('lineage', ''),
+                'serial': state.get('serial', 0),
+                'digest': digest,
+                'time': dt.now().isoformat(timespec='seconds'),
+                'bytes': len(data),
+                'stored_bytes': object_file.stat().st_size,
+            }
+            snapshots.append(snapshot)
+            self._prune(snapshots)
+        return snapshot
+
+    def _prune(self, snapshots: list):
+        removed = snapshots[:-self.keep] if len(snapshots) > self.keep else []
+        kept = snapshots[len(removed):]
+        write_atomic(self.index_file, json.dumps(kept, indent=1))
+        used = {s['digest'] for s in kept}
+        for digest in {s['digest'] for s in removed} - used:
+            self._object(digest).unlink(missing_ok=True)
+
+    def _object(self, digest: str) -> Path:
+        return self.store_dir / 'objects' / f'{digest}.json.gz'
+
+    def find(self, serial: int, lineage: str=None) -> dict:
+        """Latest snapshot of the serial, of the lineage of the latest snapshot unless another is given"""
+
+        snapshots = self.snapshots()
+        if lineage is None and snapshots:
+            lineage = snapshots[-1]['lineage']
+        for snapshot in reversed(snapshots):
+            if snapshot['serial'] == serial and snapshot['lineage'] == lineage:
+                return snapshot
+        raise LookupError(f"No snapshot of the state serial {serial} of lineage '{lineage}' in '{self.store_dir}'")
+
+    def read(self, serial: int, lineage: str=None) -> bytes:
+        return gzip.decompress(self._object(self.find(serial, lineage)['digest']).read_bytes())
+
+    def restore(self, serial: int, state_file: Path, lineage: str=None):
+        write_atomic(state_file, self.read(serial, lineage))
+
+    def diff(self, serial: int, other_serial: int, lineage: str=None) -> dict:
+        """Addresses of the resource instances added, removed and changed from the serial to the other serial"""
+
+        old, new = [self._instances(json.loads(self.read(s, lineage))) for s in [serial, other_serial]]
+        return {
+            'added': sorted(new.keys() - old.keys()),
+            'removed': sorted(old.keys() - new.keys()),
+            'changed': sorted([k for k in old.keys() & new.keys() if old[k] != new[k]]),
+        }
+
+    def _instances(self, state: dict) -> dict:
+        res = {}
+        for resource in state.get('resources', []):
+            address = f"{resource['type']}.{resource['name']}"
+            if resource.get('mode', 'managed') == 'data':
+                address = f'data.{address}'
+            if resource.get('module', None):
+                address = f"{resource['module']}.{address}"
+            for instance in resource.get('instances', []):
+                key = instance.get('index_key', None)
+                res[address if key is None else f'{address}[{json.dumps(key)}]'] = json.dumps(instance, sort_keys=True)
+        return res
+
+class RunAll:
+    """Run the operation for every stack (a directory with a config file) below the root directory
+
+    Stacks depend on the stacks listed in their `dependencies` block and on the stacks whose remote state they read, i.e.
+    the ones which state key is passed to them as a `*_remote_state_params` input. Independent stacks run in parallel,
+    each one in a separate process with its output buffered and printed at once when the stack is done"""
+
+    def __init__(self, operation: str, root: Path, workers=RUN_ALL_WORKERS, allow_state=False, prefix='', cache_dir=CONFIG_CACHE_DIR, auto_approve=False, provider_cache=None, runner: TerraformRunner=None):
+        self.operation = Operation(operation)
+        self.root = root.resolve()
+        self.workers = workers
+        self.allow_state = allow_state
+        self.prefix = prefix
+        self.cache_dir = cache_dir
+        self.auto_approve = auto_approve
+        self.provider_cache = provider_cache
+        # Only the timeout and the extra arguments are used, by the run of every stack
+        self.runner = runner if runner is not None else TerraformRunner()
+        self.print_lock = threading.Lock()
+
+    def run(self) -> int:
+        graph = self.discover()
+        sort_dependencies(graph, 'stacks')
+        if self.operation == Operation.DESTROY:
+            # Dependent stacks must be destroyed first
+            graph = {s: {d for d, deps in graph.items() if s in deps} for s in graph}
+
+        op = self.operation.name.lower()
+        if self.operation in [Operation.APPLY, Operation.DESTROY] and not self.auto_approve:
+            print('\n'.join([self._name(s) for s in graph]))
+            if input(f'Run `{op}` for all {len(graph)} stacks above? Only `yes` will be accepted: ') != 'yes':
+                return 1
+
+        if self.provider_cache is not None and self.provider_cache.mirror_dir is not None:
+            # Mirror the providers once for all the stacks
+            self.provider_cache.populate(list(self.root.rglob(LOCK_FILE_NAME)))
+
+        # Exit codes, None for the stacks skipped because their dependencies failed
+        results = {}
+        pending = dict(graph)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            try:
+                while pending or running:
+                    for stack in list(pending):
+                        deps = pending[stack]
+                        if any([d in results and results[d] != 0 for d in deps]):
+                            runner_log.info('[%s] skipped, dependency failed', self._name(stack))
+                            results[stack] = None
+                            del pending[stack]
+                        elif all([results.get(d, None) == 0 for d in deps if d in graph]):
+                            running[pool.submit(self._run_stack, stack)] = stack
+                            del pending[stack]
+                    if running:
+                        done, _ = wait(running, return_when=FIRST_COMPLETED)
+                        for f in done:
+                            results[running.pop(f)] = f.result()
+            except BaseException:
+                # E.g. Ctrl-C, the running stacks got the signal and the pool waits for them to stop, none may start
+                for f in running:
+                    f.cancel()
+                raise
+
+        failed = [s for s in graph if results[s] != 0]
+        runner_log.info('`%s` succeeded for %d of %d stacks', op, len(graph) - len(failed), len(graph))
+        for s in failed:
+            runner_log.info('[%s] %s', self._name(s), 'skipped' if results[s] is None else 'failed')
+        return 1 if failed else 0
+
+    def discover(self) -> dict:
+        """Return the stack directories mapped to the directories of the stacks they depend on"""
+
+        stacks = find_stacks(self.root, self.prefix)
+
+        configs = {}
+        for stack in stacks:
+            configs[stack] = Hydrator(self.operation.name.lower(), self.allow_state, self.prefix, self.cache_dir, stack_dir=stack).parse_config().config_parser
+
+        state_keys = {}
+        for stack, config in configs.items():
+            remote_state = config.get_block(Block.REMOTE_STATE)
+            if remote_state and 'key' in remote_state.get('config', {}):
+                state_keys[remote_state['config']['key']] = stack
+
+        graph = {}
+        for stack, config in configs.items():
+            deps = set()
+            paths = (config.get_block(Block.DEPENDENCIES) or {}).get('paths', [])
+            paths += [d['config_path'] for d in (config.get_block(Block.DEPENDENCY) or {}).values()]
+            for path in paths:
+                dep = (stack / path).resolve()
+                if dep not in configs:
+                    raise LookupError(f"Dependency '{path}' of '{self._name(stack)}' is not a stack under '{self.root}'")
+                deps.add(dep)
+            for params in self._remote_state_params(config.get_block(Block.INPUTS)):
+                dep = state_keys.get(params['key'], None)
+                if dep is not None and dep != stack:
+                    deps.add(dep)
+            graph[stack] = deps
+            runner_log.debug('[%s] depends on %s', self._name(stack), [self._name(d) for d in deps])
+        return graph
+
+    def _remote_state_params(self, value):
+        """Find all the `*_remote_state_params` objects with a state `key`"""
+
+        if isinstance(value, dict):
+            for k, v in value.items():
+                if k.endswith(REMOTE_STATE_PARAMS_SUFFIX) and isinstance(v, dict) and 'key' in v:
+                    yield v
+                else:
+                    yield from self._remote_state_params(v)
+        elif isinstance(value, list):
+            for v in value:
+                yield from self._remote_state_params(v)
+
+    def _name(self, stack: Path) -> str:
+        return stack.relative_to(self.root).as_posix()
+
+    def _run_stack(self, stack: Path) -> int:
+        # The daemon runs one command at a time, the parallel runs must never be forwarded to it
+        cmd = [sys.executable, str(Path(__file__).resolve()), self.operation.name.lower(), '--no-daemon']
+        if self.allow_state:
+            cmd.append('--allow-state')
+        if self.prefix:
+            cmd += ['--prefix', self.prefix]
+        cmd += ['--no-cache'] if self.cache_dir is None else ['--cache-dir', str(self.cache_dir)]
+        cmd += ['--log-level', logging.getLevelName(logging.getLogger('hydrator').getEffectiveLevel())]
+        json_files = [h.baseFilename for h in logging.getLogger('hydrator').handlers if isinstance(h, logging.FileHandler)]
+        if json_files:
+            cmd += ['--log-json', json_files[0]]
+        if self.provider_cache is None:
+            cmd.append('--no-plugin-cache')
+        else:
+            if self.provider_cache.plugin_cache_dir is not None:
+                cmd += ['--plugin-cache-dir', str(self.provider_cache.plugin_cache_dir)]
+            if self.provider_cache.mirror_dir is not None:
+                cmd += ['--provider-mirror', str(self.provider_cache.mirror_dir)]
+        if self.runner.timeout is not None:
+            cmd += ['--timeout', str(self.runner.timeout)]
+        tf_args = self.runner.extra_args.get(self.operation.name.lower(), [])
+        if tf_args:
+            cmd.append(f'--tf-args={shlex.join(tf_args)}')
+
+        # Nobody can answer the prompts of the parallel runs
+        env = dict(os.environ, PYTHONUNBUFFERED='1', TF_INPUT='0')
+        if self.operation in [Operation.APPLY, Operation.DESTROY]:
+            env[f'TF_CLI_ARGS_{self.operation.name.lower()}'] = '-auto-approve'
+
+        name = self._name(stack)
+        start = time.time()
+        # In a session of its own so only one signal reaches it (and its Terraform), the one passed on by this process
+        proc = subprocess.Popen(cmd, cwd=stack, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, start_new_session=True)
+        with TerraformRunner.tracked(proc):
+            try:
+                output, _ = proc.communicate()
+            except BaseException:
+                proc.kill()
+                proc.wait()
+                raise
+        with self.print_lock:
+            for line in output.splitlines():
+                print(f'[{name}] {line}')
+            runner_log.info('[%s] finished with exit code %d in %.1fs', name, proc.returncode, time.time() - start)
+        return proc.returncode
+
+class Render:
+    """Hydrate every stack below the root without running Terraform, e.g. to review or scan the results or just to check
+    that all the configs still parse
+
+    Nothing is run between the stacks so they are all rendered in parallel, in a pool of processes. Each stack is rendered
+    into its own run directory, optionally copied to `<out_dir>/<stack>`. A JSON summary is printed at the end"""
+
+    def __init__(self, root: Path, workers=RUN_ALL_WORKERS, allow_state=False, prefix='', cache_dir=CONFIG_CACHE_DIR, out_dir=None, summary_file=None):
+        self.root = root.resolve()
+        self.workers = workers
+        self.allow_state = allow_state
+        self.prefix = prefix
+        self.cache_dir = cache_dir
+        self.out_dir = out_dir.resolve() if out_dir is not None else None
+        self.summary_file = summary_file
+
+    def run(self) -> int:
+        start = time.perf_counter()
+        stacks = find_stacks(self.root, self.prefix)
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            futures = {}
+            for stack in stacks:
+                name = stack.relative_to(self.root).as_posix()
+                out_dir = self.out_dir / name if self.out_dir is not None else None
+                futures[name] = pool.submit(render_stack, stack, self.allow_state, self.prefix, self.cache_dir, out_dir)
+            results = {name: f.result() for name, f in futures.items()}
+
+        failed = {}
+        for name, res in results.items():
+            if res['status'] == 'ok':
+                runner_log.info('[%s] rendered in %.2fs', name, res['seconds'])
+            else:
+                runner_log.error('[%s] %s failed: %s', name, res['phase'], res['error'])
+                failed[res['phase']] = failed.get(res['phase'], 0) + 1
+
+        summary = {
+            'root': str(self.root),
+            'stacks': len(results),
+            'succeeded': len(results) - sum(failed.values()),
+            'failed': failed,
+            'seconds': time.perf_counter() - start,
+            'results': results,
+        }
+        write_summary(summary, self.summary_file)
+        return 1 if failed else 0
+
+def write_summary(summary: dict, summary_file: Path=None):
+    """Print the JSON summary and write it to the file if given"""
+
+    summary_json = json.dumps(summary, indent=2)
+    if summary_file is not None:
+        summary_file.parent.mkdir(parents=True, exist_ok=True)
+        summary_file.write_text(summary_json)
+    print(summary_json)
+
+def render_stack(stack: Path, allow_state=False, prefix='', cache_dir=CONFIG_CACHE_DIR, out_dir=None) -> dict:
+    """Parse, stage and set the variables of a single stack, in a worker process of `Render`. Errors are returned"""
+
+    res = {'status': 'ok', 'phases': {}}
+    start = time.perf_counter()
+    phase = None
+    try:
+        hydrator = Hydrator(Operation.PLAN.name, allow_state, prefix, cache_dir, stack_dir=stack)
+        with hydrator.lock():
+            for phase, step in [('parse', hydrator.parse_config), ('staging', hydrator._copy), ('vars', hydrator._set_vars)]:
+                phase_start = time.perf_counter()
+                step()
+                res['phases'][phase] = time.perf_counter() - phase_start
+        res['output'] = str(hydrator.run_dir)
+
+        if out_dir is not None:
+            phase = 'output'
+            if out_dir.exists():
+                shutil.rmtree(out_dir)
+            out_dir.mkdir(parents=True)
+            for f in hydrator.run_dir.iterdir():
+                if f.is_file() and f.name not in RENDER_IGNORED:
+                    shutil.copyfile(f, out_dir / f.name)
+            res['output'] = str(out_dir)
+    except Exception as e:
+        res.update({'status': 'error', 'phase': phase, 'error': f'{type(e).__name__}: {e}'})
+    res['seconds'] = time.perf_counter() - start
+    return res
+
+class Drift:
+    """Check every stack below the root for drift, i.e. differences between the configuration, the state and the real
+    resources found by `terraform plan -detailed-exitcode` (which refreshes the state first)
+
+    Stacks are independent, each one is hydrated and planned in a pool of processes, with the output of Terraform written
+    to its run directory. A stack is clean if the plan has no changes, drifted if it has any and errored if anything fails.
+    A stack is not planned again if its staged files and its state (serial) are unchanged since its last clean scan. A
+    JSON summary is printed at the end"""
+
+    def __init__(self, root: Path, workers=RUN_ALL_WORKERS, allow_state=False, prefix='', cache_dir=CONFIG_CACHE_DIR, provider_cache=None, summary_file=None, rescan=False, runner: TerraformRunner=None):
+        self.root = root.resolve()
+        self.workers = workers
+        self.allow_state = allow_state
+        self.prefix = prefix
+        self.cache_dir = cache_dir
+        self.provider_cache = provider_cache
+        self.summary_file = summary_file
+        self.rescan = rescan
+        self.runner = runner
+
+    def run(self) -> int:
+        """Return 0 if all the stacks are clean, 2 if any drifted and 1 if any errored"""
+
+        start = time.perf_counter()
+        stacks = find_stacks(self.root, self.prefix)
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            futures = {}
+            for stack in stacks:
+                name = stack.relative_to(self.root).as_posix()
+                futures[name] = pool.submit(drift_stack, stack, self.allow_state, self.prefix, self.cache_dir, self.provider_cache, self.rescan, self.runner)
+            results = {name: f.result() for name, f in futures.items()}
+
+        counts = {'clean': 0, 'drifted': 0, 'errored': 0}
+        for name, res in results.items():
+            counts[res['status']] += 1
+            if res['status'] == 'errored':
+                runner_log.error('[%s] %s failed: %s', name, res['phase'], res['error'])
+            else:
+                runner_log.info('[%s] %s%s in %.1fs', name, res['status'], ' (unchanged)' if res['skipped'] else '', res['seconds'])
+
+        summary = {
+            'root': str(self.root),
+            'stacks': len(results),
+            **counts,
+            'skipped': len([r for r in results.values() if r.get('skipped', False)]),
+            'seconds': time.perf_counter() - start,
+            'results': results,
+        }
+        write_summary(summary, self.summary_file)
+        if counts['errored'] > 0:
+            return 1
+        return 2 if counts['drifted'] > 0 else 0
+
+def drift_stack(stack: Path, allow_state=False, prefix='', cache_dir=CONFIG_CACHE_DIR, provider_cache=None, rescan=False, runner: TerraformRunner=None) -> dict:
+    """Hydrate and plan a single stack, in a worker process of `Drift`. Errors are returned"""
+
+    run_dir = stack_run_dir(stack, prefix)
+    log_file, record_file = meta_path(run_dir, DRIFT_LOG), meta_path(run_dir, DRIFT_RECORD)
+    res = {'status': 'errored', 'skipped': False, 'phases': {}, 'log': str(log_file)}
+    start = time.perf_counter()
+    phase = None
+    try:
+        log_file.parent.mkdir(parents=True, exist_ok=True)
+        # Nobody can answer the prompts, the output of each stack goes to its own log
+        with open(log_file, 'w') as log, open(os.devnull) as devnull, redirected_streams([devnull.fileno(), log.fileno(), log.fileno()]), environ({'TF_INPUT': '0'}):
+            hydrator = Hydrator(Operation.PLAN.name, allow_state, prefix, cache_dir, provider_cache, stack_dir=stack, runner=runner)
+            with hydrator.lock():
+                for phase, step in [('parse', hydrator.parse_config), ('staging', hydrator._copy), ('vars', hydrator._set_vars), ('init', hydrator._init)]:
+                    phase_start = time.perf_counter()
+                    step()
+                    res['phases'][phase] = time.perf_counter() - phase_start
+                if hydrator.init_status != 0:
+                    raise RuntimeError(f'`terraform init` failed with exit code {hydrator.init_status}')
+
+                phase = 'plan'
+                phase_start = time.perf_counter()
+                record = {'key': hydrator._plan_key(), 'state': state_id(hydrator.run_dir, hydrator.runner)}
+                try:
+                    last = json.loads(record_file.read_text())
+                except (OSError, ValueError):
+                    last = None
+                record_file.unlink(missing_ok=True)
+                if not rescan and record['state'] is not None and last == record:
+                    runner_log.info('Unchanged since the last clean scan, not planning')
+                    res['skipped'] = True
+                    status = 0
+                else:
+                    # Read only, must not block anyone changing the stack meanwhile
+                    status = hydrator._tf_run(Operation.PLAN, '-detailed-exitcode', '-lock=false', '-input=false')
+                res['phases'][phase] = time.perf_counter() - phase_start
+
+                if status == 0:
+                    # Recorded before anyone else can change the stack, it is clean only once recorded
+                    write_atomic(record_file, json.dumps(record))
+                    res['status'] = 'clean'
+
+        if status == 2:
+            res['status'] = 'drifted'
+        elif status != 0:
+            lines = log_file.read_text(errors='replace').strip().splitlines()
+            res['error'] = '\n'.join(lines[-DRIFT_ERROR_LINES:])
+    except Exception as e:
+        res['error'] = f'{type(e).__name__}: {e}'
+    if res['status'] == 'errored':
+        res['phase'] = phase
+    res['seconds'] = time.perf_counter() - start
+    return res
+
+DAEMON = 'daemon'
+DAEMON_SOCKET_ENV = 'HYDRATOR_SOCKET'
+# Commands are forwarded to the daemon only when asked for with `--use-daemon` or this variable set to 1
+DAEMON_ENABLED_ENV = 'HYDRATOR_USE_DAEMON'
+# Set for the commands run by the daemon (and everything they start) so they never forward to the daemon again
+DAEMON_DISABLED_ENV = 'HYDRATOR_NO_DAEMON'
+# Environment variables passed on to the daemon, the commands run by it see only these
+DAEMON_ENV_PREFIXES = ('TF_', 'AWS_', 'HYDRATOR_', 'LC_')
+DAEMON_ENV_NAMES = {
+    'PATH', 'HOME', 'USER', 'LANG', 'TZ', 'TERM', 'TMPDIR', 'SSL_CERT_FILE', 'SSL_CERT_DIR', 'REQUESTS_CA_BUNDLE',
+    'HTTP_PROXY', 'HTTPS_PROXY', 'NO_PROXY', 'http_proxy', 'https_proxy', 'no_proxy'
+}
+# Comma separated names of any other variables the commands need, e.g. the ones read with `get_env()` in the configs
+DAEMON_ENV_EXTRA_ENV = 'HYDRATOR_DAEMON_ENV'
+
+def default_daemon_socket() -> Path:
+    """Socket of the daemon in a directory only the user can access, in `$XDG_RUNTIME_DIR` if set"""
+
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR', '')
+    if runtime_dir:
+        return Path(runtime_dir) / 'hydrator' / 'daemon.sock'
+    return Path(tempfile.gettempdir()) / f'hydrator-{os.getuid() if hasattr(os, "getuid") else "user"}' / 'daemon.sock'
+
+def is_private_dir(path: Path) -> bool:
+    """Whether the directory is owned by the user and nobody else has any access to it"""
+
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and st.st_mode & 0o077 == 0
+
+def peer_uid(conn: socket.socket) -> int:
+    """User id of the process on the other end of the Unix socket"""
+
+    _, uid, _ = struct.unpack('3i', conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+    return uid
+
+def code_version() -> str:
+    """Identifies the code of the hydrator, the daemon only serves clients running the same code"""
+
+    path = Path(__file__).resolve()
+    st = path.stat()
+    return f'{path}|{st.st_mtime_ns}|{st.st_size}'
+
+def daemon_env() -> dict:
+    """The part of the environment the commands run by the daemon need"""
+
+    extra = {name.strip() for name in os.environ.get(DAEMON_ENV_EXTRA_ENV, '').split(',')}
+    return {k: v for k, v in os.environ.items() if k.startswith(DAEMON_ENV_PREFIXES) or k in DAEMON_ENV_NAMES or k in extra}
+
+def send_message(conn: socket.socket, message: dict, fds=()):
+    """Send the message as a JSON line, with the file descriptors if any"""
+
+    data = json.dumps(message).encode() + b'\n'
+    ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))] if fds else []
+    sent = conn.sendmsg([data], ancillary)
+    if sent < len(data):
+        conn.sendall(data[sent:])
+
+def recv_message(conn: socket.socket) -> tuple:
+    """Return the message and the file descriptors received with it, the message is None if the connection closed"""
+
+    fds = array.array('i')
+    data, ancillary, _, _ = conn.recvmsg(65536, socket.CMSG_SPACE(3 * fds.itemsize))
+    for level, kind, fd_data in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(fd_data[:len(fd_data) - len(fd_data) % fds.itemsize])
+    while data and not data.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return (json.loads(data) if data.endswith(b'\n') else None), list(fds)
+
+def daemon_connect(socket_path: Path):
+    """Connect to the daemon, None if no daemon is running
+
+    Nothing is sent unless the socket and its directory belong to the user, nobody else can access the directory and the
+    process serving the socket runs as the user as well. Peer credentials are needed for that, so the daemon is not used
+    on platforms without them"""
+
+    if not hasattr(socket, 'AF_UNIX') or not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    try:
+        st = os.lstat(socket_path)
+    except OSError:
+        return None
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid() or not is_private_dir(socket_path.parent):
+        raise PermissionError(f'Daemon socket {socket_path} must be owned by the user, in a directory only the user can access')
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(str(socket_path))
+        uid = peer_uid(conn)
+    except OSError:
+        # Left behind by a daemon which did not stop cleanly
+        conn.close()
+        return None
+    if uid != os.getuid():
+        conn.close()
+        raise PermissionError(f'Daemon on {socket_path} runs as user {uid}, not as the user')
+    return conn
+
+def daemon_request(socket_path: Path, request: dict, fds=()) -> dict:
+    """Send the request to the daemon and return its reply, None if no daemon is running"""
+
+    conn = daemon_connect(socket_path)
+    if conn is None:
+        return None
+    with conn:
+        send_message(conn, request, fds)
+        reply, _ = recv_message(conn)
+    if reply is None:
+        # The command may have run already, it must not run again
+        raise RuntimeError(f'Daemon on {socket_path} closed the connection without a reply')
+    return reply
+
+def forward_to_daemon(argv: list, socket_path: Path):
+    """Run the command by the daemon with the standard streams, working directory and the needed environment of this
+    process and return its exit code. None if the command has to run in this process, e.g. no daemon is running
+
+    When this process is interrupted (Ctrl-C or SIGTERM) the daemon stops the command like it would stop here and the
+    exit code is the one of the stopped command. Interrupted again it exits right away, the daemon sees the connection
+    close and stops the command all the same"""
+
+    conn = daemon_connect(socket_path)
+    if conn is None:
+        return None
+    with conn:
+        send_message(conn, {'argv': argv, 'cwd': os.getcwd(), 'env': daemon_env(), 'version': code_version()}, [0, 1, 2])
+        try:
+            reply, _ = recv_message(conn)
+        except (KeyboardInterrupt, SystemExit):
+            send_message(conn, {'command': 'cancel'})
+            reply, _ = recv_message(conn)
+    if reply is None:
+        # The command may have run already, it must not run again
+        raise RuntimeError(f'Daemon on {socket_path} closed the connection without a reply')
+    return reply.get('exit', None)
+
+class Daemon:
+    """Serve the commands of the CLI from a long running process, so everything cached in memory (files read, directory
+    listings, JSON views, parsed includes, compiled expressions, config cache entries and staging manifests) stays warm
+    between the runs
+
+    Clients connect to a Unix socket and pass their arguments, working directory and the environment variables the
+    command needs along with their standard streams as file descriptors, so the command runs exactly as it would in the client, including the output of
+    Terraform and its prompts. Commands run one at a time because the working directory and the environment are process
+    wide. Cached entries are validated against the files before use, so nothing has to be invalidated explicitly. When
+    the code of the hydrator itself changes the daemon stops and the clients run the commands themselves
+
+    The socket is in a directory only the user can access and connections from processes of other users are refused"""
+
+    def __init__(self, socket_path: Path):
+        self.socket_path = socket_path
+        self.version = code_version()
+        self.stopped = False
+
+    def serve(self) -> int:
+        if not hasattr(socket, 'SO_PEERCRED'):
+            runner_log.error('Daemon needs the peer credentials of Unix sockets, not available on this platform')
+            return 1
+        self.socket_path.parent.mkdir(mode=0o700, exist_ok=True)
+        if not is_private_dir(self.socket_path.parent):
+            runner_log.error('Directory of the socket %s must be owned by the user and accessible only by the user', self.socket_path.parent)
+            return 1
+        if daemon_request(self.socket_path, {'command': 'ping'}) is not None:
+            runner_log.error('Daemon is already running on %s', self.socket_path)
+            return 1
+        # Left behind by a daemon which did not stop cleanly
+        self.socket_path.unlink(missing_ok=True)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the same user may connect
+        umask = os.umask(0o177)
+        try:
+            server.bind(str(self.socket_path))
+        finally:
+            os.umask(umask)
+        server.listen()
+        runner_log.info('Daemon %d serving on %s', os.getpid(), self.socket_path)
+        try:
+            while not self.stopped:
+                conn, _ = server.accept()
+                with conn:
+                    try:
+                        if peer_uid(conn) != os.getuid():
+                            runner_log.warning('Refused a connection from user %d', peer_uid(conn))
+                            continue
+                        self._handle(conn)
+                    except OSError as e:
+                        # E.g. the client is gone, the others are still served
+                        runner_log.warning('Request failed: %s', e)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            self.socket_path.unlink(missing_ok=True)
+        runner_log.info('Daemon stopped')
+        return 0
+
+    def _handle(self, conn: socket.socket):
+        request, fds = recv_message(conn)
+        try:
+            if request is None:
+                return
+            command = request.get('command', None)
+            if command == 'ping':
+                reply = {'pid': os.getpid()}
+            elif command == 'stop':
+                self.stopped = True
+                reply = {'exit': 0}
+            elif request.get('version', None) != self.version or code_version() != self.version:
+                if code_version() != self.version:
+                    runner_log.info('Code of the hydrator changed, stopping')
+                    self.stopped = True
+                reply = {'error': 'version'}
+            elif len(fds) != 3:
+                reply = {'error': 'streams'}
+            else:
+                start = time.perf_counter()
+                runner_log.info('Running `%s` in %s', ' '.join(request['argv']), request['cwd'])
+                cancelled = threading.Event()
+                try:
+                    with self._cancel_with_client(conn, cancelled):
+                        res = self._run(request, fds)
+                except KeyboardInterrupt:
+                    if not cancelled.is_set():
+                        raise
+                    res = 128 + signal.SIGINT
+                runner_log.info('Finished with exit code %d in %.2fs', res, time.perf_counter() - start)
+                reply = {'exit': res}
+            send_message(conn, reply)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    @contextmanager
+    def _cancel_with_client(self, conn: socket.socket, cancelled: threading.Event):
+        """Interrupt the running command like Ctrl-C does when the client cancels it or the connection is gone, e.g. the
+        client was killed. Signals are passed on to Terraform as usual and the command stops cleanly"""
+
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def watch():
+            try:
+                # A cancel request or the end of the connection, the client sends nothing else while the command runs
+                data = conn.recv(65536)
+            except OSError:
+                data = b''
+            with lock:
+                if not done.is_set():
+                    runner_log.warning('Client %s, stopping the command', 'cancelled' if data else 'disconnected')
+                    cancelled.set()
+                    os.kill(os.getpid(), signal.SIGINT)
+
+        watcher = threading.Thread(target=watch, daemon=True)
+        watcher.start()
+        try:
+            yield
+        finally:
+            with lock:
+                done.set()
+            try:
+                # Wakes up the watcher, the reply can still be sent
+                conn.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+            watcher.join()
+
+    def _run(self, request: dict, fds: list) -> int:
+        """Run the command with the standard streams, working directory and environment of the client"""
+
+        saved_env = dict(os.environ)
+        os.environ.clear()
+        os.environ.update(request['env'])
+        os.environ[DAEMON_DISABLED_ENV] = '1'
+        # The CLI is relative to the working directory, the daemon runs one command at a time
+        cwd = os.getcwd()
+        try:
+            os.chdir(request['cwd'])
+            with redirected_streams(fds):
+                try:
+                    return main(request['argv'])
+                except SystemExit as e:
+                    if e.code is None or isinstance(e.code, int):
+                        return e.code or 0
+                    print(e.code, file=sys.stderr)
+                    return 1
+                except Exception:
+                    traceback.print_exc()
+                    return 1
+        finally:
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(saved_env)
+            # Whatever the command set up (e.g. a JSON log file) is closed, the daemon logs as before
+            setup_logging(logging.getLogger('hydrator').level)
+
+class Stager:
+    """Incrementally stage files into the run directory
+
+    A manifest of the staged files is kept between the runs. Files which are unchanged since the last run (and are staged
+    with the same inputs) are not touched at all, so their modification times stay the same. Files which do not need any
+    rewriting are hard linked (or symlinked if hard links are not possible) instead of copied. Files which are no longer
+    among the sources are removed"""
+
+    def __init__(self, run_dir: Path, manifest_file: Path, profiler=None):
+        self.run_dir = run_dir
+        self.manifest_file = manifest_file
+        self.profiler = profiler if profiler is not None else Profiler()
+
+    def stage(self, files: list, render, inputs: str, names: dict=None):
+        """Stage the files, `render(path, text)` returns the contents `.tf` files must have in the run directory and
+        `inputs` is anything else that contents depends on. Files are staged with the same names unless given in `names`"""
+
+        try:
+            manifest = json.loads(FS_CACHE.read(self.manifest_file)[0])
+        except (OSError, ValueError):
+            manifest = {}
+
+        names = names if names is not None else {}
+        staged = {}
+        for f in files:
+            name = names.get(f, f.name)
+            with self.profiler.measure('staging', os.path.relpath(f, self.run_dir.parent)):
+                staged[name] = self._stage_entry(f, name, manifest.get(name, None), render, inputs)
+
+        # Remove whatever was staged before but is no longer among the sources
+        for name in manifest:
+            if name not in staged and name.lower() not in STAGING_KEEP:
+                staging_log.debug('Removing: %s', name)
+                (self.run_dir / name).unlink(missing_ok=True)
+
+        write_atomic(self.manifest_file, json.dumps(staged))
+
+    def _stage_entry(self, f: Path, name: str, entry: dict, render, inputs: str) -> dict:
+        """Stage a single file unless it is unchanged since the last run, return its manifest entry"""
+
+        source = str(f.absolute())
+        st = f.stat()
+        content = None
+        if entry is not None and entry['source'] == source and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            digest = entry['hash']
+        else:
+            content = f.read_bytes()
+            digest = hashlib.sha256(content).hexdigest()
+
+        # Rendered contents also depend on the location of the original file
+        file_inputs = hashlib.sha256(f'{inputs}|{f.parent.absolute()}'.encode()).hexdigest() if f.suffix.lower() == '.tf' else ''
+        dest = self.run_dir / name
+        if entry is not None and entry['source'] == source and entry['hash'] == digest and entry['inputs'] == file_inputs and self._dest_stat(dest) == entry['dest']:
+            staging_log.debug('Unchanged: %s', f)
+            return dict(entry, size=st.st_size, mtime_ns=st.st_mtime_ns)
+
+        if content is None:
+            content = f.read_bytes()
+        mode = self._stage_file(f, dest, content, render)
+        staging_log.debug('Staged (%s): %s', mode, f)
+        return {
+            'source': source, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': digest, 'inputs': file_inputs,
+            'mode': mode, 'dest': self._dest_stat(dest)
+        }
+
+    def _stage_file(self, f: Path, dest: Path, content: bytes, render) -> str:
+        # Never write through an existing link, that would modify the original
+        dest.unlink(missing_ok=True)
+
+        if f.suffix.lower() == '.tf':
+            txt = content.decode()
+            rendered = render(f, txt)
+            if rendered != txt:
+                dest.write_text(rendered)
+                return 'render'
+
+        if dest.name.lower() not in STAGING_COPY_ONLY:
+            try:
+                os.link(f, dest)
+                return 'link'
+            except OSError:
+                pass
+            try:
+                dest.symlink_to(f.absolute())
+                return 'symlink'
+            except OSError:
+                pass
+        dest.write_bytes(content)
+        return 'copy'
+
+    def _dest_stat(self, dest: Path):
+        try:
+            st = os.lstat(dest)
+        except OSError:
+            return None
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+class ProviderCache:
+    """Provider plugin cache shared by all the runs and/or a local filesystem mirror of the providers, Terraform's own
+    settings apply to whichever is not given
+
+    The mirror is populated from the dependency lock files with `terraform providers mirror`, only with the provider
+    versions not mirrored yet. When there is a mirror `terraform init` installs the providers from it, falling back to
+    the registry for anything missing"""
+
+    def __init__(self, plugin_cache_dir: Path=None, mirror_dir: Path=None, runner: TerraformRunner=None):
+        self.plugin_cache_dir = plugin_cache_dir.absolute() if plugin_cache_dir is not None else None
+        self.mirror_dir = mirror_dir.absolute() if mirror_dir is not None else None
+        self.runner = runner if runner is not None else TerraformRunner()
+
+    def lock(self):
+        """Lock of the plugin cache, Terraform does not support concurrent inits using the same one. Nothing to lock if
+        only the mirror is used, `terraform init` only reads it"""
+
+        if self.plugin_cache_dir is None:
+            return nullcontext()
+        return FileLock(self.plugin_cache_dir / '.hydrator.lock')
+
+    def settings(self) -> dict:
+        """Everything which decides where `terraform init` installs the providers from"""
+
+        return {
+            'plugin_cache_dir': str(self.plugin_cache_dir) if self.plugin_cache_dir is not None else None,
+            'mirror_dir': str(self.mirror_dir) if self.mirror_dir is not None else None
+        }
+
+    def env(self) -> dict:
+        """Environment variables for `terraform init` to use the cache and the mirror"""
+
+        env = {}
+        if self.plugin_cache_dir is not None:
+            self.plugin_cache_dir.mkdir(parents=True, exist_ok=True)
+            env['TF_PLUGIN_CACHE_DIR'] = str(self.plugin_cache_dir)
+        if self.mirror_dir is not None:
+            # Installation methods can only be set in the CLI configuration file
+            self.mirror_dir.mkdir(parents=True, exist_ok=True)
+            cli_config = self.mirror_dir / '.hydrator.tfrc'
+            mirror = self.mirror_dir.as_posix()
+            cli_config.write_text(f'provider_installation {{\n  filesystem_mirror {{\n    path = "{mirror}"\n  }}\n  direct {{}}\n}}\n')
+            env['TF_CLI_CONFIG_FILE'] = str(cli_config)
+        return env
+
+    def populate(self, lock_files: list):
+        """Mirror all the provider versions from the lock files, unless mirrored already"""
+
+        providers = {}
+        for f in lock_files:
+            locked = HclParser(f.read_text()).parse().get('provider', {})
+            for address, provider in locked.items():
+                providers.setdefault(address, set()).add(hcl_string(provider['version']))
+
+        if not self._missing(providers):
+            runner_log.debug('All the providers are mirrored already')
+            return
+
+        self.mirror_dir.mkdir(parents=True, exist_ok=True)
+        with FileLock(self.mirror_dir / '.hydrator.lock'):
+            # Another run may have mirrored them while waiting for the lock
+            missing = self._missing(providers)
+            # A configuration can require only a single version of a provider, mirror the others in the next round(s)
+            rounds = max([len(v) for v in missing.values()], default=0)
+            for i in range(rounds):
+                required = {a: v[i] for a, v in missing.items() if i < len(v)}
+                runner_log.info('Mirroring providers: %s', required)
+                self._mirror(required)
+
+    def _missing(self, providers: dict) -> dict:
+        missing = {}
+        for address, versions in providers.items():
+            missing_versions = [v for v in sorted(versions) if not self._is_mirrored(address, v)]
+            if missing_versions:
+                missing[address] = missing_versions
+        return missing
+
+    def _is_mirrored(self, address: str, version: str) -> bool:
+        # Packed mirror layout is `HOSTNAME/NAMESPACE/TYPE/terraform-provider-TYPE_VERSION_TARGET.zip`
+        provider_dir = self.mirror_dir.joinpath(*address.split('/'))
+        type_name = address.split('/')[-1]
+        return any(provider_dir.glob(f'terraform-provider-{type_name}_{version}_*.zip'))
+
+    def _mirror(self, required: dict):
+        lines = [f'    p{i} = {{\n      source  = "{a}"\n      version = "= {v}"\n    }}' for i, (a, v) in enumerate(required.items())]
+        with tempfile.TemporaryDirectory() as tmp:
+            Path(tmp, 'versions.tf').write_text('terraform {\n  required_providers {\n' + '\n'.join(lines) + '\n  }\n}\n')
+            res = self.runner.run(['providers', 'mirror', str(self.mirror_dir)], Path(tmp))
+        if res['exit_code'] != 0:
+            raise RuntimeError(f'Failed to mirror providers {required}')
+
 class TerragruntConfigParser:
-    def __init__(self, config_file_path: Path, config_str=None, required_blocks=[Block.TERRAFORM]):
+    def __init__(self, config_file_path: Path, config_str=None, required_blocks=[Block.TERRAFORM], dependencies=None, config=None, profiler=None, track_caller=False, terragrunt_dir: Path=None, runner: TerraformRunner=None):
         self.config_file_path = config_file_path
-        if config_str is None:
+        self.profiler = profiler if profiler is not None else Profiler()
+        # Runs Terraform to read the outputs of the dependencies
+        self.runner = runner if runner is not None else TerraformRunner()
+
+        # Directory of the config being run (of the including one for the included configs), `get_terragrunt_dir()` and
+        # the relative paths are relative to it. The current directory unless given
+        self.terragrunt_dir = FS_CACHE.resolve_dir(terragrunt_dir if terragrunt_dir is not None else Path('.'))
+
+        # Included configs track which values depend on the including config (e.g. `path_relative_to_include()`) as paths
+        # of `(intermediate key, resolved key)` pairs, so only those have to be resolved again for another including config
+        self.track_caller = track_caller
+        self.caller_calls = 0
+        self.caller_dependent = []
+        self.intermediate = None
+
+        # Everything the parsing depends on (files read, environment variables), shared with the included configs
+        self.dependencies = dependencies if dependencies is not None else ConfigDependencies()
+        if config_str is None and config is None:
             if not config_file_path.exists():
                 raise FileNotFoundError(f'{config_file_path} is not found')
 
-            config_str = config_file_path.read_text()
+            config_str = self.dependencies.read_file(config_file_path)
         self.config_str = config_str
         self.required_blocks = required_blocks
         self.config = {}
         self.config[self._block_key(Block.LOCALS)] = {}
 
-        self.known_functions = {
+        self.known_functions = self._functions()
+
+        if config is not None:
+            # Already resolved, e.g. loaded from the cache
+            self.config = config
+        else:
+            self._parse_config()
+
+    def __repr__(self) -> str:
+        return str(self.config)
+
+    def _functions(self) -> dict:
+        return {
             'get_env': self._get_env, 
             'file': self._file, 
             'find_in_parent_folders': self._find_in_parent_folders,
@@ -206,10 +2652,17 @@ class TerragruntConfigParser:
             'replace': self._replace
         }
 
-        self._parse_config()
+    def for_caller(self, caller):
+        """Shallow copy of this (included) config resolving the values for another including config, the resolved values
+        are shared and nothing in this one changes"""
 
-    def __repr__(self) -> str:
-        return str(self.config)
+        res = copy.copy(self)
+        res.terragrunt_dir = caller.terragrunt_dir
+        res.dependencies = caller.dependencies
+        res.profiler = caller.profiler
+        res.caller_calls = 0
+        res.known_functions = res._functions()
+        return res
 
     def get_block(self, block: Block):
         return self.config.get(self._block_key(block), None)
@@ -222,55 +2675,13 @@ class TerragruntConfigParser:
         config_str = self.config_str.strip()
         if len(config_str) == 0:
             return self
-        
-        
-
-        # One way to parse HCL is by converting it to JSON. Could also be done using existing 3rd party libraries but this is 
-        # designed to work in constrained environments where only Python is avaiable with no additional libraries
-
-        ops = [
-            ('\s*#[^\n]*', ''),                                 # Remove comments
-            ('\\\\"', QUOTE_ESCAPE_REPLACE),                    # Temporarily mask escaped strings
-            ('\${', SUB_REPLACE),                               # TODO: is it really necessary? Temporarily mask interpolation (start of)
-            (
-                '(^|\n)\s*include\s+"([^\s"]+)"\s*{', 
-                '\\1' + INC_PREFIX + '\\2 {'
-            ),                                                  # Parse imports: `import "name" {` with `import_name {`, do this before double quote masking!
-            ('"', QUOTE_REPLACE),                               # Temporarily mask double quotes. This is necesary to handle cases when
-            ('(\n|^)\s*([^\s\n=\$]+)\s*=', '\\1,"\\2":'),       # Replace `name =` with `,"name":`
-            ('(\n|^)\s*([^\s\n:{,"]+)\s*{', '\\1,"\\2": {'),    # Replace `name {` with `,"name": {`, this should only apply to top level parameters
-
-            (':\s*(`[^`]*`)\s*((}|,))', ': "\\1"\\2'),          # Wrap the object string value into double quotes 
-                      
-            (':\s*([^\s\d[{"\'][^\n$]*)', ': "\\1"'),           # Wrap simple non-numeric values into double quotes
-            ('\s*\n\s*', ' '),                                  # Compress empty space into a single space
-            ('{(\s|\n)*,', '{'),                                # Remove extra commas after `{` which could've been introduced by the previous substitutions
-            ('{\s*`', '{"`'), ('`\s*:', '`":'),                 # Wrap the object keys into double quotes
-            (':\s*\[`', ': ["`'), 
-            ('(:\s\["`[^]]*`)]', '\\1"]'),                      # Handle list edges
-            (QUOTE_ESCAPE_REPLACE, '\\\\"'),                    # Restore masked escaped double quotes
-        ]
-
-        flags = re.IGNORECASE | re.MULTILINE | re.DOTALL      
-        for p, r in ops:
-            config_str = re.subn(p, r, config_str, flags=flags)[0]
-        
-        # Handle multi-element list inner parts
-        while True:
-            config = re.subn(':\s*\[([^]]*)`\s*,\s*`([^]]+)]', ': [\\1`", "`\\2]', config_str, flags=flags)
-            if config[1] == 0:
-                break
-            config_str = config[0]
-
-        # Remove extra commas at the boundaries                            
-        config_str = config_str.strip(',')
 
-        # Unwrap booleans and nulls which may've got wrapped into double quotes earlier
-        conf_str = config_str.replace(': "true"', ': true').replace(': "false"', ': false').replace(': "null"', ': null')   
-
-        log(f'Config str: {conf_str}')
-        config = json.loads(f"{{{conf_str}}}")
-        log(f'Config: {config}')
+        # HCL could also be parsed using existing 3rd party libraries but this is designed to work in constrained environments
+        # where only Python is avaiable with no additional libraries
+        config = HclParser(config_str).parse()
+        parser_log.debug('Config: %s', config)
+        if self.track_caller:
+            self.intermediate = config
 
         # If `terraform` node is required it must have `source` attribute
         block = Block.TERRAFORM
@@ -279,9 +2690,9 @@ class TerragruntConfigParser:
         if block in self.required_blocks and (tf is None or tf.get('source', None) is None):
             raise LookupError(f'Reference to source terraform template is not found')
         if tf is not None:
-            tf['source'] = tf.get('source').replace(QUOTE_REPLACE, '')
+            _, tf['source'] = self._resolve(tf['source'], block_type=block)
             self.config[block_key] = tf
-        log(f'{block_key}: {tf}')
+        parser_log.debug('%s: %s', block_key, tf)
 
         # Resolve includes first (which in Terragrunt seem to allow only fixed values or functions, no locals)
         block = Block.INCLUDE
@@ -298,19 +2709,59 @@ class TerragruntConfigParser:
                 includes[k[len(INC_PREFIX):]] = include
         self.config[block_key] = includes
 
-        # Following nodes are processed in the common way, start with `locals`
-        for block in [Block.LOCALS, Block.INPUTS, Block.REMOTE_STATE]:
+        # `dependency` outputs can be used by `locals`, so like includes these allow only fixed values or functions
+        self._parse_dependencies(config.get(self._block_key(Block.DEPENDENCY), None))
+
+        # `locals` can reference each other so they are resolved in the dependency order
+        block_key = self._block_key(Block.LOCALS)
+        self._resolve_locals(config.get(block_key, None))
+        parser_log.debug('%s: %s', block_key, self.config[block_key])
+
+        # Following nodes are processed in the common way
+        for block in [Block.INPUTS, Block.REMOTE_STATE, Block.DEPENDENCIES]:
             block_key = self._block_key(block)
-            _, res = self._resolve(config.get(block_key, None), block_type=block, is_recursive=False)
+            _, res = self._resolve_tracked(config.get(block_key, None), block, ((block_key, block_key), ))
 
             # These are top level blocks, do not store null for them
             if res is not None:
                 self.config[block_key] = res  # if res is not None else {}
-            log(f'{block_key}: {res}')
+            parser_log.debug('%s: %s', block_key, res)
 
-        log(f'Parsed config: {self.config}')
+        # Only the references into the locals which are decoded JSON files had to be decoded to resolve everything above,
+        # the resolved config has them as plain values
+        block_key = self._block_key(Block.LOCALS)
+        self.config[block_key] = {k: materialize(v) for k, v in self.config[block_key].items()}
+
+        parser_log.debug('Parsed config: %s', self.config)
         return self
 
+    def _parse_dependencies(self, value: dict):
+        """Resolve the `dependency "name"` blocks with the outputs of the stacks they point to, or their `mock_outputs` if
+        those stacks have no outputs yet"""
+
+        if not value:
+            return
+        block_key = self._block_key(Block.DEPENDENCY)
+        self.config[block_key] = {}
+        for name, body in value.items():
+            _, body = self._resolve(body, block_type=Block.DEPENDENCY)
+            config_path = body.get('config_path', None)
+            if config_path is None:
+                raise LookupError(f"dependency '{name}' must have a `config_path`")
+
+            stack = (self.terragrunt_dir / config_path).resolve()
+            # Outputs of the config with the same prefix, if the stack has one
+            prefix = config_prefix(self.config_file_path)
+            run_dir = stack_run_dir(stack, prefix if (stack / (prefix + CONFIG_FILE_NAME)).exists() else '')
+            state, outputs = dependency_outputs(run_dir, self.runner)
+            self.dependencies.add_state(run_dir, state)
+            if not outputs:
+                outputs = body.get('mock_outputs', None)
+                if outputs is None:
+                    raise LookupError(f"dependency '{name}' has no outputs, apply '{config_path}' first or set `mock_outputs`")
+                parser_log.debug('Using mock outputs of %s', name)
+            self.config[block_key][name] = {'config_path': config_path, 'outputs': outputs}
+
     def _parse_include(self, config: dict) -> dict:
         """Parse the `include "name ` directive"""
 
@@ -322,12 +2773,24 @@ class TerragruntConfigParser:
         # Resolve path. Terragrunt allows functions for this but not `locals` 
         _, path = self._resolve(path, block_type=Block.INCLUDE)
 
-        include = TerragruntConfigParser(Path(path), required_blocks=[])
+        return INCLUDE_CACHE.get(self.terragrunt_dir / path, self)
 
-        return include.config
+    def _resolve_tracked(self, value, block_type: Block, path: tuple, lazy=False):
+        """Resolve the value, recording the paths of the values which depend on the including config if tracking those"""
 
-    def _resolve(self, value, block_type: Block=Block.LOCALS, is_recursive=False):
-        """Return a value with all the locals and functions resolved"""
+        if not self.track_caller:
+            return self._resolve(value, block_type=block_type, is_recursive=True, lazy=lazy)
+        if isinstance(value, (dict, list)):
+            return self._resolve(value, block_type=block_type, is_recursive=True, path=path)
+        calls = self.caller_calls
+        res = self._resolve(value, block_type=block_type, is_recursive=True, lazy=lazy)
+        if self.caller_calls != calls:
+            self.caller_dependent.append((block_type, path))
+        return res
+
+    def _resolve(self, value, block_type: Block=Block.LOCALS, is_recursive=False, path=None, lazy=False):
+        """Return a value with all the locals and functions resolved. If lazy, `jsondecode(file(...))` of the whole value
+        returns a `JsonView` of the file"""
 
         # Nothing to resolve
         if value is None:
@@ -337,33 +2800,26 @@ class TerragruntConfigParser:
 
         if isinstance(value, dict):
             resolved = {}
-            to_process = list(value.keys())
-            while to_process:
-                key = to_process.pop(0)
-                is_ok, res = self._resolve(value[key], block_type=block_type, is_recursive=True)
-                if is_ok:
-                    # Key may be wrapped into QUOTE_REPLACE
-                    k = key.strip(QUOTE_REPLACE)
-                    resolved[k] = res
-                    if block_type == Block.LOCALS and not is_recursive:
-                        # Store only top level locals
-                        self.config[self._block_key(Block.LOCALS)][k] = res
-                elif not is_recursive:
-                    # Dependency not found, this could only happen to locals, not inputs, put it back to queue but only if it wasn't the last one
-                    if len(to_process) > 0:
-                        to_process.append(key)
-                    else:
-                        raise LookupError(f"'Dependency for {value[key]}' not found")
+            for key, v in value.items():
+                if path is not None:
+                    is_ok, res = self._resolve_tracked(v, block_type, path + ((key, key), ))
                 else:
-                    # Must be also part of locals but is deeper in the hierarchy, stop here, this should abandon the full tree traversal
+                    is_ok, res = self._resolve(v, block_type=block_type, is_recursive=True)
+                if not is_ok:
+                    # Must be a reference to a local which is not resolved, this abandons the full tree traversal
                     return False, None
+
+                resolved[key] = res
         
             return True, resolved
         
         if isinstance(value, list):
             resolved = []
-            for v in value:
-                is_ok, res = self._resolve(v, block_type=block_type, is_recursive=True)
+            for i, v in enumerate(value):
+                if path is not None:
+                    is_ok, res = self._resolve_tracked(v, block_type, path + ((i, i), ))
+                else:
+                    is_ok, res = self._resolve(v, block_type=block_type, is_recursive=True)
                 if is_ok:
                     resolved.append(res)
                 else:
@@ -374,316 +2830,164 @@ class TerragruntConfigParser:
         elif isinstance(value, str):
             # Just because the value is string here doesn't mean it will be of string type becuase of the way we converted the HCL to JSON,
             # e.g. in `x = jsondecode(...)` is converted to `"x": "jsondecode(...)"` so value will appear as str type here but it is an object
-   
-            # Value may be wrapped in QUOTE_REPLACE, strip those. It may also contain QUOTE_REPLACE in it so convert it to double quote
-            value = value.strip(QUOTE_REPLACE).replace(QUOTE_REPLACE, '"')
-            value = value.replace(SUB_REPLACE, '${')
-            log(f'Resolving: {value}')
-
-            if value.startswith('local.'):
-                # For now assume this is a single value, not an operation. It can be a nested property lookup
-                log(f'Resolving local: {value}')
-                v = self._get_local(value)
-                if v is not None:
-                    return True, v
-                elif local_must_exist:
-                    raise LookupError(f"'{value}' not found in locals")
-                else:
-                    return False, None
-            
-            elif value.startswith('include.'):
-                log(f'Resolving include: {value}')
-                v = self._get_include(value)
-                return v is not None, v
-            
-            elif value.startswith('null'):
-                log(f'Resolving null')
-                return True, None
-            
-            elif value.startswith('{}'):
-                log(f'Resolving empty object')
-                return True, {}
-            
-            elif value.startswith('[]'):
-                log(f'Resolving empty list')
-                return True, []
-            
-            elif self._is_function(value):
-                return self._exec_function(value)
-            
-            else:
-                 # This is likely just a string, strip possible surrounding double quotes
-                log(f'Resolving string: {value}')
-                is_ok, res = self._replace_locals(value.strip('"'), local_must_exist=local_must_exist)
-                if is_ok:
-                    res = self._replace_functions(res)
-                log(f'- resolved: {res}')
-                return is_ok, res
-            
-            raise RuntimeError(f"Should never get here: {value}")
-        
+            try:
+                return True, self._evaluate(compile_expression(value), lazy=lazy)
+            except UnresolvedReference as e:
+                if e.root == 'local' and local_must_exist:
+                    raise LookupError(f"'{e.ref}' not found in locals") from None
+                if e.root == 'dependency':
+                    raise LookupError(f"'{e.ref}' not found in the dependency outputs") from None
+                return False, None
+
         else:
             # Boolean or number, no need to process
             return True, value
 
-    def _get_local(self, key: str):
-        if key.startswith('local.'):
-            key = key[len('local.'):]
-        lookup = self.config[self._block_key(Block.LOCALS)]
-        keys = key.split('.')
-        for key in keys:
-            if '[' in key:
-                i = key.index('[')
-                if i > 0:
-                    k = key[:i]
-                    lookup = lookup.get(k, None)
-                    if lookup is None:
-                        return None
-
-                k = key[i:]
-                while k is not None and k.startswith('['):
-                    i = k.index(']')
-                    idx = int(k[1:i])
-                    lookup = lookup[idx]
-                    i += 1
-                    k = None if i >= len(k) else k[i:]
-            else:
-                lookup = lookup.get(key, None)
-                if lookup is None:
-                    return None
-
-        return lookup
-
-    def _get_include(self, key: str):
-        if key.startswith('include.'):
-            key = key[len('include.'):]
-        lookup = self.config[self._block_key(Block.INCLUDE)]
-        for k in key.split('.'):
-            res = lookup.get(k, None)
-            if res is None:
-                break
-            else:
-                lookup = res
-        return res  
-
-    def _is_function(self, value: str) -> bool:
-        if not value.startswith('"'):
-            for func in self.known_functions:
-                if re.search(f'^{func}\s*\(', value):
-                    return True
-        return False
-
-    def _replace_locals(self, value_str: str, local_must_exist=False) -> tuple[bool, str]:
-        """ Interpolate the string by replacing all the occurrences of references to locals only"""
-
-        # This is a string interpolation so must include `${...}`
-        pattern = "(\$\{local.([^\s}]+)\})"
-        while True:
-            res = re.search(pattern, value_str, re.IGNORECASE)
-            if res:
-                full_local = res.group(1)
-                key = res.group(2)
-                v = self._get_local(key)
-                if v is not None:
-                    value_str = value_str.replace(full_local, str(v), 1)
-                    continue
-                elif local_must_exist:
-                    raise LookupError(f"'{key}' not found in locals")
-                return False, None
-            break
-
-        return True, value_str
-
-    def _replace_functions(self, value_str: str):
-        """ Interpolate the string by replacing all the occurrences of references to functions"""
-
-        # Fancy regexes like `((\$\{)?\d[^"()\{\}/]*\([^()]*(\)*\s*)*)` would be really hard to construct here, e.g. for nested functions, safer to parse by walking along
-        while True:
-            if '${' in value_str:
-                i = value_str.index('${')
-            else:
-                break
-
-            j = i + 2
-            func_str = value_str[j:]
-            is_func = self._is_function(func_str)
-            if not is_func:
-                raise LookupError(f'Unknown function in "{func_str}" at the position {i}')
-            
-            in_string = False
-            while (value_str[j] != '}' or in_string) and j < len(value_str):
-                if value_str[j] == '"':
-                    in_string = not in_string
-                elif in_string and value_str[j] == '{' and value_str[j-1] == '$':
-                    ## Nested function, need to solve it first
-                    i = j - 1
-                    in_string = False
-                j += 1
-
-            if j < len(value_str):
-                is_ok, res = self._exec_function(value_str[i+2:j].strip())
-                if is_ok:
-                    value_str = f'{value_str[0:i]}{res}{value_str[j+1:]}'
-
-        return value_str
-
-    def _extract_function(self, value: str) -> str:
-        """ Extract the full definition of the function at the start of the given value"""
-
-        log(f'Extracting function from: {value}')
-
-        # Fancy regexes like `'([^{(\s]+)\s*\(([^)]*)(\)*\s*)*'` won't be sufficient here, e.g. for nested functions, safer to parse by walking along
-        lookup = re.search(f'(^([^\s\(]+)\s*\()', value)
-        if not lookup:
-            raise ValueError(f'Invalid function {value}')
-        func = lookup.group(2)
-        if func not in self.known_functions:
-            raise ValueError(f'Uknown function {func}')
-        
-        i = len(lookup.group(1)) - 1
-        count = 0
-        in_string = False
-        while i < len(value) - 1:
-            i += 1
-            if value[i] == '"':
-                in_string = not in_string
-                i += 1
-                continue
-            if in_string:
-                continue
-
-            if value[i] == '(':
-                count += 1
-                continue
-
-            if value[i] == ')':
-                if count == 0:
-                    return value[0:i+1]
-                else:
-                    count -= 1
-
-        return value
-    
-    def _exec_function(self, func_str: str):
-        """Execute a given function"""
-
-        lookup = re.search(f'(^([^\s\(]+)\s*\()', func_str)
-        if not lookup:
-            raise ValueError(f'Invalid function {func_str}')
-        func = lookup.group(2)
-        if func not in self.known_functions:
-            raise ValueError(f'Uknown function {func}')
-
-        log(f'Executing: {func_str}')
-        
-        param_str = func_str.strip()[len(lookup.group(1)):-1]
-        if len(param_str) == 0:
-            # Function without parameters
-            return True, self.known_functions[func]()
-        
-        if param_str.count(',') == 0:
-            # A single parameter
-            is_ok, res = self._resolve(param_str)
-            if is_ok:
-                return True, self.known_functions[func](res)
-            return False, None
-        
-        if '${' in param_str:
-            param_str = self._replace_functions(param_str)
-
-        params = []
-        i = 0
-        while i < len(param_str):
-            if param_str[i] == ' ':
-                i += 1
-                continue
-
-            if param_str[i] == '"':
-                j = i + 1
-                while j < len(param_str) and param_str[j] != '"':
-                    j += 1
-                if j < len(param_str):
-                    # No trims here
-                    params.append(param_str[i:j+1])
+    def _resolve_locals(self, value: dict):
+        """Resolve top level `locals` in the order of their dependencies on each other, each one is resolved exactly once"""
+
+        if not value:
+            return
+        locals_key = self._block_key(Block.LOCALS)
+        order = sort_dependencies({k: self._local_references(v) for k, v in value.items()}, 'locals')
+
+        resolved = self.config[locals_key]
+        for key in order:
+            with self.profiler.measure('locals', key):
+                # Locals which are just decoded JSON files are decoded only as far as they are referenced
+                is_ok, res = self._resolve_tracked(value[key], Block.LOCALS, ((locals_key, locals_key), (key, key)), lazy=True)
+            if not is_ok:
+                raise LookupError(f"Dependency for 'local.{key}' not found")
+            resolved[key] = res
+
+        # Keep the declaration order
+        self.config[locals_key] = {k: resolved[k] for k in value}
+
+    def _local_references(self, value) -> set:
+        """Names of all the locals referenced anywhere in the value"""
+
+        if isinstance(value, str):
+            try:
+                node = compile_expression(value)
+            except ValueError:
+                # Fails properly once resolved
+                return set()
+            return self._node_local_references(node)
+        refs = set()
+        if isinstance(value, dict):
+            for v in value.values():
+                refs |= self._local_references(v)
+        elif isinstance(value, list):
+            for v in value:
+                refs |= self._local_references(v)
+        return refs
+
+    def _node_local_references(self, node: tuple) -> set:
+        kind = node[0]
+        if kind == EXPR_LITERAL:
+            return set()
+        refs = set()
+        if kind == EXPR_REFERENCE:
+            _, root, steps, _ = node
+            if root == 'local' and steps[0][0] == STEP_ATTR:
+                refs.add(steps[0][1])
+            for step, v in steps:
+                if step == STEP_INDEX:
+                    refs |= self._node_local_references(v)
+        elif kind == EXPR_CALL:
+            for arg in node[2]:
+                refs |= self._node_local_references(arg)
+        elif kind == EXPR_OBJECT:
+            for k, v in node[1]:
+                refs |= self._node_local_references(k) | self._node_local_references(v)
+        else:
+            for part in node[1]:
+                refs |= self._node_local_references(part)
+        return refs
+
+    def _evaluate(self, node: tuple, lazy=False):
+        """Evaluate the compiled expression, raises `UnresolvedReference` if a referenced value is not (yet) known. If lazy,
+        `jsondecode(file(...))` returns a `JsonView` of the file instead of decoding it"""
+
+        kind = node[0]
+        if kind == EXPR_LITERAL:
+            return node[1]
+        if kind == EXPR_TEMPLATE:
+            return ''.join([str(self._evaluate(part)) for part in node[1]])
+        if kind == EXPR_REFERENCE:
+            return self._get_reference(node)
+        if kind == EXPR_CALL:
+            _, func, args = node
+            if func not in self.known_functions:
+                raise ValueError(f'Unknown function {func}')
+            if lazy and func == 'jsondecode' and len(args) == 1 and args[0][0] == EXPR_CALL and args[0][1] == 'file' and len(args[0][2]) == 1:
+                with self.profiler.measure('functions', 'jsondecode'):
+                    return self._json_file(self._evaluate(args[0][2][0]))
+            return self._call_function(func, *[self._evaluate(arg) for arg in args])
+        if kind == EXPR_LIST:
+            return [self._evaluate(item) for item in node[1]]
+        if kind == EXPR_OBJECT:
+            return {str(self._evaluate(k)): self._evaluate(v) for k, v in node[1]}
+        raise RuntimeError(f"Should never get here: {node}")
+
+    def _get_reference(self, node: tuple):
+        _, root, steps, text = node
+        block = {'local': Block.LOCALS, 'include': Block.INCLUDE, 'dependency': Block.DEPENDENCY}[root]
+        lookup = self.config.get(self._block_key(block), {})
+        try:
+            for step, v in steps:
+                if step == STEP_ATTR:
+                    lookup = lookup[v]
                 else:
-                    raise RuntimeError(f'Unclosed string in {param_str} from position {i}')
-                i = j + 1
-                if i < len(param_str) and param_str[i] == ',':
-                    i += 1
-            elif self._is_function(param_str[i:]):
-                f = self._extract_function(param_str[i:])
-                params.append(f)
-                i = i + len(f)
-                if i < len(param_str) and param_str[i] == ',':
-                    i += 1
-            elif param_str[i:].startswith('local.') or param_str[i:].startswith('include.'):
-                j = i + len('local.')
-                while j < len(param_str) and param_str[j] != ',':
-                    j += 1
-                params.append(param_str[i:j].strip())
-                i = j + 1
-            elif param_str[i:].startswith('null'):
-                j = i + len('null')
-                params.append('null')
-                while j < len(param_str) and param_str[j] != ',':
-                    j += 1
-                i = j + 1
-            elif param_str[i:].startswith('{}'):
-                j = i + len('{}')
-                params.append('{}')
-                while j < len(param_str) and param_str[j] != ',':
-                    j += 1
-                i = j + 1
-            elif param_str[i:].startswith('[]'):
-                j = i + len('[]')
-                params.append('[]')
-                while j < len(param_str) and param_str[j] != ',':
-                    j += 1
-                i = j + 1
-            else:
-                raise RuntimeError(f"Should never get here: {param_str}")
+                    idx = self._evaluate(v)
+                    lookup = lookup[int(idx) if isinstance(lookup, list) else idx]
+        except (KeyError, IndexError, TypeError, ValueError):
+            raise UnresolvedReference(root, text) from None
+        return materialize(lookup)
 
-        resolved_params = []
-        for p in params:
-            is_ok, p_res = self._resolve(p)
-            if is_ok:
-                resolved_params.append(p_res)
-            else:
-                return False, None
-            
-        return True, self.known_functions[func](*resolved_params)
+    def _call_function(self, func: str, *params):
+        with self.profiler.measure('functions', func):
+            return self.known_functions[func](*params)
 
 
     def _get_env(self, name: str, default=None) -> str:
-        val = os.environ.get(name, default)
-        return val
+        val = os.environ.get(name)
+        self.dependencies.add_env(name, val)
+        return val if val is not None else default
 
     def _get_terragrunt_dir(self) -> Path:
-        return Path(".").absolute().resolve()
+        self.caller_calls += 1
+        return self.terragrunt_dir
 
     def _file(self, path: str) -> str:
-        p = Path(path.strip(' "'))
-        return p.read_text()
+        return self.dependencies.read_file(self._path(path))
+
+    def _json_file(self, path: str):
+        return self.dependencies.read_json(self._path(path))
+
+    def _path(self, path: str) -> Path:
+        p = Path(str(path).strip(' "'))
+        if not p.is_absolute():
+            # Relative to the directory of the config being run, i.e. the including config
+            self.caller_calls += 1
+            p = self.terragrunt_dir / p
+        return p
 
     def _jsondecode(self, obj: str) -> dict:
         # Strip possible surrounding double quotes
         return json.loads(obj.strip('"'))
 
     def _find_in_parent_folders(self, name='terragrunt.hcl') -> Path:
-        def find_recursive(parent: Path):
-            f = parent / name
-            if f.exists():
-                return f
-            if os.path.dirname(str(parent)) == str(parent):
-                # We are at the root, stop
-                raise FileNotFoundError(f'{name} not found')
-            return find_recursive((parent / '../').resolve())
-        
-        return find_recursive(Path('../').resolve())
+        found, probed = FS_CACHE.find_in_parents(self._get_terragrunt_dir().parent, name)
+        for f in probed:
+            self.dependencies.add_missing(f)
+        if found is None:
+            raise FileNotFoundError(f'{name} not found')
+        return found
 
     def _path_relative_to_include(self) -> str:
         caller = self._get_terragrunt_dir()
-        res = caller.relative_to(self.config_file_path.parent.absolute().resolve())
+        res = caller.relative_to(FS_CACHE.resolve_dir(self.config_file_path.parent))
 
         # Need to use posix style separator here
         return str(res).replace(os.sep, '/')
@@ -700,14 +3004,659 @@ class TerragruntConfigParser:
     def _replace(self, value: str, old: str, new: str):
         return value.replace(old, new)
 
-def get_args():
+JSON_STRING = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+# Anything but strings and brackets, always up to the next one of those so failed matches cannot backtrack exponentially
+JSON_OTHER = rb'[^"\[\]{}]+(?=["\[\]{}])'
+JSON_SKIP_DEPTH = 3
+JSON_SKIP_ITEMS = 1000
+
+def json_container_pattern(depth: int) -> bytes:
+    """Regular expression matching a JSON object or array with up to `depth` levels of containers nested in it"""
+
+    pattern = rb'[\[{](?:' + JSON_OTHER + b'|' + JSON_STRING + rb'){0,%d}[\]}]' % JSON_SKIP_ITEMS
+    for _ in range(depth):
+        pattern = rb'[\[{](?:' + JSON_OTHER + b'|' + JSON_STRING + b'|' + pattern + rb'){0,%d}[\]}]' % JSON_SKIP_ITEMS
+    return pattern
+
+class JsonView:
+    """Read-only view of a JSON object or array in a (memory mapped) buffer, which decodes only what is accessed
+
+    A container is indexed once, the first time anything in it is accessed: only the offsets of its direct children are
+    recorded, everything nested in them is skipped without decoding. Scalars are decoded on access and containers are
+    returned as views, so memory is proportional to what is referenced rather than to the size of the document.
+    `materialize()` decodes the full container"""
+
+    WS_RE = re.compile(rb'[ \t\r\n]*')
+    STRING_RE = re.compile(JSON_STRING)
+    SCALAR_RE = re.compile(rb'[^,:\]}\s]+')
+    # Everything up to the next bracket outside of strings, a limited number of items at once so the state kept by the
+    # regular expression engine stays small
+    SKIP_RE = re.compile(rb'(?:' + JSON_OTHER + b'|' + JSON_STRING + rb'){0,%d}' % JSON_SKIP_ITEMS)
+    # Containers nested up to a few levels deep are skipped by a single match, deeper ones bracket by bracket
+    CONTAINER_RE = re.compile(json_container_pattern(JSON_SKIP_DEPTH))
+
+    def __init__(self, buf, start: int):
+        self.buf = buf
+        self.start = start
+        self.is_object = buf[start:start + 1] == b'{'
+        self.end = None
+        self.index = None
+        self.views = {}
+
+    @classmethod
+    def of(cls, buf):
+        """Return a view of the top level container, or the decoded value if it is a scalar"""
+
+        start = cls.WS_RE.match(buf, 0).end()
+        if buf[start:start + 1] in (b'{', b'['):
+            return cls(buf, start)
+        return json.loads(buf[start:])
+
+    def __getitem__(self, key):
+        index = self._index()
+        if not self.is_object:
+            key = int(key)
+        start, end = index[key]
+        if self.buf[start:start + 1] in (b'{', b'['):
+            view = self.views.get(key, None)
+            if view is None:
+                view = JsonView(self.buf, start)
+                view.end = end
+                self.views[key] = view
+            return view
+        return json.loads(self.buf[start:end])
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except (KeyError, IndexError, ValueError):
+            return default
+
+    def __contains__(self, key) -> bool:
+        return key in self._index() if self.is_object else 0 <= int(key) < len(self._index())
+
+    def __len__(self) -> int:
+        return len(self._index())
+
+    def __iter__(self):
+        index = self._index()
+        return iter(index) if self.is_object else (self[i] for i in range(len(index)))
+
+    def materialize(self):
+        if self.end is None:
+            self._index()
+        return json.loads(self.buf[self.start:self.end])
+
+    def __repr__(self) -> str:
+        return f'JsonView({"object" if self.is_object else "array"} at {self.start})'
+
+    def _index(self):
+        """Offsets (start, end) of the children, by key for objects or by position for arrays"""
+
+        if self.index is not None:
+            return self.index
+        buf = self.buf
+        index = {} if self.is_object else []
+        close = b'}' if self.is_object else b']'
+        pos = self.WS_RE.match(buf, self.start + 1).end()
+        if buf[pos:pos + 1] == close:
+            pos += 1
+        else:
+            while True:
+                if self.is_object:
+                    m = self.STRING_RE.match(buf, pos)
+                    if m is None:
+                        raise ValueError(f'Expected an object key at the position {pos}')
+                    key = json.loads(m.group())
+                    pos = self.WS_RE.match(buf, m.end()).end()
+                    if buf[pos:pos + 1] != b':':
+                        raise ValueError(f"Expected ':' at the position {pos}")
+                    pos = self.WS_RE.match(buf, pos + 1).end()
+                end = self._skip_value(pos)
+                if self.is_object:
+                    index[key] = (pos, end)
+                else:
+                    index.append((pos, end))
+                pos = self.WS_RE.match(buf, end).end()
+                c = buf[pos:pos + 1]
+                if c == close:
+                    pos += 1
+                    break
+                if c != b',':
+                    raise ValueError(f"Expected ',' or '{close.decode()}' at the position {pos}")
+                pos = self.WS_RE.match(buf, pos + 1).end()
+        self.end = pos
+        self.index = index
+        return index
+
+    def _skip_value(self, pos: int) -> int:
+        """Position after the value starting at the position"""
+
+        buf = self.buf
+        c = buf[pos:pos + 1]
+        if c == b'"':
+            m = self.STRING_RE.match(buf, pos)
+        elif c in (b'{', b'['):
+            depth = 0
+            while True:
+                if c in (b'{', b'['):
+                    m = self.CONTAINER_RE.match(buf, pos)
+                    if m is not None:
+                        if depth == 0:
+                            return m.end()
+                        pos = m.end()
+                    else:
+                        depth += 1
+                        pos += 1
+                elif c in (b'}', b']'):
+                    depth -= 1
+                    pos += 1
+                    if depth == 0:
+                        return pos
+                next_pos = self.SKIP_RE.match(buf, pos).end()
+                c = buf[next_pos:next_pos + 1]
+                if next_pos == pos and c not in (b'{', b'[', b'}', b']'):
+                    raise ValueError(f'Unexpected end of a container at the position {pos}')
+                pos = next_pos
+        else:
+            m = self.SCALAR_RE.match(buf, pos)
+        if m is None:
+            raise ValueError(f'Expected a value at the position {pos}')
+        return m.end()
+
+def materialize(value):
+    """Decode the value fully if it is a `JsonView`"""
+
+    return value.materialize() if isinstance(value, JsonView) else value
+
+class JsonStream:
+    """Incremental reader of a JSON document from a text stream, decoding only the values at the given paths
+
+    Paths are tuples of object keys and array indexes, `*` in a pattern matches any index. Containers which cannot contain
+    any of the paths are skipped bracket by bracket without decoding anything in them, so the memory used is bounded by the
+    chunk size and the largest single value, however large the document is"""
+
+    # Commas and colons carry no information for reading a valid document, they are skipped like white space
+    TOKEN_RE = re.compile(r'[\s,:]*(?:([\[\]{}])|("[^"\\]*(?:\\.[^"\\]*)*")|([^\s,:\[\]{}"]+))')
+    SKIP_RE = re.compile(r'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*"){0,%d}' % JSON_SKIP_ITEMS)
+
+    def __init__(self, stream, chunk_size=JSON_STREAM_CHUNK):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def values(self, patterns: list):
+        """Yield `(path, value)` of every scalar value matching any of the patterns, in the document order"""
+
+        m = self._token()
+        if m is None:
+            raise ValueError('Empty JSON document')
+        yield from self._value(m, (), patterns)
+
+    def _value(self, m: re.Match, path: tuple, patterns: list):
+        bracket, string, other = m.groups()
+        if bracket is None:
+            if any([self._matches(path, p) for p in patterns if len(p) == len(path)]):
+                yield path, json.loads(string if string is not None else other)
+            return
+        if bracket not in '[{':
+            raise ValueError(f"Unexpected '{bracket}'")
+        if not any([self._matches(path, p) for p in patterns if len(p) > len(path)]):
+            self._skip()
+            return
+
+        is_object = bracket == '{'
+        close = '}' if is_object else ']'
+        i = 0
+        while True:
+            m = self._token()
+            if m is None:
+                raise ValueError('Unexpected end of the JSON document')
+            if m.group(1) == close:
+                return
+            if is_object:
+                if m.group(2) is None:
+                    raise ValueError(f"Expected an object key, got '{m.group()}'")
+                key = json.loads(m.group(2))
+                m = self._token()
+                if m is None:
+                    raise ValueError('Unexpected end of the JSON document')
+                yield from self._value(m, path + (key, ), patterns)
+            else:
+                yield from self._value(m, path + (i, ), patterns)
+                i += 1
+
+    def _matches(self, path: tuple, pattern: tuple) -> bool:
+        for k, p in zip(path, pattern):
+            if p != k and not (p == '*' and isinstance(k, int)):
+                return False
+        return True
+
+    def _token(self):
+        """Next token, None at the end of the document"""
+
+        while True:
+            m = self.TOKEN_RE.match(self.buf, self.pos)
+            # A token at the end of the buffer may continue in the next chunk
+            if m is not None and (m.end() < len(self.buf) or self.eof):
+                self.pos = m.end()
+                return m
+            if self.eof:
+                if self.buf[self.pos:].strip(' \t\r\n,:'):
+                    raise ValueError(f'Invalid JSON: {self.buf[self.pos:self.pos + 50]}')
+                return None
+            self._fill()
+
+    def _skip(self):
+        """Skip the rest of the container which opening bracket was just read"""
+
+        depth = 1
+        while True:
+            start = self.pos
+            self.pos = self.SKIP_RE.match(self.buf, self.pos).end()
+            c = self.buf[self.pos:self.pos + 1]
+            if c in ('[', '{'):
+                depth += 1
+                self.pos += 1
+            elif c in (']', '}'):
+                depth -= 1
+                self.pos += 1
+                if depth == 0:
+                    return
+            elif self.pos == start:
+                # End of the buffer, possibly in the middle of a string
+                if self.eof:
+                    raise ValueError('Unexpected end of the JSON document')
+                self._fill()
+
+    def _fill(self):
+        chunk = self.stream.read(self.chunk_size)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+
+def plan_summary(stream) -> dict:
+    """Count the changes of the plan read from `terraform show -json` output by module, resource type and action,
+    actions without any changes (no-op, read) are not counted"""
+
+    summary = {'totals': {a: 0 for a in PLAN_SUMMARY_ACTIONS}, 'modules': {}}
+    if stream is None:
+        return summary
+
+    def add(resource: dict):
+        actions = resource.get('actions', [])
+        if sorted(actions) == ['create', 'delete']:
+            action = 'replace'
+        elif len(actions) == 1 and actions[0] in PLAN_SUMMARY_ACTIONS:
+            action = actions[0]
+        else:
+            return
+        types = summary['modules'].setdefault(resource.get('module_address', None) or 'root', {})
+        counts = types.setdefault(resource.get('type', 'unknown'), {})
+        counts[action] = counts.get(action, 0) + 1
+        summary['totals'][action] += 1
+
+    # Changes are read one at a time, only the counts are kept
+    index, resource = None, None
+    for path, value in JsonStream(stream).values(PLAN_SUMMARY_PATHS):
+        if path[1] != index:
+            if resource is not None:
+                add(resource)
+            index, resource = path[1], {}
+        if path[2] == 'change':
+            resource.setdefault('actions', []).append(value)
+        else:
+            resource[path[2]] = value
+    if resource is not None:
+        add(resource)
+    return summary
+
+class FileSystemCache:
+    """Process wide cache of the files read by the configs, of the directory listings and of the resolved working
+    directories
+
+    Every entry is validated against the modification time (and size) of the file or directory before it is used, so
+    changes are always picked up, at the cost of a single `stat` instead of a full read or lookup. The cache is bounded,
+    least recently used entries are evicted first"""
+
+    def __init__(self, max_bytes=FILE_CACHE_MAX_BYTES, max_dirs=DIR_CACHE_MAX_ENTRIES):
+        self.max_bytes = max_bytes
+        self.max_dirs = max_dirs
+        self.files = OrderedDict()
+        self.size = 0
+        self.dirs = OrderedDict()
+        self.resolved = {}
+        self.json_views = OrderedDict()
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.files.clear()
+            self.size = 0
+            self.dirs.clear()
+            self.resolved.clear()
+            self.json_views.clear()
+
+    def read(self, path: Path) -> tuple:
+        """Return the text of the file and the hash of its contents"""
+
+        key = os.path.abspath(path)
+        st = os.stat(key)
+        signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self.lock:
+            entry = self.files.get(key, None)
+            if entry is not None and entry[0] == signature:
+                self.files.move_to_end(key)
+                return entry[1], entry[2]
+
+        with open(key, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+
+        # Same new line handling as `Path.read_text`
+        text = content.decode().replace('\r\n', '\n').replace('\r', '\n')
+        with self.lock:
+            old = self.files.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            if len(text) <= self.max_bytes:
+                self.files[key] = (signature, text, digest)
+                self.size += len(text)
+                while self.size > self.max_bytes:
+                    _, evicted = self.files.popitem(last=False)
+                    self.size -= len(evicted[1])
+        return text, digest
+
+    def json_view(self, path: Path) -> tuple:
+        """Return a lazy `JsonView` of the JSON file, memory mapped, and the hash of its contents. The views (and their
+        indexes) are shared by all the configs reading the same file"""
+
+        key = os.path.abspath(path)
+        st = os.stat(key)
+        signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self.lock:
+            entry = self.json_views.get(key, None)
+            if entry is not None and entry[0] == signature:
+                self.json_views.move_to_end(key)
+                return entry[1], entry[2]
+
+        with open(key, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size > 0 else b''
+        digest = hashlib.sha256(buf).hexdigest()
+        view = JsonView.of(buf)
+        with self.lock:
+            self.json_views[key] = (signature, view, digest)
+            while len(self.json_views) > JSON_VIEW_MAX_ENTRIES:
+                self.json_views.popitem(last=False)
+        return view, digest
+
+    def digest(self, path: Path) -> str:
+        """Hash of the contents of the file, without keeping the contents"""
+
+        key = os.path.abspath(path)
+        st = os.stat(key)
+        signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self.lock:
+            for entries in [self.files, self.json_views]:
+                entry = entries.get(key, None)
+                if entry is not None and entry[0] == signature:
+                    return entry[2]
+
+        digest = hashlib.sha256()
+        with open(key, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def list_dir(self, path: str):
+        """Return the set of names in the directory, None if there is no such directory"""
+
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.dirs.get(path, None)
+            if entry is not None and entry[0] == mtime:
+                self.dirs.move_to_end(path)
+                return entry[1]
+        try:
+            names = set(os.listdir(path))
+        except OSError:
+            return None
+        self._add_dir(path, mtime, names)
+        return names
+
+    def _add_dir(self, path: str, mtime: int, names: set):
+        with self.lock:
+            self.dirs[path] = (mtime, names)
+            self.dirs.move_to_end(path)
+            while len(self.dirs) > self.max_dirs:
+                self.dirs.popitem(last=False)
+
+    def index(self, root: Path):
+        """List all the directories of the tree in one pass, e.g. before parsing all the configs in it"""
+
+        for path, dirs, files in os.walk(os.path.abspath(root)):
+            dirs[:] = [d for d in dirs if not is_run_dir(d) and not d.startswith('.')]
+            try:
+                self._add_dir(path, os.stat(path).st_mtime_ns, set(dirs) | set(files))
+            except OSError:
+                continue
+
+    def find_in_parents(self, start: Path, name: str) -> tuple:
+        """Look for the name in the directory and its parents, return the path found (or None) and all the paths checked
+        before it"""
+
+        probed = []
+        d = str(start)
+        while True:
+            names = self.list_dir(d)
+            f = os.path.join(d, name)
+            if names is not None and name in names:
+                return Path(f), probed
+            probed.append(f)
+            parent = os.path.dirname(d)
+            if parent == d:
+                # We are at the root, stop
+                return None, probed
+            d = parent
+
+    def resolve_dir(self, path: Path) -> Path:
+        """Absolute path of the directory with all the symlinks resolved"""
+
+        key = os.path.abspath(path)
+        res = self.resolved.get(key, None)
+        if res is None:
+            res = Path(key).resolve()
+            with self.lock:
+                if len(self.resolved) >= self.max_dirs:
+                    self.resolved.clear()
+                self.resolved[key] = res
+        return res
+
+FS_CACHE = FileSystemCache()
+
+class ConfigDependencies:
+    """Inputs a parsed config depends on: content hashes of the files read, values of the environment variables read,
+    the paths probed by `find_in_parent_folders` which did not exist and the states of the `dependency` stacks"""
+
+    def __init__(self, files=None, env=None, missing=None, states=None):
+        self.files = files if files is not None else {}
+        self.env = env if env is not None else {}
+        self.missing = missing if missing is not None else []
+        self.states = states if states is not None else {}
+
+    def read_file(self, path: Path) -> str:
+        text, digest = FS_CACHE.read(path)
+        self.files[str(path.absolute())] = digest
+        return text
+
+    def read_json(self, path: Path):
+        view, digest = FS_CACHE.json_view(path)
+        self.files[str(path.absolute())] = digest
+        return view
+
+    def merge(self, other):
+        self.files.update(other.files)
+        self.env.update(other.env)
+        for path in other.missing:
+            self.add_missing(path)
+        self.states.update(other.states)
+
+    def add_env(self, name: str, value):
+        self.env[name] = value
+
+    def add_state(self, run_dir: Path, state: str):
+        self.states[str(run_dir)] = state
+
+    def add_missing(self, path: Path):
+        path = str(path)
+        if path not in self.missing:
+            self.missing.append(path)
+
+    def is_valid(self, runner: TerraformRunner=None) -> bool:
+        """Check the dependencies are still the same as when they were collected, `runner` reads the states of the
+        dependencies"""
+
+        for name, value in self.env.items():
+            if os.environ.get(name) != value:
+                return False
+        for path in self.missing:
+            if os.path.exists(path):
+                return False
+        for path, digest in self.files.items():
+            try:
+                if FS_CACHE.digest(Path(path)) != digest:
+                    return False
+            except OSError:
+                return False
+        for run_dir, state in self.states.items():
+            if state_id(Path(run_dir), runner) != state:
+                return False
+        return True
+
+    def to_dict(self) -> dict:
+        return {'files': self.files, 'env': self.env, 'missing': self.missing, 'states': self.states}
+
+    @classmethod
+    def from_dict(cls, value: dict):
+        return cls(value['files'], value['env'], value['missing'], value.get('states', None))
+
+class ConfigCache:
+    """On-disk cache of fully resolved configs
+
+    Entries are stored per config file and working directory, each one together with the dependencies collected while
+    parsing. An entry is only used if all of its dependencies are unchanged, a few most recent entries are kept so switching
+    between e.g. environment variable values does not invalidate the cache"""
+
+    def __init__(self, cache_dir: Path=CONFIG_CACHE_DIR, runner: TerraformRunner=None):
+        self.cache_dir = cache_dir
+        self.runner = runner
+
+    def _entry_path(self, config_file: Path) -> Path:
+        key = f'{config_file.absolute()}|{FS_CACHE.resolve_dir(config_file.parent)}'
+        return self.cache_dir / f'{hashlib.sha256(key.encode()).hexdigest()}.json'
+
+    def _read_entries(self, config_file: Path) -> list:
+        try:
+            return json.loads(FS_CACHE.read(self._entry_path(config_file))[0])
+        except (OSError, ValueError):
+            return []
+
+    def load(self, config_file: Path):
+        """Return the parser for a valid cached entry if there is one, None otherwise"""
+
+        for entry in self._read_entries(config_file):
+            dependencies = ConfigDependencies.from_dict(entry['dependencies'])
+            if dependencies.is_valid(self.runner):
+                parser_log.debug('Using cached config for %s', config_file)
+                return TerragruntConfigParser(config_file, dependencies=dependencies, config=entry['config'], runner=self.runner)
+        return None
+
+    def store(self, config_parser: TerragruntConfigParser):
+        config_file = config_parser.config_file_path
+        entry = {
+            'dependencies': config_parser.dependencies.to_dict(),
+            'config': config_parser.config
+        }
+        entries = [e for e in self._read_entries(config_file) if e['dependencies'] != entry['dependencies']]
+        entries = [entry] + entries[:CONFIG_CACHE_ENTRIES - 1]
+
+        # Some values (e.g. paths) are not JSON types, those are cached as strings
+        write_atomic(self._entry_path(config_file), json.dumps(entries, default=str))
+
+class IncludeCache:
+    """Process wide cache of the included configs, e.g. `backend.hcl` included by every stack
+
+    An included config is parsed and resolved once. For every other including config only the values which depend on the
+    including config (e.g. `path_relative_to_include()`) are resolved again, everything else is shared"""
+
+    def __init__(self):
+        self.includes = {}
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.includes.clear()
+
+    def get(self, path: Path, caller: TerragruntConfigParser) -> dict:
+        """Return the included config resolved for the including config"""
+
+        key = str(path.absolute())
+        with self.lock:
+            include = self.includes.get(key, None)
+        if include is None or not include.dependencies.is_valid(caller.runner):
+            include = TerragruntConfigParser(path, required_blocks=[], profiler=caller.profiler, track_caller=True, terragrunt_dir=caller.terragrunt_dir, runner=caller.runner)
+            with self.lock:
+                self.includes[key] = include
+            config = include.config
+        else:
+            parser_log.debug('Using parsed include %s', path)
+            config = self._resolve_for_caller(include, caller)
+        caller.dependencies.merge(include.dependencies)
+        return config
+
+    def _resolve_for_caller(self, include: TerragruntConfigParser, caller: TerragruntConfigParser) -> dict:
+        if not include.caller_dependent:
+            return include.config
+        if any([block_type == Block.LOCALS for block_type, _ in include.caller_dependent]):
+            # Any other value may depend on those locals, resolve everything again
+            return TerragruntConfigParser(include.config_file_path, config_str=include.config_str, required_blocks=[], dependencies=caller.dependencies, profiler=caller.profiler, terragrunt_dir=caller.terragrunt_dir, runner=caller.runner).config
+
+        # Copy only the nodes on the way to the values to resolve again, share the rest
+        resolver = include.for_caller(caller)
+        config = dict(include.config)
+        for block_type, path in include.caller_dependent:
+            value = include.intermediate
+            for key, _ in path:
+                value = value[key]
+            node = config
+            for _, key in path[:-1]:
+                node[key] = dict(node[key]) if isinstance(node[key], dict) else list(node[key])
+                node = node[key]
+            _, node[path[-1][1]] = resolver._resolve(value, block_type=block_type, is_recursive=True)
+        return config
+
+INCLUDE_CACHE = IncludeCache()
+
+def get_args(argv=None):
     parser = ArgumentParser(
         description='Run terragrunt template without using the Terragrunt'
     )
     parser.add_argument(
         'operation',
         default=Operation.PLAN.value,
-        help=f'Terraform operation to run, one of {[op.name.lower() for op in list(Operation)]}'
+        help=f'Terraform operation to run, one of {[op.name.lower() for op in list(Operation)]}, `{RUN_ALL}`, `{RENDER}` to only hydrate all the stacks, `{DRIFT}` to check all the stacks for drift, `{STATES}` to list the history of the local state or `{DAEMON}` to serve the commands from a long running process'
+    )
+    parser.add_argument(
+        'run_all_operation',
+        nargs='?',
+        default=None,
+        help=f'Terraform operation to run for every stack when the operation is `{RUN_ALL}`, or `stop` to stop the `{DAEMON}`'
     )
     parser.add_argument(
         '-s',
@@ -722,11 +3671,191 @@ def get_args():
         default='',
         help='Prefix of the configuration file to use'
     )
+    parser.add_argument(
+        '--cache-dir',
+        default=str(CONFIG_CACHE_DIR),
+        help='Directory to cache the resolved configuration in'
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        default=False,
+        help='If specified then the configuration is always parsed, the cache is neither used nor updated'
+    )
+    parser.add_argument(
+        '--plugin-cache-dir',
+        default=None,
+        help="Provider plugin cache directory shared by all the runs, Terraform's own setting (TF_PLUGIN_CACHE_DIR or the CLI configuration) is used unless specified"
+    )
+    parser.add_argument(
+        '--no-plugin-cache',
+        action='store_true',
+        default=False,
+        help='If specified then neither --plugin-cache-dir nor --provider-mirror is used'
+    )
+    parser.add_argument(
+        '--provider-mirror',
+        default=None,
+        help='Local filesystem mirror directory to install the providers from'
+    )
+    parser.add_argument(
+        '--profile',
+        nargs='?',
+        const=PROFILE_IN_RUN_DIR,
+        default=None,
+        help=f'Write a JSON report with the time taken by each phase of the run, to `{PROFILE_FILE.relative_to(RUN_DIR)}` in the run directory unless a file is given'
+    )
+    parser.add_argument(
+        '--profile-out',
+        default=None,
+        help='Profile the run with `cProfile` and write the results to `<PROFILE_OUT>.pstats` and, as collapsed stacks for flame graphs, to `<PROFILE_OUT>.collapsed`'
+    )
+    parser.add_argument(
+        '--log-level',
+        default=logging.getLevelName(LOG_LEVEL),
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help='Logging level'
+    )
+    parser.add_argument(
+        '--log-json',
+        default=None,
+        help='File to also write the log records to, as JSON lines'
+    )
+    parser.add_argument(
+        '--root',
+        default='.',
+        help=f'Directory to look for the stacks in when running `{RUN_ALL}`, `{RENDER}` or `{DRIFT}`'
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=RUN_ALL_WORKERS,
+        help=f'Maximum number of stacks to run in parallel when running `{RUN_ALL}`, `{RENDER}` or `{DRIFT}`'
+    )
+    parser.add_argument(
+        '--auto-approve',
+        action='store_true',
+        default=False,
+        help=f'If specified then `{RUN_ALL}` does not ask for a confirmation before `apply` or `destroy`'
+    )
+    parser.add_argument(
+        '--out',
+        default=None,
+        help=f'Directory to copy the output of every stack to when running `{RENDER}`, each into `<OUT>/<stack path>`'
+    )
+    parser.add_argument(
+        '--summary',
+        default=None,
+        help=f'File to also write the JSON summary of `{RENDER}` or `{DRIFT}` to'
+    )
+    parser.add_argument(
+        '--rescan',
+        action='store_true',
+        default=False,
+        help=f'If specified then `{DRIFT}` plans every stack, even the ones unchanged since their last clean scan'
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=None,
+        help='Seconds any Terraform command may run, it is interrupted (like with Ctrl-C) when it takes longer'
+    )
+    parser.add_argument(
+        '--tf-args',
+        default='',
+        help='Extra arguments of the Terraform operation, e.g. `--tf-args="-parallelism=20 -refresh=false"`'
+    )
+    parser.add_argument(
+        '--restore',
+        type=int,
+        default=None,
+        metavar='SERIAL',
+        help=f'Restore the local state to the snapshot of the serial when running `{STATES}`'
+    )
+    parser.add_argument(
+        '--diff',
+        type=int,
+        nargs=2,
+        default=None,
+        metavar='SERIAL',
+        help=f'Print the resources which differ between the snapshots of the two serials when running `{STATES}`'
+    )
+    parser.add_argument(
+        '--socket',
+        default=os.environ.get(DAEMON_SOCKET_ENV, None) or str(default_daemon_socket()),
+        help=f'Unix socket of the `{DAEMON}`, in a directory only the user can access'
+    )
+    parser.add_argument(
+        '--use-daemon',
+        action='store_true',
+        default=os.environ.get(DAEMON_ENABLED_ENV, '') == '1',
+        help=f'If specified (or `{DAEMON_ENABLED_ENV}=1`) then the command is run by the `{DAEMON}` if it is running'
+    )
+    parser.add_argument(
+        '--no-daemon',
+        action='store_true',
+        default=False,
+        help=f'If specified then the command runs in this process even with `--use-daemon` or `{DAEMON_ENABLED_ENV}=1`'
+    )
 
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.operation == RUN_ALL and args.run_all_operation is None:
+        parser.error(f'`{RUN_ALL}` requires the Terraform operation to run, e.g. `{RUN_ALL} plan`')
+    return args
+
+
+def main(argv=None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    args = get_args(argv)
+    if args.operation == DAEMON:
+        setup_logging(args.log_level, Path(args.log_json) if args.log_json else None)
+        if args.run_all_operation == 'stop':
+            return 0 if daemon_request(Path(args.socket), {'command': 'stop'}) is not None else 1
+        return Daemon(Path(args.socket)).serve()
+
+    if threading.current_thread() is threading.main_thread():
+        forward_signals()
+    if args.use_daemon and not args.no_daemon and DAEMON_DISABLED_ENV not in os.environ:
+        forwarded = forward_to_daemon(argv, Path(args.socket))
+        if forwarded is not None:
+            return forwarded
+    setup_logging(args.log_level, Path(args.log_json) if args.log_json else None)
+    cache_dir = None if args.no_cache else Path(args.cache_dir)
+    tf_operation = args.run_all_operation if args.operation == RUN_ALL else Operation.PLAN.name.lower() if args.operation == DRIFT else args.operation
+    runner = TerraformRunner(timeout=args.timeout, extra_args={tf_operation: shlex.split(args.tf_args)} if args.tf_args else None)
+    provider_cache = None
+    if not args.no_plugin_cache and (args.plugin_cache_dir or args.provider_mirror):
+        provider_cache = ProviderCache(Path(args.plugin_cache_dir) if args.plugin_cache_dir else None, Path(args.provider_mirror) if args.provider_mirror else None, runner)
+    if args.operation == RENDER:
+        render = Render(Path(args.root), args.workers, args.allow_state, args.prefix, cache_dir, Path(args.out) if args.out else None, Path(args.summary) if args.summary else None)
+        return render.run()
+    if args.operation == DRIFT:
+        drift = Drift(Path(args.root), args.workers, args.allow_state, args.prefix, cache_dir, provider_cache, Path(args.summary) if args.summary else None, args.rescan, runner)
+        return drift.run()
+    if args.operation == STATES:
+        stack = FS_CACHE.resolve_dir(Path('.'))
+        run_dir = stack_run_dir(stack, args.prefix)
+        store = StateStore(meta_path(run_dir, STATE_STORE))
+        if args.restore is not None:
+            # Runs of the config wait, none of them sees a partially restored state
+            with FileLock(meta_path(run_dir, RUN_LOCK)):
+                store.restore(args.restore, local_state_file(stack, args.prefix))
+        elif args.diff is not None:
+            print(json.dumps(store.diff(*args.diff), indent=2))
+        else:
+            for snapshot in store.snapshots():
+                print(f"{snapshot['serial']:>6} {snapshot['time']} {snapshot['lineage']} {snapshot['bytes']:>10} bytes ({snapshot['stored_bytes']} stored)")
+        return 0
+    if args.operation == RUN_ALL:
+        run_all = RunAll(args.run_all_operation, Path(args.root), args.workers, args.allow_state, args.prefix, cache_dir, args.auto_approve, provider_cache, runner)
+        return run_all.run()
+    profiler = Profiler(None, Path(args.profile_out) if args.profile_out else None)
+    hydrator = Hydrator(args.operation, args.allow_state, args.prefix, cache_dir, provider_cache, profiler, runner=runner)
+    if args.profile is not None:
+        profiler.report_file = meta_path(hydrator.run_dir, PROFILE_FILE) if args.profile is PROFILE_IN_RUN_DIR else Path(args.profile)
+    return 0 if hydrator.run()['exit_code'] == 0 else 1
 
 
 if __name__ == '__main__':
-    args = get_args()
-    hydrator = Hydrator(args.operation, args.allow_state, args.prefix)
-    hydrator.run()
\ No newline at end of file
+    sys.exit(main())
@@ -2,8 +2,22 @@ import unittest
 import os
 from pathlib import Path
 import tempfile
+import json
+import pstats
+import logging
+import io
+import sys
+import time
+import subprocess
+import signal
+import socket
+import shutil
+from unittest import mock
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
 
-from hydrator import TerragruntConfigParser, Block
+import bench_hydrator
+from hydrator import TerragruntConfigParser, Block, ConfigCache, RunAll, Hydrator, RUN_DIR, ProviderCache, Profiler, setup_logging, FileSystemCache, INCLUDE_CACHE, compile_expression, environ, Render, JsonView, Drift, plan_summary, StateStore, STATE_STORE, TerraformRunner, FS_CACHE, drift_stack, write_atomic, meta_path, DRIFT_RECORD, RUN_LOCK
 
 
 class TestHydrator(unittest.TestCase):
@@ -48,6 +62,114 @@ class TestHydrator(unittest.TestCase):
         new_val = config.get_block(Block.LOCALS)['sub_object']['str_val']
         self.assertEqual(new_val, 'my-some-replaced-value-string')
 
+    def test_parse_long_list(self):
+        items = ', '.join([f'"item-{i}"' for i in range(5000)])
+        config_str = f"""
+        locals {{
+            items = [{items}]
+            multi_line = [
+                "a",
+                "b",   # Trailing comma and comments are allowed
+            ]
+        }}"""
+        config = TerragruntConfigParser(Path('./no-file.hcl'), config_str=config_str, required_blocks=[])
+        self.assertEqual(len(config.get_block(Block.LOCALS)['items']), 5000)
+        self.assertEqual(config.get_block(Block.LOCALS)['items'][4999], 'item-4999')
+        self.assertEqual(config.get_block(Block.LOCALS)['multi_line'], ['a', 'b'])
+
+    def test_parse_comments_and_multi_line_functions(self):
+        config_str = """
+        // Line comment
+        locals {
+            /* Block
+               comment */
+            with_hash = "not # a comment"
+            merged    = merge(
+                {},
+                lookup({}, "missing", {})
+            )
+        }"""
+        config = TerragruntConfigParser(Path('./no-file.hcl'), config_str=config_str, required_blocks=[])
+        self.assertEqual(config.get_block(Block.LOCALS)['with_hash'], 'not # a comment')
+        self.assertEqual(config.get_block(Block.LOCALS)['merged'], {})
+
+    def test_locals_resolved_in_dependency_order(self):
+        # Every local references the next one, the worst case for resolving in the declaration order
+        count = 3000
+        lines = [f'v{i} = "${{local.v{i + 1}}}"' for i in range(count)]
+        config_str = 'locals {\n' + '\n'.join(lines) + f'\nv{count} = "end"\n}}'
+        config = TerragruntConfigParser(Path('./no-file.hcl'), config_str=config_str, required_blocks=[])
+        self.assertEqual(config.get_block(Block.LOCALS)['v0'], 'end')
+        self.assertEqual(list(config.get_block(Block.LOCALS))[0], 'v0')
+
+    def test_locals_cycle_errors(self):
+        config_str = """
+        locals {
+            a = "${local.b}"
+            b = merge(local.c, {})
+            c = local.a
+        }"""
+        with self.assertRaisesRegex(LookupError, 'a -> b -> c -> a'):
+            TerragruntConfigParser(Path('./no-file.hcl'), config_str=config_str, required_blocks=[])
+
+    def test_locals_missing_dependency_errors(self):
+        config_str = """
+        locals {
+            a = "${local.not_there}"
+        }"""
+        with self.assertRaises(LookupError):
+            TerragruntConfigParser(Path('./no-file.hcl'), config_str=config_str, required_blocks=[])
+
+    def test_expressions(self):
+        config_str = """
+        locals {
+            names = ["a", "b"]
+            obj   = { key = "value", "quoted key" = local.names[1] }
+            nested = "${local.obj.key}-${replace("${local.names[0]}-x", "-", "_")}"
+            merged = merge(local.obj, { extra = [1, true, null] })
+        }"""
+        config = TerragruntConfigParser(Path('./no-file.hcl'), config_str=config_str, required_blocks=[])
+        locals = config.get_block(Block.LOCALS)
+        self.assertEqual(locals['obj'], {'key': 'value', 'quoted key': 'b'})
+        self.assertEqual(locals['nested'], 'value-a_x')
+        self.assertEqual(locals['merged']['extra'], [1, True, None])
+
+        with self.assertRaises(ValueError):
+            self.config._resolve('not_a_function("x")')
+
+    def test_string_literals(self):
+        config_str = r"""
+        locals {
+            backtick  = "a`b"
+            marker    = "a§|b"
+            escapes   = "tab\tquote\"back\\slash\u00e9"
+            literal   = "$${not_interpolated}"
+            in_call   = replace("a`b", "`", "'")
+            "`key`"   = "value"
+            heredoc   = <<-EOT
+              say "hi" \n ${replace("a`b", "`", "")}
+              EOT
+        }"""
+        config = TerragruntConfigParser(Path('./no-file.hcl'), config_str=config_str, required_blocks=[])
+        self.assertEqual(config.get_block(Block.LOCALS), {
+            'backtick': 'a`b',
+            'marker': 'a§|b',
+            'escapes': 'tab\tquote"back\\slash\u00e9',
+            'literal': '${not_interpolated}',
+            'in_call': "a'b",
+            '`key`': 'value',
+            'heredoc': 'say "hi" \\n ab\n'
+        })
+
+    def test_expressions_compiled_once(self):
+        compile_expression.cache_clear()
+        value = '"${replace("a-b", "-", "_")}"'
+        for _ in range(3):
+            is_ok, res = self.config._resolve(value)
+            self.assertTrue(is_ok)
+            self.assertEqual(res, 'a_b')
+        self.assertEqual(compile_expression.cache_info().misses, 1)
+
     def test_parse_config_null_local_errors(self):
         config_str = """
         inputs = {
@@ -250,7 +372,1032 @@ class TestHydrator(unittest.TestCase):
         self.assertIsNone(config.get_block(Block.LOCALS)['null_local'])
         self.assertEqual(config.get_block(Block.LOCALS)['empty_object'], {})
         self.assertEqual(config.get_block(Block.INPUTS)['empty_object'], {})
-        
+
+    def test_config_cache(self):
+        config_str = """
+        locals {
+            params = jsondecode(file(get_env("hydrator_test_cache_var_file", "")))
+            x = "hi"
+        }
+        inputs = {
+            some_var = local.params.some_var
+        }"""
+        env_key = 'hydrator_test_cache_var_file'
+        with tempfile.TemporaryDirectory() as tmp:
+            config_file = Path(tmp) / 'terragrunt.hcl'
+            config_file.write_text(config_str)
+            var_file = Path(tmp) / 'variables.json'
+            var_file.write_text('{"some_var": "original"}')
+            os.environ[env_key] = str(var_file)
+
+            cache = ConfigCache(Path(tmp) / 'cache')
+            self.assertIsNone(cache.load(config_file))
+            parsed = TerragruntConfigParser(config_file, required_blocks=[])
+            cache.store(parsed)
+
+            cached = cache.load(config_file)
+            self.assertIsNotNone(cached)
+            self.assertEqual(cached.get_block(Block.INPUTS)['some_var'], 'original')
+            self.assertEqual(cached.get_block(Block.LOCALS), parsed.get_block(Block.LOCALS))
+            self.assertEqual(cached.get_block(Block.LOCALS), {'params': {'some_var': 'original'}, 'x': 'hi'})
+
+            # Any change to the environment variables or files read must invalidate the entry
+            os.environ[env_key] = str(var_file) + '.other'
+            self.assertIsNone(cache.load(config_file))
+            os.environ[env_key] = str(var_file)
+            self.assertIsNotNone(cache.load(config_file))
+            var_file.write_text('{"some_var": "changed"}')
+            self.assertIsNone(cache.load(config_file))
+
+
+    def _stub_terraform(self, bin_dir: Path, script: str):
+        """Put a fake `terraform` executable first in the PATH for the duration of the test"""
+
+        bin_dir.mkdir(parents=True, exist_ok=True)
+        terraform = bin_dir / 'terraform'
+        terraform.write_text('#!/bin/sh\n' + script)
+        terraform.chmod(0o755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = f'{bin_dir}{os.pathsep}{path}'
+        self.addCleanup(os.environ.__setitem__, 'PATH', path)
+
+    def _write_stacks(self, root: Path, stacks: dict):
+        """Create a Terraform template and a config directory for each of the given stacks"""
+
+        (root / 'tpl').mkdir()
+        (root / 'tpl' / 'main.tf').write_text('terraform {}\n')
+        (root / 'config').mkdir()
+        (root / 'config' / 'backend.hcl').write_text("""
+        remote_state {
+            backend = "s3"
+            config = {
+                key = "state/${path_relative_to_include()}/terraform.tfstate"
+            }
+        }""")
+        for name, extra in stacks.items():
+            (root / 'config' / name).mkdir()
+            (root / 'config' / name / 'terragrunt.hcl').write_text(f"""
+            terraform {{
+                source = "../../tpl"
+            }}
+            include "backend" {{
+                path = find_in_parent_folders("backend.hcl")
+            }}
+            {extra}""")
+
+    @unittest.skipIf(os.name == 'nt', 'Requires a POSIX shell for the stub terraform')
+    def test_run_all(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            log_file = root / 'terraform.log'
+            self._stub_terraform(root / 'bin', f'[ "$1" = init ] || [ "$1" = state ] || echo "$(basename $(dirname $(pwd))) $1" >> {log_file}\n')
+            self._write_stacks(root, {
+                'a': '',
+                'b': 'inputs = {\n a_remote_state_params = { key = "state/a/terraform.tfstate" }\n}',
+                'c': 'dependencies {\n paths = ["../b"]\n}',
+                'd': ''
+            })
+
+            run_all = RunAll('plan', root / 'config', workers=2)
+            graph = {run_all._name(k): sorted([run_all._name(d) for d in v]) for k, v in run_all.discover().items()}
+            self.assertEqual(graph, {'a': [], 'b': ['a'], 'c': ['b'], 'd': []})
+
+            self.assertEqual(run_all.run(), 0)
+            order = [l.split()[0] for l in log_file.read_text().splitlines()]
+            self.assertEqual(sorted(order), ['a', 'b', 'c', 'd'])
+            self.assertLess(order.index('a'), order.index('b'))
+            self.assertLess(order.index('b'), order.index('c'))
+
+            # Destroy runs in the reverse order
+            log_file.unlink()
+            self.assertEqual(RunAll('destroy', root / 'config', auto_approve=True).run(), 0)
+            order = [l.split()[0] for l in log_file.read_text().splitlines()]
+            self.assertLess(order.index('c'), order.index('b'))
+            self.assertLess(order.index('b'), order.index('a'))
+
+    @unittest.skipIf(os.name == 'nt', 'Requires a POSIX shell for the stub terraform')
+    def test_run_all_signals(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            log_file = root / 'terraform.log'
+            self._stub_terraform(root / 'bin', f'[ "$1" = plan ] || exit 0\ntrap \'kill $!; echo stopped >> {log_file}; exit 3\' INT TERM\necho started >> {log_file}\nsleep 30 &\nwait\n')
+            self._write_stacks(root, {'a': '', 'b': '', 'c': ''})
+
+            # SIGTERM reaches Terraform in every running stack, the queued ones never start
+            script = str(Path(__file__).resolve().parent / 'hydrator.py')
+            run_all = subprocess.Popen([sys.executable, script, 'run-all', 'plan', '--root', str(root / 'config'), '--workers', '2'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            for _ in range(200):
+                if log_file.exists() and log_file.read_text().count('started') == 2:
+                    break
+                time.sleep(0.05)
+            run_all.send_signal(signal.SIGTERM)
+            self.assertEqual(run_all.wait(20), 128 + signal.SIGTERM)
+            self.assertEqual(log_file.read_text().count('started'), 2)
+            self.assertEqual(log_file.read_text().count('stopped'), 2)
+
+
+    @unittest.skipIf(os.name == 'nt', 'Requires Unix sockets and a POSIX shell for the stub terraform')
+    def test_daemon(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp).resolve()
+            self._stub_terraform(root / 'bin', 'echo "terraform $1"\n')
+            self._write_stacks(root, {'a': 'inputs = {\n value = get_env("hydrator_test_daemon", "")\n}'})
+            script = str(Path(__file__).resolve().parent / 'hydrator.py')
+            sock = root / 'd.sock'
+            daemon = subprocess.Popen([sys.executable, script, 'daemon', '--socket', str(sock)], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            self.addCleanup(daemon.kill)
+            for _ in range(100):
+                if sock.exists():
+                    break
+                time.sleep(0.1)
+
+            # Output, exit code, working directory and environment are the ones of the client
+            stack = root / 'config' / 'a'
+            for value in ['one', 'two']:
+                env = dict(os.environ, hydrator_test_daemon=value, HYDRATOR_USE_DAEMON='1', HYDRATOR_DAEMON_ENV='hydrator_test_daemon')
+                res = subprocess.run([sys.executable, script, 'plan', '--socket', str(sock)], cwd=stack, env=env, capture_output=True, text=True)
+                self.assertEqual(res.returncode, 0, res.stderr)
+                self.assertIn('terraform plan', res.stdout)
+                self.assertEqual(json.loads((stack / RUN_DIR / 'hydrator.auto.tfvars.json').read_text()), {'value': value})
+            # Only the variables the command needs are passed on
+            env = dict(os.environ, hydrator_test_daemon='three')
+            res = subprocess.run([sys.executable, script, 'plan', '--socket', str(sock), '--use-daemon'], cwd=stack, env=env, capture_output=True, text=True)
+            self.assertEqual(res.returncode, 0, res.stderr)
+            self.assertEqual(json.loads((stack / RUN_DIR / 'hydrator.auto.tfvars.json').read_text()), {'value': ''})
+            res = subprocess.run([sys.executable, script, 'plan', '--socket', str(sock), '--use-daemon', '--prefix', 'missing-'], cwd=stack, capture_output=True, text=True)
+            self.assertEqual(res.returncode, 1)
+            self.assertIn('FileNotFoundError', res.stderr)
+            # Nothing is sent to a socket others can get to
+            root.chmod(0o755)
+            res = subprocess.run([sys.executable, script, 'plan', '--socket', str(sock), '--use-daemon'], cwd=stack, capture_output=True, text=True)
+            root.chmod(0o700)
+            self.assertEqual(res.returncode, 1)
+            self.assertIn('PermissionError', res.stderr)
+            # Not forwarded unless asked for
+            res = subprocess.run([sys.executable, script, 'plan', '--socket', str(sock)], cwd=stack, env=env, capture_output=True, text=True)
+            self.assertEqual(res.returncode, 0, res.stderr)
+            self.assertEqual(json.loads((stack / RUN_DIR / 'hydrator.auto.tfvars.json').read_text()), {'value': 'three'})
+
+            res = subprocess.run([sys.executable, script, 'daemon', 'stop', '--socket', str(sock)], capture_output=True, text=True)
+            self.assertEqual(res.returncode, 0)
+            out, _ = daemon.communicate(timeout=10)
+            self.assertEqual(daemon.returncode, 0)
+            self.assertEqual(out.count('Running `plan'), 4)
+            self.assertFalse(sock.exists())
+
+            # Without the daemon the command runs in the client
+            res = subprocess.run([sys.executable, script, 'plan', '--socket', str(sock), '--use-daemon'], cwd=stack, capture_output=True, text=True)
+            self.assertEqual(res.returncode, 0, res.stderr)
+            self.assertIn('terraform plan', res.stdout)
+
+    @unittest.skipIf(not hasattr(socket, 'SO_PEERCRED'), 'Requires peer credentials of Unix sockets')
+    def test_daemon_cancel(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp).resolve()
+            log_file = root / 'terraform.log'
+            self._stub_terraform(root / 'bin', f'[ "$1" = plan ] || exit 0\ntrap \'kill $!; echo stopped >> {log_file}; exit 3\' INT\necho started >> {log_file}\nsleep 30 &\nwait\n')
+            self._write_stacks(root, {'a': ''})
+            script = str(Path(__file__).resolve().parent / 'hydrator.py')
+            sock = root / 'd.sock'
+            daemon = subprocess.Popen([sys.executable, script, 'daemon', '--socket', str(sock)], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            self.addCleanup(daemon.kill)
+            for _ in range(100):
+                if sock.exists():
+                    break
+                time.sleep(0.1)
+
+            def wait_for_log(text: str, count: int):
+                for _ in range(200):
+                    if log_file.exists() and log_file.read_text().count(text) == count:
+                        return
+                    time.sleep(0.05)
+                self.fail(f'{text} not logged {count} time(s)')
+
+            # Ctrl-C of the client stops Terraform in the daemon, a killed client as well
+            stack = root / 'config' / 'a'
+            cmd = [sys.executable, script, 'plan', '--socket', str(sock), '--use-daemon']
+            client = subprocess.Popen(cmd, cwd=stack, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            wait_for_log('started', 1)
+            client.send_signal(signal.SIGINT)
+            self.assertNotEqual(client.wait(20), 0)
+            self.assertEqual(log_file.read_text().count('stopped'), 1)
+            client = subprocess.Popen(cmd, cwd=stack, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            wait_for_log('started', 2)
+            client.kill()
+            client.wait()
+            wait_for_log('stopped', 2)
+
+            # The daemon keeps serving
+            res = subprocess.run([sys.executable, script, 'daemon', 'stop', '--socket', str(sock)], capture_output=True, text=True)
+            self.assertEqual(res.returncode, 0)
+            out, _ = daemon.communicate(timeout=10)
+            self.assertEqual(daemon.returncode, 0)
+            self.assertEqual(out.count('Finished with exit code 130'), 2)
+
+    def test_dependency_outputs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp).resolve()
+            log_file, state_file, outputs_file = root / 'log.txt', root / 'state.json', root / 'outputs.json'
+            self._stub_terraform(root / 'bin', f"""
+            case "$1" in
+                state) cat {state_file} ;;
+                output) echo output >> {log_file}; cat {outputs_file} ;;
+            esac
+            """)
+            self._write_stacks(root, {
+                'a': '',
+                'b': """
+                dependency "a" {
+                    config_path  = "../a"
+                    mock_outputs = { id = "mock", name = "mock" }
+                }
+                locals {
+                    name = "${dependency.a.outputs.name}-b"
+                }
+                inputs = {
+                    id   = dependency.a.outputs.id
+                    name = local.name
+                }""",
+            })
+
+            def parse(cache_dir=None) -> dict:
+                return Hydrator('plan', cache_dir=cache_dir, stack_dir=root / 'config' / 'b').parse_config().config_parser.get_block(Block.INPUTS)
+
+            def outputs_read() -> int:
+                count = len(log_file.read_text().splitlines()) if log_file.exists() else 0
+                log_file.unlink(missing_ok=True)
+                return count
+
+            # Not applied yet
+            self.assertEqual(parse(), {'id': 'mock', 'name': 'mock-b'})
+            self.assertEqual(outputs_read(), 0)
+
+            (root / 'config' / 'a' / RUN_DIR / '.terraform').mkdir(parents=True)
+            state_file.write_text('{"lineage": "x", "serial": 1}')
+            outputs_file.write_text('{"id": {"value": "id-1", "type": "string"}, "name": {"value": "a", "type": "string"}}')
+            cache_dir = root / 'cache'
+            self.assertEqual(parse(cache_dir), {'id': 'id-1', 'name': 'a-b'})
+            self.assertEqual(outputs_read(), 1)
+
+            # Outputs are read again only when the state changed, so is the cached config
+            self.assertEqual(parse(), {'id': 'id-1', 'name': 'a-b'})
+            self.assertEqual(outputs_read(), 0)
+            state_file.write_text('{"lineage": "x", "serial": 2}')
+            outputs_file.write_text('{"id": {"value": "id-2", "type": "string"}, "name": {"value": "a", "type": "string"}}')
+            self.assertEqual(parse(cache_dir), {'id': 'id-2', 'name': 'a-b'})
+            self.assertEqual(outputs_read(), 1)
+
+            # Missing output, mocks are used only if there are no outputs at all
+            outputs_file.write_text('{"id": {"value": "id-3", "type": "string"}}')
+            state_file.write_text('{"lineage": "x", "serial": 3}')
+            with self.assertRaisesRegex(LookupError, 'dependency.a.outputs.name'):
+                parse()
+
+    def test_render(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp).resolve()
+            self._write_stacks(root, {
+                'a': 'inputs = {\n name = "a"\n}',
+                'b': '',
+                'c': 'locals {\n x = local.missing\n}',
+            })
+            summary_file, out = root / 'summary.json', root / 'out'
+            with redirect_stdout(io.StringIO()) as stdout:
+                res = Render(root / 'config', workers=2, cache_dir=None, out_dir=out, summary_file=summary_file).run()
+            self.assertEqual(res, 1)
+
+            summary = json.loads(stdout.getvalue())
+            self.assertEqual(summary, json.loads(summary_file.read_text()))
+            self.assertEqual((summary['stacks'], summary['succeeded'], summary['failed']), (3, 2, {'parse': 1}))
+            self.assertEqual(sorted(summary['results']['a']['phases']), ['parse', 'staging', 'vars'])
+            self.assertIn('LookupError', summary['results']['c']['error'])
+
+            # Each stack rendered into its own directory, nothing run
+            self.assertEqual(json.loads((out / 'a' / 'hydrator.auto.tfvars.json').read_text()), {'name': 'a'})
+            self.assertEqual((out / 'b' / 'main.tf').read_text(), 'terraform {}\n')
+            self.assertFalse((root / 'config' / 'a' / RUN_DIR / '.terraform').exists())
+
+    @unittest.skipIf(os.name == 'nt', 'Requires a POSIX shell for the stub terraform')
+    def test_drift(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp).resolve()
+            log_file = root / 'plans.log'
+            self._stub_terraform(root / 'bin', f"""stack=$(basename $(dirname $(pwd)))
+            case "$1" in
+                init) mkdir -p .terraform ;;
+                state) echo '{{"lineage": "l", "serial": 1}}' ;;
+                plan) echo "$stack $*" >> {log_file}; case $stack in a) exit 0 ;; b) exit 2 ;; *) echo "Error: boom"; exit 1 ;; esac ;;
+            esac
+            """)
+            self._write_stacks(root, {'a': '', 'b': '', 'c': '', 'd': 'locals {\n x = local.missing\n}'})
+
+            summary_file = root / 'drift.json'
+            with redirect_stdout(io.StringIO()):
+                res = Drift(root / 'config', workers=2, cache_dir=None, summary_file=summary_file).run()
+            self.assertEqual(res, 1)
+            summary = json.loads(summary_file.read_text())
+            self.assertEqual((summary['clean'], summary['drifted'], summary['errored'], summary['skipped']), (1, 1, 2, 0))
+            results = summary['results']
+            self.assertEqual([results[s]['status'] for s in 'abcd'], ['clean', 'drifted', 'errored', 'errored'])
+            self.assertEqual((results['c']['phase'], results['c']['error']), ('plan', 'Error: boom'))
+            self.assertEqual(results['d']['phase'], 'parse')
+            self.assertGreater(results['a']['seconds'], 0)
+            self.assertIn('a plan -detailed-exitcode -lock=false -input=false', log_file.read_text())
+
+            # Unchanged clean stacks are not planned again, unless asked to
+            log_file.unlink()
+            with redirect_stdout(io.StringIO()):
+                Drift(root / 'config', cache_dir=None, summary_file=summary_file).run()
+            self.assertTrue(json.loads(summary_file.read_text())['results']['a']['skipped'])
+            self.assertEqual(sorted([l.split()[0] for l in log_file.read_text().splitlines()]), ['b', 'c'])
+            with redirect_stdout(io.StringIO()):
+                Drift(root / 'config', cache_dir=None, rescan=True).run()
+            self.assertEqual(sorted([l.split()[0] for l in log_file.read_text().splitlines()]), ['a', 'b', 'b', 'c', 'c'])
+
+            # The clean scan is recorded while the stack is still locked, and is clean only if it was recorded
+            import fcntl
+            run_dir = root / 'config' / 'a' / RUN_DIR
+            locked = []
+            def write(path: Path, text, fail=False):
+                if path == meta_path(run_dir, DRIFT_RECORD):
+                    with open(meta_path(run_dir, RUN_LOCK), 'a') as f:
+                        try:
+                            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                            locked.append(False)
+                        except BlockingIOError:
+                            locked.append(True)
+                    if fail:
+                        raise OSError('No space left on device')
+                write_atomic(path, text)
+
+            with mock.patch('hydrator.write_atomic', write):
+                res = drift_stack(root / 'config' / 'a', cache_dir=None, rescan=True)
+            self.assertEqual((res['status'], locked), ('clean', [True]))
+            with mock.patch('hydrator.write_atomic', lambda path, text: write(path, text, fail=True)):
+                res = drift_stack(root / 'config' / 'a', cache_dir=None, rescan=True)
+            self.assertEqual((res['status'], res['error'], res['phase']), ('errored', 'OSError: No space left on device', 'plan'))
+            self.assertFalse(meta_path(run_dir, DRIFT_RECORD).exists())
+
+    def test_render_sources_and_backend(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            self._write_stacks(root, {'a': ''})
+            (root / 'tpl' / 'modules.tf').write_text("""
+            # module "commented" { source = "./no" }
+            locals {
+              s = "module \\"quoted\\" { source = \\"./no\\" }"
+              h = <<-EOT
+                module "heredoc" {
+                  source = "./no"
+                }
+              EOT
+            }
+            module "nested" {
+              a = { b = { c = { d = "}" } } }
+              dynamic "x" {
+                content { source = "./no" }
+              }
+              source = "./m" # after the nested blocks
+            }
+            module "registry" {
+              source = "terraform-aws-modules/vpc/aws"
+            }
+            module "one_line" { source = "./m" }
+            terraform {
+              required_providers {
+                aws = { source = "hashicorp/aws" }
+              }
+              backend "s3" {
+                # Set by the hydrator
+              }
+            }
+            """)
+            stack = root / 'config' / 'a'
+            hydrator = Hydrator('plan', cache_dir=None, stack_dir=stack).parse_config()._copy()
+            txt = (stack / RUN_DIR / 'modules.tf').read_text()
+            self.assertEqual(txt.count('"../../../tpl/m"'), 2)
+            self.assertEqual(txt.count('"./no"'), 3)
+            self.assertIn('source = \\"./no\\"', txt)
+            self.assertIn('source = "terraform-aws-modules/vpc/aws"', txt)
+            self.assertIn('source = "hashicorp/aws"', txt)
+            self.assertIn('backend "s3" {\n    key = "state/a/terraform.tfstate"\n  }', txt)
+
+            # The backend of the template must be the one of the `remote_state` and empty
+            for body, error in [('terraform {\n  backend "local" {}\n}', 'Invalid backend'), ('terraform {\n  backend "s3" {\n    key = "x"\n  }\n}', 'must be empty')]:
+                (root / 'tpl' / 'modules.tf').write_text(body)
+                with self.assertRaisesRegex(RuntimeError, error):
+                    hydrator._copy()
+
+            # Linear in the number of modules
+            (root / 'tpl' / 'modules.tf').write_text(''.join([f'module "m{i}" {{\n  source = "./m"\n  tags = {{ a = "{{" }}\n}}\n' for i in range(5000)]))
+            start = time.perf_counter()
+            hydrator._copy()
+            self.assertLess(time.perf_counter() - start, 2)
+            self.assertEqual((stack / RUN_DIR / 'modules.tf').read_text().count('source = "../../../tpl/m"'), 5000)
+
+    def test_incremental_staging(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            self._write_stacks(root, {'a': ''})
+            (root / 'tpl' / 'modules.tf').write_text('module "m" {\n  source = "./m"\n}\n')
+            (root / 'tpl' / 'backend.tf').write_text('terraform {\n  backend "s3" {}\n}\n')
+            stack = root / 'config' / 'a'
+            (stack / 'variables.json').write_text('{}')
+
+            Hydrator('plan', stack_dir=stack).parse_config()._copy()
+            run_dir = stack / RUN_DIR
+            self.assertIn(f'source = "../../../tpl/m"', (run_dir / 'modules.tf').read_text())
+            self.assertIn('key = "state/a/terraform.tfstate"', (run_dir / 'backend.tf').read_text())
+            if os.name != 'nt':
+                # Files which need no rewriting are linked, not copied
+                self.assertTrue(os.path.samefile(run_dir / 'main.tf', root / 'tpl' / 'main.tf'))
+                self.assertTrue(os.path.samefile(run_dir / 'variables.json', stack / 'variables.json'))
+            stats = {f.name: f.lstat().st_mtime_ns for f in run_dir.glob('*.tf')}
+
+            # Nothing changed, nothing must be touched
+            Hydrator('plan', stack_dir=stack).parse_config()._copy()
+            self.assertEqual(stats, {f.name: f.lstat().st_mtime_ns for f in run_dir.glob('*.tf')})
+
+            # Changes are picked up and removed files are pruned
+            (root / 'tpl' / 'modules.tf').write_text('module "other" {\n  source = "./other"\n}\n')
+            (stack / 'variables.json').unlink()
+            Hydrator('plan', stack_dir=stack).parse_config()._copy()
+            self.assertIn(f'source = "../../../tpl/other"', (run_dir / 'modules.tf').read_text())
+            self.assertEqual(stats['backend.tf'], (run_dir / 'backend.tf').lstat().st_mtime_ns)
+            self.assertFalse((run_dir / 'variables.json').exists())
+
+
+    @unittest.skipIf(os.name == 'nt', 'Requires a POSIX shell for the stub terraform')
+    def test_provider_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            log_file = root / 'terraform.log'
+            self._stub_terraform(root / 'bin', f"""
+            if [ "$1" = providers ]; then cat versions.tf >> {log_file}; fi
+            if [ "$1" = init ]; then echo "init ${{TF_PLUGIN_CACHE_DIR:-default}} $TF_CLI_CONFIG_FILE" >> {log_file}; fi
+            """)
+            lock_file = root / '.terraform.lock.hcl'
+            lock_file.write_text("""
+            # This file is maintained automatically by "terraform init".
+            provider "registry.terraform.io/databricks/databricks" {
+              version     = "1.50.0"
+              constraints = ">= 1.50.0"
+              hashes = [
+                "h1:abc=",
+              ]
+            }
+            provider "registry.terraform.io/hashicorp/aws" {
+              version = "4.58.0"
+            }""")
+
+            # Pre-seeded mirror has one of the providers already
+            mirror = root / 'mirror'
+            seeded = mirror / 'registry.terraform.io' / 'databricks' / 'databricks'
+            seeded.mkdir(parents=True)
+            (seeded / 'terraform-provider-databricks_1.50.0_linux_amd64.zip').write_text('')
+
+            cache = ProviderCache(root / 'cache', mirror)
+            cache.populate([lock_file])
+            mirrored = log_file.read_text()
+            self.assertIn('source  = "registry.terraform.io/hashicorp/aws"', mirrored)
+            self.assertIn('version = "= 4.58.0"', mirrored)
+            self.assertNotIn('databricks', mirrored)
+
+            self._write_stacks(root, {'a': ''})
+            log_file.unlink()
+            Hydrator('plan', provider_cache=cache, stack_dir=root / 'config' / 'a').parse_config()._copy()._init()
+            self.assertEqual(log_file.read_text().split(), ['init', str(root / 'cache'), str(mirror / '.hydrator.tfrc')])
+            self.assertIn(f'path = "{mirror.as_posix()}"', (mirror / '.hydrator.tfrc').read_text())
+
+            # Terraform's own plugin cache setting unless given, the stack's providers are mirrored before its init
+            env = os.environ.pop('TF_PLUGIN_CACHE_DIR', None)
+            try:
+                lock_file.rename(root / 'config' / 'a' / '.terraform.lock.hcl')
+                log_file.unlink()
+                Hydrator('plan', provider_cache=ProviderCache(None, root / 'other-mirror'), stack_dir=root / 'config' / 'a').parse_config()._copy()._init()
+            finally:
+                if env is not None:
+                    os.environ['TF_PLUGIN_CACHE_DIR'] = env
+            log = log_file.read_text()
+            self.assertIn('source  = "registry.terraform.io/databricks/databricks"', log)
+            self.assertEqual(log.splitlines()[-1].split(), ['init', 'default', str(root / 'other-mirror' / '.hydrator.tfrc')])
+
+    @unittest.skipIf(os.name == 'nt', 'Requires a POSIX shell for the stub terraform')
+    def test_provider_cache_lock(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp).resolve()
+            log_file = root / 'init.log'
+            self._stub_terraform(root / 'bin', f"""
+            if [ "$1" = init ]; then echo start >> {log_file}; sleep 0.3; echo end >> {log_file}; fi
+            """)
+            self._write_stacks(root, {'a': '', 'b': ''})
+
+            def init(stack: str, cache: ProviderCache):
+                Hydrator('plan', cache_dir=None, provider_cache=cache, stack_dir=root / 'config' / stack).parse_config()._copy()._init()
+
+            # Inits sharing a plugin cache run one at a time
+            cache = ProviderCache(root / 'cache')
+            with ThreadPoolExecutor(2) as pool:
+                list(pool.map(lambda s: init(s, cache), ['a', 'b']))
+            self.assertEqual(log_file.read_text().split(), ['start', 'end', 'start', 'end'])
+
+            # Only the mirror is used, nothing to serialize
+            log_file.unlink()
+            cache = ProviderCache(None, root / 'mirror')
+            with ThreadPoolExecutor(2) as pool:
+                list(pool.map(lambda s: init(s, cache), ['a', 'b']))
+            self.assertEqual(log_file.read_text().split(), ['start', 'start', 'end', 'end'])
+
+    @unittest.skipIf(os.name == 'nt', 'Requires a POSIX shell for the stub terraform')
+    def test_init_skipped_unless_changed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp).resolve()
+            log_file = root / 'log.txt'
+            self._stub_terraform(root / 'bin', f'if [ "$1" = init ]; then mkdir -p .terraform; echo "$@" >> {log_file}; fi\n')
+            self._write_stacks(root, {'a': ''})
+            main_tf = root / 'tpl' / 'main.tf'
+            main_tf.write_text('terraform {\n  backend "s3" {}\n}\n')
+            (root / 'tpl' / 'modules' / 'm').mkdir(parents=True)
+
+            def run(provider_cache=None):
+                Hydrator('plan', cache_dir=None, provider_cache=provider_cache, stack_dir=root / 'config' / 'a').run()
+                inits = log_file.read_text().splitlines() if log_file.exists() else []
+                log_file.unlink(missing_ok=True)
+                return inits
+
+            self.assertEqual(run(), ['init'])
+            self.assertEqual(run(), [])
+
+            # Backend changed
+            backend = root / 'config' / 'backend.hcl'
+            backend.write_text(backend.read_text().replace('state/', 'other-state/'))
+            self.assertEqual(run(), ['init -reconfigure'])
+            self.assertEqual(run(), [])
+
+            # Modules, including the ones used by local modules, and the lock file
+            main_tf.write_text(main_tf.read_text() + 'module "m" {\n  source = "./modules/m"\n}\n')
+            (root / 'tpl' / 'modules' / 'm' / 'main.tf').write_text('')
+            self.assertEqual(run(), ['init'])
+            (root / 'tpl' / 'modules' / 'm' / 'main.tf').write_text('module "n" {\n  source  = "org/n/aws"\n  version = "1.0.0"\n}\n')
+            self.assertEqual(run(), ['init'])
+            (root / 'tpl' / 'modules' / 'm' / 'main.tf').write_text('module "n" {\n  version = "1.1.0" # Before the source\n  source  = "org/n/aws"\n}\n')
+            self.assertEqual(run(), ['init'])
+            (root / 'config' / 'a' / '.terraform.lock.hcl').write_text('# lock')
+            self.assertEqual(run(), ['init'])
+            self.assertEqual(run(), [])
+
+            # Required providers, but not anything else in the `terraform` block
+            main_tf.write_text(main_tf.read_text().replace('backend "s3" {}', 'backend "s3" {}\n  required_providers {\n    aws = "~> 5.0"\n  }'))
+            self.assertEqual(run(), ['init'])
+            main_tf.write_text(main_tf.read_text().replace('backend "s3" {}', 'backend "s3" {}\n  required_version = ">= 1.5"'))
+            self.assertEqual(run(), [])
+
+            # Where the providers are installed from
+            self.assertEqual(run(ProviderCache(root / 'cache')), ['init'])
+            self.assertEqual(run(ProviderCache(root / 'cache')), [])
+            self.assertEqual(run(ProviderCache(root / 'cache', root / 'mirror')), ['init'])
+            self.assertEqual(run(), ['init'])
+
+            # Explicit init always runs, the plan after it does not run it again
+            Hydrator('init', cache_dir=None, stack_dir=root / 'config' / 'a').run()
+            self.assertEqual(run(), ['init'])
+
+    @unittest.skipIf(os.name == 'nt', 'Requires a POSIX shell for the stub terraform')
+    def test_concurrent_stacks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp).resolve()
+            self._stub_terraform(root / 'bin', '[ "$1" = plan ] && basename $(dirname $(pwd)) > ran-in\nexit 0\n')
+            names = [f's{i}' for i in range(8)]
+            self._write_stacks(root, {n: 'inputs = {\n dir = "${get_terragrunt_dir()}"\n file = file("extra.txt")\n}' for n in names})
+            (root / 'tpl' / 'main.tf').write_text('terraform {\n  backend "s3" {}\n}\n')
+            for n in names:
+                (root / 'config' / n / 'extra.txt').write_text(n)
+
+            # Stacks run from threads, none of them in the current directory
+            cwd = os.getcwd()
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                results = list(pool.map(lambda n: Hydrator('plan', cache_dir=None, stack_dir=root / 'config' / n).run(), names))
+            self.assertEqual(os.getcwd(), cwd)
+            for n, res in zip(names, results):
+                run_dir = root / 'config' / n / RUN_DIR
+                self.assertEqual((res['exit_code'], res['run_dir']), (0, str(run_dir)))
+                self.assertEqual(list(res['phases']), ['parse', 'staging', 'vars', 'init', 'plan'])
+                self.assertEqual((run_dir / 'ran-in').read_text().strip(), n)
+                self.assertEqual(json.loads((run_dir / 'hydrator.auto.tfvars.json').read_text()), {'dir': str(run_dir.parent), 'file': n})
+                # Included once, resolved for every stack
+                self.assertIn(f'key = "state/{n}/terraform.tfstate"', (run_dir / 'main.tf').read_text())
+
+            # Configs parsed from threads with explicit directories are the same as parsed one after another
+            def parse(n: str) -> dict:
+                stack = root / 'config' / n
+                return TerragruntConfigParser(stack / 'terragrunt.hcl', terragrunt_dir=stack).config
+
+            FS_CACHE.clear()
+            INCLUDE_CACHE.clear()
+            serial = [parse(n) for n in names]
+            FS_CACHE.clear()
+            INCLUDE_CACHE.clear()
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                parallel = list(pool.map(parse, names * 3))
+            self.assertEqual(parallel, serial * 3)
+            self.assertEqual(serial[3][Block.INPUTS.val()], {'dir': str(root / 'config' / 's3'), 'file': 's3'})
+            self.assertEqual(os.getcwd(), cwd)
+
+    @unittest.skipIf(os.name == 'nt', 'Requires a POSIX shell for the stub terraform')
+    def test_prefix_run_dirs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp).resolve()
+            log_file = root / 'log.txt'
+            self._stub_terraform(root / 'bin', f"""
+            [ "$1" = plan ] || exit 0
+            echo "start $(basename $(pwd))" >> {log_file}; sleep 0.3; echo "end $(basename $(pwd))" >> {log_file}
+            """)
+            self._write_stacks(root, {'a': ''})
+            stack = root / 'config' / 'a'
+            for prefix in ['dev-', 'test-']:
+                (stack / f'{prefix}terragrunt.hcl').write_text((stack / 'terragrunt.hcl').read_text() + f'inputs = {{\n env = "{prefix}"\n}}')
+
+            prefixes = ['dev-', 'test-', 'dev-', 'test-']
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                results = list(pool.map(lambda p: Hydrator('plan', prefix=p, cache_dir=None, stack_dir=stack).run(), prefixes))
+            self.assertEqual([Path(r['run_dir']).name for r in results], ['_hydrator-dev', '_hydrator-test', '_hydrator-dev', '_hydrator-test'])
+            for prefix in ['dev', 'test']:
+                self.assertEqual(json.loads((stack / f'_hydrator-{prefix}' / 'hydrator.auto.tfvars.json').read_text()), {'env': f'{prefix}-'})
+
+            # Runs of the same prefix one after another, of different prefixes at the same time
+            running, most = [], 0
+            for event, run_dir in [l.split() for l in log_file.read_text().splitlines()]:
+                if event == 'start':
+                    self.assertNotIn(run_dir, running)
+                    running.append(run_dir)
+                    most = max(most, len(running))
+                else:
+                    running.remove(run_dir)
+            self.assertEqual(most, 2)
+
+            # Each prefix caches its config in its own run directory
+            Hydrator('plan', prefix='dev-', stack_dir=stack).run()
+            self.assertTrue(any((stack / '_hydrator-dev' / '.hydrator' / 'config-cache').iterdir()))
+            self.assertFalse((stack / RUN_DIR / '.hydrator' / 'config-cache').exists())
+
+    def test_saved_plan(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp).resolve()
+            log_file, state_file, plan_exit = root / 'log.txt', root / 'state.json', root / 'plan-exit'
+            self._stub_terraform(root / 'bin', f"""
+            case "$1" in
+                init) mkdir -p .terraform ;;
+                state) cat {state_file} 2>/dev/null ;;
+                plan) echo "$*" >> {log_file}; touch hydrator.tfplan; exit $(cat {plan_exit}) ;;
+                apply) echo "$*" >> {log_file} ;;
+            esac
+            """)
+            self._write_stacks(root, {'a': ''})
+            state_file.write_text('{"lineage": "x", "serial": 1}')
+
+            def run(op: str, changes=True) -> list:
+                plan_exit.write_text('2' if changes else '0')
+                Hydrator(op, cache_dir=None, stack_dir=root / 'config' / 'a').run()
+                calls = log_file.read_text().splitlines() if log_file.exists() else []
+                log_file.unlink(missing_ok=True)
+                return calls
+
+            # Exactly the plan which was made is applied
+            self.assertEqual(run('plan'), ['plan -out=hydrator.tfplan -detailed-exitcode'])
+            self.assertEqual(run('apply'), ['apply hydrator.tfplan'])
+            state_file.write_text('{"lineage": "x", "serial": 2}')
+
+            # No changes, Terraform is not called again until anything changes
+            self.assertEqual(len(run('plan', changes=False)), 1)
+            self.assertEqual(run('plan', changes=False), [])
+            state_file.write_text('{"lineage": "x", "serial": 3}')
+            self.assertEqual(len(run('plan', changes=False)), 1)
+            self.assertEqual(run('plan', changes=False), [])
+            with environ({'TF_VAR_extra': 'value'}):
+                self.assertEqual(len(run('plan', changes=False)), 1)
+
+            # Plan is not applied if the configuration changed since
+            self.assertEqual(len(run('plan')), 1)
+            (root / 'tpl' / 'main.tf').write_text('terraform {}\n# Changed\n')
+            self.assertEqual(run('apply'), ['apply'])
+
+    @unittest.skipIf(os.name == 'nt', 'Requires a POSIX shell for the stub terraform')
+    def test_plan_summary(self):
+        big = {'tags': {f'k{i}': 'x' * 100 for i in range(2000)}, 'list': [[{'a': '"]}'}]] * 1000}
+        changes = [
+            {'address': 'aws_s3_bucket.a', 'type': 'aws_s3_bucket', 'change': {'actions': ['create'], 'before': None, 'after': big}},
+            {'address': 'aws_s3_bucket.b', 'type': 'aws_s3_bucket', 'change': {'actions': ['delete', 'create'], 'before': big, 'after': big}},
+            {'address': 'module.m.aws_iam_role.r', 'module_address': 'module.m', 'type': 'aws_iam_role', 'change': {'before': big, 'actions': ['update'], 'after': big}},
+            {'address': 'module.m.aws_iam_role.s', 'module_address': 'module.m', 'type': 'aws_iam_role', 'change': {'actions': ['delete']}},
+            {'address': 'data.aws_caller_identity.c', 'type': 'aws_caller_identity', 'change': {'actions': ['read']}},
+            {'address': 'aws_s3_bucket.c', 'type': 'aws_s3_bucket', 'change': {'actions': ['no-op'], 'before': big, 'after': big}},
+        ]
+        expected = {
+            'totals': {'create': 1, 'update': 1, 'replace': 1, 'delete': 1},
+            'modules': {
+                'root': {'aws_s3_bucket': {'create': 1, 'replace': 1}},
+                'module.m': {'aws_iam_role': {'update': 1, 'delete': 1}},
+            },
+        }
+        plan = json.dumps({'format_version': '1.2', 'prior_state': big, 'resource_changes': changes, 'configuration': big})
+
+        # Everything around the values is skipped, whatever the layout
+        self.assertEqual(plan_summary(io.StringIO(plan)), expected)
+        self.assertEqual(plan_summary(io.StringIO(json.dumps({'resource_changes': changes}, indent=1))), expected)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp).resolve()
+            (root / 'plan.json').write_text(plan)
+            self._stub_terraform(root / 'bin', f"""
+            case "$1" in
+                plan) exit 2 ;;
+                show) [ "$*" = "show -json hydrator.tfplan" ] && cat {root / 'plan.json'} ;;
+            esac
+            """)
+            self._write_stacks(root, {'a': ''})
+            res = Hydrator('plan', cache_dir=None, stack_dir=root / 'config' / 'a').run()
+            summary_file = root / 'config' / 'a' / RUN_DIR / 'plan-summary.json'
+            self.assertEqual(res['plan_summary'], str(summary_file))
+            self.assertEqual(json.loads(summary_file.read_text()), expected)
+
+    @unittest.skipIf(os.name == 'nt', 'Requires a POSIX shell for the stub terraform')
+    def test_state_history(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp).resolve()
+            new_state = root / 'new.tfstate'
+            self._stub_terraform(root / 'bin', f"""
+            case "$1" in
+                init) mkdir -p .terraform ;;
+                apply) cp {new_state} terraform.tfstate ;;
+            esac
+            """)
+            self._write_stacks(root, {'a': ''})
+            stack = root / 'config' / 'a'
+
+            def state(serial: int, resources: dict) -> dict:
+                return {'version': 4, 'lineage': 'l', 'serial': serial, 'resources': [
+                    {'mode': 'managed', 'type': 't', 'name': name, 'instances': [{'attributes': {'value': value}}]}
+                    for name, value in resources.items()
+                ]}
+
+            for serial, resources in enumerate([{'a': 1, 'b': 'x' * 10000}, {'a': 2, 'b': 'x' * 10000}, {'a': 2, 'c': 3}], 1):
+                new_state.write_text(json.dumps(state(serial, resources)))
+                Hydrator('apply', allow_state=True, cache_dir=None, stack_dir=stack).run()
+                self.assertEqual((stack / 'terraform.tfstate').read_text(), new_state.read_text())
+            # Nothing changed, nothing is written
+            mtime = (stack / 'terraform.tfstate').stat().st_mtime_ns
+            Hydrator('apply', allow_state=True, cache_dir=None, stack_dir=stack).run()
+            self.assertEqual((stack / 'terraform.tfstate').stat().st_mtime_ns, mtime)
+
+            store = StateStore(stack / STATE_STORE)
+            snapshots = store.snapshots()
+            self.assertEqual([s['serial'] for s in snapshots], [1, 2, 3])
+            self.assertLess(snapshots[0]['stored_bytes'], snapshots[0]['bytes'] / 10)
+            self.assertEqual(store.diff(1, 3), {'added': ['t.c'], 'removed': ['t.b'], 'changed': ['t.a']})
+            store.restore(1, stack / 'terraform.tfstate')
+            self.assertEqual(json.loads((stack / 'terraform.tfstate').read_text()), state(1, {'a': 1, 'b': 'x' * 10000}))
+            with self.assertRaises(LookupError):
+                store.find(4)
+
+            # A config with a prefix keeps its state next to the config, staged as the state of its own run directory, and
+            # its history in that run directory
+            (stack / 'dev-terragrunt.hcl').write_text((stack / 'terragrunt.hcl').read_text())
+            stack_state = (stack / 'terraform.tfstate').read_text()
+            new_state.write_text(json.dumps(state(1, {'d': 1})))
+            Hydrator('apply', allow_state=True, prefix='dev-', cache_dir=None, stack_dir=stack).run()
+            self.assertEqual((stack / 'dev-terraform.tfstate').read_text(), new_state.read_text())
+            self.assertEqual((stack / 'terraform.tfstate').read_text(), stack_state)
+            dev_store = StateStore(stack / '_hydrator-dev' / STATE_STORE.relative_to(RUN_DIR))
+            self.assertEqual([s['serial'] for s in dev_store.snapshots()], [1])
+            self.assertEqual([s['serial'] for s in store.snapshots()], [1, 2, 3])
+            # The state survives removing the run directory
+            shutil.rmtree(stack / '_hydrator-dev')
+            Hydrator('plan', allow_state=True, prefix='dev-', cache_dir=None, stack_dir=stack).run()
+            self.assertEqual((stack / '_hydrator-dev' / 'terraform.tfstate').read_text(), new_state.read_text())
+            self.assertFalse((stack / '_hydrator-dev' / 'dev-terraform.tfstate').exists())
+
+            # The same contents are stored once, only the latest snapshots are kept
+            store = StateStore(root / 'store', keep=2)
+            for serial in [1, 2, 1, 3]:
+                store.save(json.dumps(state(serial, {})).encode())
+            self.assertEqual([s['serial'] for s in store.snapshots()], [1, 3])
+            self.assertEqual(len(list((root / 'store' / 'objects').iterdir())), 2)
+
+    @unittest.skipIf(os.name == 'nt', 'Requires a POSIX shell for the stub terraform')
+    def test_terraform_runner(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp).resolve()
+            started = root / 'started'
+            self._stub_terraform(root / 'bin', f"""
+            case "$1" in
+                plan) echo "plan in $(basename $(dirname $(pwd)))"; echo "args $*" >&2; exit 2 ;;
+                apply) trap 'echo "stopped by $SIG"; exit 130' INT; trap 'echo terminated > {started}; exit 143' TERM
+                       SIG=INT; echo started > {started}; sleep 10 > /dev/null & wait $! ;;
+            esac
+            """)
+            self._write_stacks(root, {'a': ''})
+
+            # Output streams to the sinks, with the extra arguments of the command
+            lines = []
+            runner = TerraformRunner(sinks=[lines.append], extra_args={'plan': ['-parallelism=3']})
+            res = Hydrator('plan', cache_dir=None, stack_dir=root / 'config' / 'a', runner=runner).run()
+            plan = res['terraform'][-1]
+            self.assertEqual((plan['command'], plan['exit_code'], plan['cwd']), (['terraform', 'plan', '-parallelism=3', '-out=hydrator.tfplan', '-detailed-exitcode'], 2, res['run_dir']))
+            self.assertGreater(plan['seconds'], 0)
+            self.assertIn('plan in a\n', lines)
+            self.assertIn('args plan -parallelism=3 -out=hydrator.tfplan -detailed-exitcode\n', lines)
+
+            # Standard output read by the caller, standard error kept, the sinks get nothing
+            lines = []
+            res, output = runner.read(['plan', '-json'], root / 'config' / 'a', lambda stream: stream.read().upper())
+            self.assertEqual((res['exit_code'], output, res['stderr']), (2, 'PLAN IN CONFIG\n', 'args plan -parallelism=3 -json\n'))
+            self.assertEqual(lines, [])
+
+            # Interrupted when it takes too long
+            lines = []
+            start = time.perf_counter()
+            res = TerraformRunner(sinks=[lines.append], timeout=0.5).run(['apply'], root)
+            self.assertLess(time.perf_counter() - start, 5)
+            self.assertEqual((res['exit_code'], res['timed_out']), (130, True))
+            self.assertEqual(lines[-1], 'stopped by INT\n')
+
+            # A terminated process stops Terraform first
+            started.unlink()
+            code = f'import sys; sys.path.insert(0, {str(Path(__file__).parent.resolve())!r}); import hydrator; hydrator.forward_signals(); hydrator.TerraformRunner().run(["apply"], {str(root)!r})'
+            proc = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            for _ in range(100):
+                if started.exists():
+                    break
+                time.sleep(0.05)
+            proc.terminate()
+            self.assertEqual(proc.wait(5), 128 + 15)
+            self.assertEqual(started.read_text(), 'terminated\n')
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            self._stub_terraform(root / 'bin', 'true\n')
+            self._write_stacks(root, {'a': 'locals {\n name = "a"\n file = find_in_parent_folders("backend.hcl")\n}'})
+            report_file, out = root / 'profile.json', root / 'out' / 'profile'
+            Hydrator('plan', cache_dir=None, profiler=Profiler(report_file, out), stack_dir=root / 'config' / 'a').run()
+
+            report = json.loads(report_file.read_text())
+            self.assertEqual(list(report['phases']), ['parse', 'staging', 'vars', 'init', 'plan'])
+            self.assertGreater(report['total']['wall'], 0)
+            self.assertIn('../../tpl/main.tf', report['staging'])
+            self.assertEqual(sorted(report['locals']), ['file', 'name'])
+            self.assertEqual(report['functions']['find_in_parent_folders']['calls'], 2)
+            self.assertGreater(len(pstats.Stats(f'{out}.pstats').stats), 0)
+            self.assertIn('hydrator.py', Path(f'{out}.collapsed').read_text())
+
+            # By default the report is in the run directory of the prefix
+            stack = root / 'config' / 'a'
+            (stack / 'dev-terragrunt.hcl').write_text((stack / 'terragrunt.hcl').read_text())
+            script = str(Path(__file__).resolve().parent / 'hydrator.py')
+            res = subprocess.run([sys.executable, script, 'plan', '--prefix', 'dev-', '--no-cache', '--profile'], cwd=stack, capture_output=True, text=True)
+            self.assertEqual(res.returncode, 0, res.stderr)
+            self.assertEqual(list(json.loads((stack / '_hydrator-dev' / '.hydrator' / 'profile.json').read_text())['phases'])[0], 'parse')
+            self.assertFalse((stack / '_hydrator' / '.hydrator' / 'profile.json').exists())
+
+
+    def test_json_log(self):
+        logger = logging.getLogger('hydrator')
+        self.addCleanup(setattr, logger, 'handlers', logger.handlers)
+        self.addCleanup(logger.setLevel, logger.level)
+        with tempfile.TemporaryDirectory() as tmp:
+            json_file = Path(tmp) / 'log.jsonl'
+            setup_logging(logging.INFO, json_file)
+            TerragruntConfigParser(Path('./no-file.hcl'), config_str=self._config_with_basic_locals(), required_blocks=[])
+            self.assertEqual(json_file.read_text(), '')
+
+            setup_logging(logging.DEBUG, json_file)
+            TerragruntConfigParser(Path('./no-file.hcl'), config_str=self._config_with_basic_locals(), required_blocks=[])
+            records = [json.loads(l) for l in json_file.read_text().splitlines()]
+            for h in logger.handlers:
+                h.close()
+        self.assertGreater(len(records), 0)
+        self.assertTrue(all([r['logger'] == 'hydrator.parser' and r['level'] == 'DEBUG' for r in records]))
+        self.assertIn('Parsed config: ', records[-1]['message'])
+
+
+    def test_file_system_cache(self):
+        cache = FileSystemCache(max_bytes=10)
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp).resolve()
+            (root / 'a' / 'b').mkdir(parents=True)
+            f = root / 'a' / 'file.txt'
+            f.write_text('12345')
+            self.assertEqual(cache.read(f)[0], '12345')
+            self.assertIn(str(f), cache.files)
+
+            # Changes are picked up, the cache stays within its size
+            f.write_text('1234567')
+            self.assertEqual(cache.read(f)[0], '1234567')
+            g = root / 'a' / 'other.txt'
+            g.write_text('abcdef')
+            cache.read(g)
+            self.assertNotIn(str(f), cache.files)
+            self.assertLessEqual(cache.size, 10)
+
+            cache.index(root)
+            found, probed = cache.find_in_parents(root / 'a' / 'b', 'file.txt')
+            self.assertEqual(found, f)
+            self.assertEqual(probed, [str(root / 'a' / 'b' / 'file.txt')])
+
+            # New files are found even though the directory is indexed already
+            (root / 'a' / 'b' / 'file.txt').write_text('closer')
+            self.assertEqual(cache.find_in_parents(root / 'a' / 'b', 'file.txt')[0], root / 'a' / 'b' / 'file.txt')
+            self.assertIsNone(cache.find_in_parents(root / 'a' / 'b', 'no-such-file.tmp')[0])
+
+
+    def test_lazy_json_file(self):
+        variables = {
+            'cluster_params': {'name': 'main', 'nodes': [1, 2, {"deep": "va\\\"l]}"}]},
+            'admins': [{'name': f'admin-{i}', 'tags': {'team': '{[x'}} for i in range(50)],
+            'empty': {},
+            'unused': [[[[[[[[[['deep']]]]]]]]], {'a': None}],
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            var_file = Path(tmp) / 'variables.json'
+            var_file.write_text(json.dumps(variables, indent=2))
+            config = TerragruntConfigParser(Path(tmp) / 'terragrunt.hcl', required_blocks=[], config_str=f"""
+            locals {{
+                params = jsondecode(file("{var_file.as_posix()}"))
+                cluster = local.params.cluster_params
+            }}
+            inputs = {{
+                cluster = local.cluster
+                admin = local.params.admins[3].name
+                empty = local.params.empty
+            }}""")
+            inputs = config.get_block(Block.INPUTS)
+            self.assertEqual(inputs['cluster'], variables['cluster_params'])
+            self.assertEqual(inputs['admin'], 'admin-3')
+            self.assertEqual(inputs['empty'], {})
+
+            # The resolved locals are plain values, like if the file was decoded all at once
+            resolved = config.get_block(Block.LOCALS)
+            self.assertEqual(resolved['params'], variables)
+            self.assertEqual(resolved['cluster'], variables['cluster_params'])
+            self.assertEqual(json.loads(json.dumps(resolved)), {'params': variables, 'cluster': variables['cluster_params']})
+
+            # Only the containers on the referenced paths of the shared view of the file are indexed
+            params = FS_CACHE.json_view(var_file)[0]
+            self.assertIsInstance(params, JsonView)
+            self.assertIsNone(params['unused'].index)
+            self.assertIsNone(params['admins'][4].index)
+            self.assertEqual(len(params['admins']), 50)
+            self.assertEqual(list(params), list(variables))
+            self.assertEqual(params.materialize(), variables)
+
+        self.assertEqual(JsonView.of(b' [1, "a", [], {"b": [true]}] ').materialize(), [1, 'a', [], {'b': [True]}])
+        self.assertEqual(JsonView.of(b'"scalar"'), 'scalar')
+        with self.assertRaises(ValueError):
+            len(JsonView.of(b'{"a": [1, 2}'))
+
+    def test_include_parsed_once(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp).resolve()
+            self._write_stacks(root, {'a': '', 'b': ''})
+            backend = root / 'config' / 'backend.hcl'
+            backend.write_text(backend.read_text().replace('config = {', 'config = {\n bucket = "my-bucket"'))
+
+            keys = []
+            for name in ['a', 'b']:
+                config = TerragruntConfigParser(root / 'config' / name / 'terragrunt.hcl', terragrunt_dir=root / 'config' / name)
+                keys.append(config.get_block(Block.REMOTE_STATE)['config']['key'])
+                if name == 'a':
+                    include = INCLUDE_CACHE.includes[str(backend)]
+                    shared = include.config['remote_state']['config']
+            self.assertEqual(keys, ['state/a/terraform.tfstate', 'state/b/terraform.tfstate'])
+
+            # Parsed once, only the value depending on the including config is resolved again
+            self.assertIs(INCLUDE_CACHE.includes[str(backend)], include)
+            self.assertEqual([p for _, p in include.caller_dependent], [(('remote_state', 'remote_state'), ('config', 'config'), ('key', 'key'))])
+            self.assertEqual(shared['key'], 'state/a/terraform.tfstate')
+            self.assertEqual(config.get_block(Block.REMOTE_STATE)['config']['bucket'], 'my-bucket')
+
+            # Changes to the included file are picked up
+            backend.write_text(backend.read_text().replace('my-bucket', 'other-bucket'))
+            config = TerragruntConfigParser(root / 'config' / 'b' / 'terragrunt.hcl', terragrunt_dir=root / 'config' / 'b')
+            self.assertIsNot(INCLUDE_CACHE.includes[str(backend)], include)
+            self.assertEqual(config.get_block(Block.REMOTE_STATE)['config']['bucket'], 'other-bucket')
+
+    def test_benchmark(self):
+        cases = {'locals': {'locals': 50}, 'modules': {'modules': 5}}
+        results = bench_hydrator.run_benchmarks(cases, repeat=1)
+        self.assertEqual(list(results['cases']), ['locals', 'modules'])
+        for phases in results['cases'].values():
+            for phase in bench_hydrator.PHASES:
+                self.assertGreater(phases[phase]['seconds'], 0)
+                self.assertGreaterEqual(phases[phase]['peak_bytes'], 0)
+        self.assertEqual(results['cases']['locals']['sizes']['locals'], 50)
+
+        self.assertEqual(bench_hydrator.compare(results, results), [])
+        baseline = json.loads(json.dumps(results))
+        baseline['cases']['modules']['copy']['seconds'] = results['cases']['modules']['copy']['seconds'] - 1
+        self.assertEqual([r[:2] for r in bench_hydrator.compare(results, baseline)], [('modules', 'copy')])
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file